@@ -1,4 +1,5 @@
 import random
+import numpy as np
 import torch
 import torch.nn as nn
 from transformers import BertModel
@@ -8,6 +9,7 @@ import torch.nn.functional as F
 from torch_geometric.data import Data
 
 from utils.vocab_reader import Vocabulary
+from utils.load_data import tensorize
 from rgcn_encoder import RGCNModel
 from cross_att_model import CrossModel, CrossConfig
 
@@ -39,29 +41,35 @@ class CARST(nn.Module):
         self.ablation = config['ablation']
         
         # RSG data dir
-        rel_triple2id = []
         self.RSG_dir = config['RSG_dir']
-        with open(self.RSG_dir, 'r') as file:
-            for line in file:
-                # Assuming the elements of the triple are separated by whitespace
-                triple = line.strip().split()
-                rel_triple2id.append(triple)
-        head_r_list=[]
-        tail_r_list=[]
-        rtype_list=[]
-
-        # Generate ID representations of entities and relationships
-        for triple in rel_triple2id:
-            head, relation, tail  = triple
-            head_r_list.append(int(head))
-            tail_r_list.append(int(tail))
-            rtype_list.append(int(relation))
-        all_list=[]
-        all_list.append(head_r_list)
-        all_list.append(tail_r_list)
         self.x = torch.randn(self._voc_size , self._voc_size)
-        self.edge_index = torch.tensor(all_list , dtype=torch.long)
-        self.edge_type = torch.tensor(rtype_list)
+        if self.RSG_dir.endswith('.npz'):
+            # RSG2.npz of build_RSG2.py: src, dst and weight arrays
+            with np.load(self.RSG_dir) as rsg:
+                self.edge_index = torch.from_numpy(np.stack([rsg['src'], rsg['dst']]).astype(np.int64))
+                self.edge_type = torch.from_numpy(rsg['weight'].astype(np.int64))
+        else:
+            rel_triple2id = []
+            with open(self.RSG_dir, 'r') as file:
+                for line in file:
+                    # Assuming the elements of the triple are separated by whitespace
+                    triple = line.strip().split()
+                    rel_triple2id.append(triple)
+            head_r_list=[]
+            tail_r_list=[]
+            rtype_list=[]
+
+            # Generate ID representations of entities and relationships
+            for triple in rel_triple2id:
+                head, relation, tail  = triple
+                head_r_list.append(int(head))
+                tail_r_list.append(int(tail))
+                rtype_list.append(int(relation))
+            all_list=[]
+            all_list.append(head_r_list)
+            all_list.append(tail_r_list)
+            self.edge_index = torch.tensor(all_list , dtype=torch.long)
+            self.edge_type = torch.tensor(rtype_list)
 
         # Text encoding initialization
         # Download Link: https://huggingface.co/bert-base-uncased
@@ -245,14 +253,10 @@ class CARST(nn.Module):
         pass
 
     def forward(self, batch, device):
-        if len(batch) == 7:
-            [relation, head, tail, path, num_path, path_mask, overall_mask] = batch
-            pos_id = None
-        elif len(batch) == 8:
-            [pos_id, relation, head, tail, path, num_path, path_mask, overall_mask] = batch
-        else:
-            print(batch)
-            raise
+        #a TensorBatch of collate_tensors, or the column lists of collate_fn and of the negatives
+        batch = tensorize(batch).to(device)
+        relation = batch.relation
+        n_batch = len(batch)
         # full model
         if self.ablation == 0:
             # text embedding
@@ -292,108 +296,75 @@ class CARST(nn.Module):
         
         # mask structure and text
         else :
-            output = self.emb_look_up(torch.tensor(relation, dtype=torch.int).to(device))
-            
-        
-        r_emb=[]
-        for r in relation:
-            temp=output[r]
-            r_emb.append(temp.tolist())
-        r_emb = torch.tensor(r_emb).to(device)
-        
-        
-        #randomly sample relational paths between entities
-        if self.sample_path >= 0:
-            path = list(path)
-            path_mask = list(path_mask)
-            overall_mask = list(overall_mask)
+            output = self.emb_look_up(relation)
+
+        #lookups in the relation representations are not trained through
+        table = output.detach()
+        r_emb = table[relation]
 
-            for i in range(len(path)):
-                n = num_path[i]
+        path, path_len, num_path = batch.path, batch.path_len, batch.num_path
+        #randomly sample relational paths between entities
+        if self.sample_path >= 0 and bool((num_path > self.sample_path).any()):
+            starts = (torch.cumsum(num_path, 0) - num_path).tolist()
+            keep = []
+            for i, n in enumerate(num_path.tolist()):
                 if n > self.sample_path:
-                    if pos_id is not None:
-                        #random.seed(pos_id[i])
-                        rand_id = random.sample([x for x in range(n)], self.sample_path)
-                    else:
-                        rand_id = random.sample([x for x in range(n)], self.sample_path)
-                    path[i] = [path[i][id_] for id_ in rand_id]
-                    path_mask[i] = [path_mask[i][id_] for id_ in rand_id]
-                overall_mask[i] = overall_mask[i][ : 4 + self.sample_path]
-                overall_mask[i][0] = 0 # fusion module does not consider [MASK]
-
-            num_path = [min(it, self.sample_path) for it in num_path]
-        
-        path_merge = list()
-        path_mask_merge = list()
-        all_pos = [x for x in range(self._max_path_len + 1)] #2 for [CLS] and relation
+                    keep.extend(starts[i] + id_ for id_ in random.sample(range(n), self.sample_path))
+                else:
+                    keep.extend(range(starts[i], starts[i] + n))
+            keep = torch.tensor(keep, dtype=torch.long).to(device)
+            path, path_len = path[keep], path_len[keep]
+            num_path = torch.clamp(num_path, max=self.sample_path)
+
+        all_pos = torch.arange(self._max_path_len + 1).to(device) #2 for [CLS] and relation
         if self.ablation > 3 or self.ablation < 0 :
-            all_pos = torch.tensor(all_pos).to(device)
             path_position_emb = self.positoin_emb_look_up(all_pos)
         else:
-            path_position_emb=[]
-            for pos in all_pos:
-                temp=output[pos]
-                path_position_emb.append(temp.tolist())
-            path_position_emb = torch.tensor(path_position_emb).to(device)
+            path_position_emb = table[all_pos]
 
-        for its in path:       
-            path_merge.extend(its)
-        for its in path_mask:
-            path_mask_merge.extend(its)
-
-        accu_num_path = torch.tensor([0] + list(num_path), dtype=torch.int).to(device)
-        accu_num_path = torch.cumsum(accu_num_path, dim=0)
-        num_path = torch.tensor(num_path, dtype=torch.float32).to(device)
+        accu_num_path = torch.cumsum(F.pad(num_path, (1, 0)), dim=0)
+        #example of every path and its slot among the paths of that example
+        path_owner = torch.repeat_interleave(torch.arange(n_batch).to(device), num_path)
+        path_slot = torch.arange(len(path)).to(device) - accu_num_path[path_owner]
+        num_path = num_path.float()
 
         if self.ablation > 3 or self.ablation < 0:
-            mask_emb = self.emb_look_up(torch.tensor([2]*len(head)).to(device)) #[MASK]
+            mask_emb = self.emb_look_up(torch.full((n_batch,), 2).to(device)) #[MASK]
         else:
-            mask_emb=[]
-            for m in [2]*len(head):
-                temp=output[m]
-                mask_emb.append(temp.tolist())
-            mask_emb = torch.tensor(mask_emb).to(device)
+            mask_emb = table[2].expand(n_batch, -1)
 
         #Entity Transformer
-        max_n_rel_nbr = max([len(it) for it in head] + [len(it) for it in tail])
+        max_n_rel_nbr = max(batch.head.shape[1], batch.tail.shape[1])
+        head = F.pad(batch.head, (0, max_n_rel_nbr - batch.head.shape[1]))
+        tail = F.pad(batch.tail, (0, max_n_rel_nbr - batch.tail.shape[1]))
+        positions = torch.arange(max_n_rel_nbr).to(device).unsqueeze(0)
+        lead_valid = torch.ones((n_batch, 1), dtype=torch.bool).to(device)
         
         if self.is_ent_pair is True:
-            pad_head = [[3] + it + [0] * (max_n_rel_nbr - len(it)) for it in head] #inv_[MASK] id
-            pad_tail = [it + [0] * (max_n_rel_nbr - len(it)) for it in tail] #inv_[CLS] id
-            pad_ent_pair = [it_h + it_t for (it_h, it_t) in zip(pad_head, pad_tail)]
-            ent_attn_bias = [[1] * len(it_h) + [0] * (max_n_rel_nbr - len(it_h)) + [1] * len(it_t) + [0] * (max_n_rel_nbr - len(it_t))\
-                 for (it_h, it_t) in zip(pad_head, pad_tail)]
+            pad_ent_pair = torch.cat((torch.full((n_batch, 1), 3).to(device), head, tail), 1) #inv_[MASK] id
+            ent_attn_bias = torch.ones(pad_ent_pair.shape).to(device)
         else:
-            pad_head = [[3] + it + [0] * (max_n_rel_nbr - len(it)) for it in head] 
-            pad_tail = [[5] + it + [0] * (max_n_rel_nbr - len(it)) for it in tail] 
-            ent_attn_bias = [[1] * (len(it) + 1) + [0] * (max_n_rel_nbr - len(it)) for it in head]\
-                + [[1] * (len(it) + 1) + [0] * (max_n_rel_nbr - len(it)) for it in tail]
+            pad_head = torch.cat((torch.full((n_batch, 1), 3).to(device), head), 1)
+            pad_tail = torch.cat((torch.full((n_batch, 1), 5).to(device), tail), 1)
+            ent_attn_bias = torch.cat((
+                torch.cat((lead_valid, positions < batch.head_len.unsqueeze(1)), 1),
+                torch.cat((lead_valid, positions < batch.tail_len.unsqueeze(1)), 1)), 0).float()
         
-        ent_attn_bias = torch.tensor(ent_attn_bias, dtype=torch.float).to(device).unsqueeze(-1)
+        ent_attn_bias = ent_attn_bias.unsqueeze(-1)
         ent_attn_mask = torch.matmul(ent_attn_bias, ent_attn_bias.transpose(-1, -2))
         ent_attn_mask = torch.mul(torch.sub(ent_attn_mask, 1.0), 10000.0)
         n_head_ent_attn_mask = torch.stack([ent_attn_mask] * self._n_head, axis=1)
         n_head_ent_attn_mask.requires_gradient = False
 
         if self.is_ent_pair is True:
-            head_tail_emb_input = self.emb_look_up(torch.tensor(pad_ent_pair, \
-                dtype=torch.int).to(device))
+            head_tail_emb_input = self.emb_look_up(pad_ent_pair)
             type_id = [0] + [1 for x in range(max_n_rel_nbr)] + [2 for x in range(max_n_rel_nbr)]
             head_tail_emb_input = head_tail_emb_input + self.type_emb_look_up(torch.tensor(type_id, dtype=torch.int).to(device))
         else:
             if self.ablation > 3 or self.ablation < 0:
-                head_tail_emb_input = self.emb_look_up(torch.tensor(pad_head + pad_tail, \
-                                                        dtype=torch.int).to(device))
+                head_tail_emb_input = self.emb_look_up(torch.cat((pad_head, pad_tail), 0))
             else:
-                pad_list=pad_head + pad_tail
-                head_tail_emb_input=[]
-                for pad in pad_list:
-                    r_emb3=[]
-                    for r in pad:
-                        temp=output[r]
-                        r_emb3.append(temp.tolist())
-                    head_tail_emb_input.append(r_emb3)
-                head_tail_emb_input=torch.tensor(head_tail_emb_input).to(device)
+                head_tail_emb_input = table[torch.cat((pad_head, pad_tail), 0)]
 
         head_tail_emb_input = self.ln6(head_tail_emb_input)
         head_tail_emb_input = self.dropout(head_tail_emb_input)
@@ -407,32 +378,23 @@ class CARST(nn.Module):
         if self.is_ent_pair is True:
             ent_pair_emb = self.head_tail_enc_out
         else:
-            head_emb = self.head_tail_enc_out[:len(head)]
-            tail_emb = self.head_tail_enc_out[len(head):]
+            head_emb = self.head_tail_enc_out[:n_batch]
+            tail_emb = self.head_tail_enc_out[n_batch:]
 
-        if len(path_merge) == 0:
+        if len(path) == 0:
             #A batch with no valid relational path, which occurs in evaluation
-            self.path_enc_out = torch.empty(len(head), self._emb_size)
+            self.path_enc_out = torch.empty(n_batch, self._emb_size)
         else:
             if self.ablation > 3 or self.ablation < 0:
-                tmp = torch.tensor(path_merge, dtype=torch.int).to(device)
-                path_merge_emb = self.emb_look_up(tmp)
+                path_merge_emb = self.emb_look_up(path)
             else:
-                path_merge_emb=[]           
-                for p in path_merge:
-                    r_emb2=[]
-                    for r in p:
-                        temp=output[r]
-                        r_emb2.append(temp.tolist())
-                    path_merge_emb.append(r_emb2)
-                path_merge_emb = torch.tensor(path_merge_emb).to(device)
+                path_merge_emb = table[path]
 
             # add position embedding to paths
             path_merge_emb += path_position_emb
-            # due with mask
-            path_mask_merge = torch.tensor(path_mask_merge, dtype=torch.float).to(device)
-            path_mask_merge = torch.unsqueeze(path_mask_merge, -1)
-            path_attn_mask = torch.matmul(path_mask_merge, path_mask_merge.transpose(-1, -2))#???                
+            # due with mask: [CLS] and the relations of a path attend to each other
+            path_valid = torch.arange(path.shape[1]).to(device).unsqueeze(0) <= path_len.unsqueeze(1)
+            path_attn_mask = (path_valid.unsqueeze(2) & path_valid.unsqueeze(1)).float()
             path_attn_mask = torch.mul(torch.sub(path_attn_mask, 1.0), 1000000.0) 
 
             n_head_path_attn_mask = torch.stack([path_attn_mask] * self._n_head, axis=1)         
@@ -454,40 +416,27 @@ class CARST(nn.Module):
                     index=torch.tensor(0).to(device)).squeeze(1) #[CLS] as output
                 
         #overall transformer, which fuses relational paths and context
-        if self.is_ent_pair is True:
-            for i in range(len(overall_mask)):
-                overall_mask[i] = overall_mask[i][1:]
-                
-
-        if self.ablation > 3 or self.ablation < 0:
-            overall_mask_emb = self.emb_look_up(torch.tensor(overall_mask).to(device))
-        else:
-            overall_mask_emb=[]
-            for m in overall_mask:
-                temp=output[m]
-                overall_mask_emb.append(temp.tolist())
-            overall_mask_emb=torch.tensor(overall_mask_emb).to(device)
-        
-        overall_mask = torch.tensor(overall_mask, dtype=torch.float).to(device)
-        overall_mask = torch.unsqueeze(overall_mask, -1)
-        overall_attn_mask = torch.matmul(overall_mask, overall_mask.transpose(-1, -2))
+        #leading [MASK]\relation\head\tail, or [MASK]\relation\entity pair
+        n_lead = 3 if self.is_ent_pair is True else 4
+        #path slots stop at the most paths in the batch, masked slots past them change no output
+        n_slot = int(num_path.max()) if n_batch > 0 else 0
+        overall_valid = torch.arange(n_lead + n_slot).to(device).unsqueeze(0) \
+            < (num_path + n_lead).unsqueeze(1)
+        if self.sample_path >= 0 and self.is_ent_pair is not True:
+            overall_valid[:, 0] = False # fusion module does not consider [MASK]
+        overall_attn_mask = (overall_valid.unsqueeze(2) & overall_valid.unsqueeze(1)).float()
         overall_attn_mask = torch.mul(torch.sub(overall_attn_mask, 1.0), 1000000.0)
         n_head_overall_attn_mask = torch.stack([overall_attn_mask] * self._n_head, axis=1)
         n_head_overall_attn_mask.requires_gradient = False
 
-        max_path_input = torch.empty(len(head), self._max_num_path, self._emb_size).to(device)
-        for i in range(len(head)):
-            if num_path[i] == 0:
-                if self.is_ent_pair is True:
-                    max_path_input[i] = overall_mask_emb[i, 3:]
-                else:
-                    max_path_input[i] = overall_mask_emb[i, 4:]
-            else:
-                path_pad_input = self.path_enc_out[accu_num_path[i]:accu_num_path[i+1]]
-                if self.is_ent_pair is True:
-                    max_path_input[i] = torch.cat((path_pad_input, overall_mask_emb[i, num_path[i].int()+3:]), 0)
-                else:
-                    max_path_input[i] = torch.cat((path_pad_input, overall_mask_emb[i, num_path[i].int()+4:]), 0)
+        #path slots after the paths of an example hold the [PAD] embedding
+        if self.ablation > 3 or self.ablation < 0:
+            pad_emb = self.emb_look_up(torch.tensor(0).to(device))
+        else:
+            pad_emb = table[0]
+        max_path_input = pad_emb.expand(n_batch, n_slot, self._emb_size).clone()
+        if len(path) > 0:
+            max_path_input[path_owner, path_slot] = self.path_enc_out
 
         #max_path_input=max_path_input[:,:-1,:]
         
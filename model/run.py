@@ -7,18 +7,26 @@ import time
 import re
 import json
 import math
+import functools
 from tqdm import tqdm
 
 from torch.utils.data import DataLoader
 from torch.optim.lr_scheduler import LambdaLR
-import networkx as nx
 
 import sys
 sys.path.append('.')
-from utils.load_data import MyDataset, collate_fn
+from utils.load_data import MyDataset, BinaryDataset, TensorBatch, TensorDataset, NegativeCollate, \
+    LazyDataset, LazyBinaryDataset
 from utils.vocab_reader import Vocabulary
+from utils.kg_graph import KnowledgeGraph
+from utils.manifest import file_hash
+from utils.path_index import PathIndex
+from utils.relation_context import RelationContext
+from utils.negative_sampler import NegativeSampler
+from utils.negative_store import load_negatives, store_dir
+from utils.negative_queue import NegativeQueue
+from utils.bucket_sampler import BucketBatchSampler, padding_waste, shuffled_batches
 from model.carst_model import CARST
-from utils.preprocess_ind_data import filter_repeat_path
 from sklearn.metrics import average_precision_score, roc_auc_score
 from utils.negative_sampling_text_sim import convert_neg_sample
 
@@ -74,12 +82,28 @@ parser.add_argument('--no_lr_scheduler', default='False', action='store_true',
                         help='Use LR scheduler?')
 parser.add_argument('--encode_ent_pair', default='False', action='store_true', help='encode head and tail entity separately or together?')
 parser.add_argument('--ablation', type=int, default=3, help='0: full model; 1: mask structure; 2: mask text; 3: mask Cross-attention')
+parser.add_argument('--data_format', type=str, default='json', choices=['json', 'binary'],
+                        help='read train/test queries and negatives from json lines and .npy, or from the <split>_bin/ arrays of preprocess_ind_data.py and negative_sampling_random.py')
+parser.add_argument('--path_index', type=str, default='',
+                        help='directory of the entity-pair path index written by preprocessing; empty (the default) disables it')
+parser.add_argument('--negative_workers', type=int, default=0,
+                        help='processes drawing fresh negatives for upcoming batches; 0 replays the precomputed negatives only')
+parser.add_argument('--negative_queue_depth', type=int, default=8,
+                        help='batches read ahead of training for the negative workers')
+parser.add_argument('--max_batch_tokens', type=int, default=0,
+                        help='batch training examples of similar path counts and context lengths, at most this many padded tokens and --batch_size examples a batch; 0 keeps uniformly shuffled batches')
+parser.add_argument('--loader_workers', type=int, default=2,
+                        help='persistent DataLoader processes assembling training batches with their precomputed negatives; 0 builds them in the training loop')
+parser.add_argument('--prefetch_factor', type=int, default=2,
+                        help='batches each loader worker keeps ready ahead of training')
+parser.add_argument('--lazy_dataset', action='store_true',
+                        help='read training examples on demand through a mapped offset index instead of loading the whole split into memory')
 
 args = parser.parse_args()
 
 
 def predict_grail_rank(model, device, neg_path, is_eval=False):
-    data_dict = np.load(neg_path, allow_pickle=True).item()
+    data_dict = load_negatives(neg_path)
     n_data = len(data_dict)
     #print('num of data: ', n_data)
     
@@ -118,7 +142,7 @@ def predict_grail_rank(model, device, neg_path, is_eval=False):
 
 
 def auc_pr(model, device, neg_path, is_eval=False):
-    data_dict = np.load(neg_path, allow_pickle=True).item()
+    data_dict = load_negatives(neg_path)
     n = len(data_dict)
     
     rands = [5, 6]
@@ -177,45 +201,42 @@ def auc_pr(model, device, neg_path, is_eval=False):
     return aucs, auc_pr_scores
 
 
+def batch_positive_ids(batch):
+    if isinstance(batch, TensorBatch):
+        return batch.pos_id.tolist()
+    return list(batch[0])
+
+
 class TrainGraph(object):
-    def __init__(self, raw_train, vocab, relation_context, neg_examples_path):
+    def __init__(self, raw_train, vocab, relation_context, neg_examples_path, index_dir=None):
         self.raw_train = raw_train
+        self.index_dir = index_dir
         self.vocab = vocab
-        self.neg_examples = np.load(neg_examples_path, allow_pickle=True).item()
-        with open(relation_context, 'r') as f_dict:
-            self.r_context = json.load(f_dict)
+        self.neg_examples = load_negatives(neg_examples_path)
+        self.r_context = RelationContext.load(relation_context).to_vocab(vocab)
 
     def build_graph(self):
-        self.biG = nx.MultiDiGraph()
-        total_links = 0
-        with open(self.raw_train, 'r') as f_train:
-            for line in f_train.readlines():
-                total_links = total_links + 1
-                tokens = re.split(r'\t|\s', line.strip())
-                head = tokens[0]
-                tail = tokens[2]
-                relation = tokens[1]
-
-                self.biG.add_edge(head, tail, **{'r_type': relation})
-                self.biG.add_edge(tail, head, **{'r_type': 'inv_' + relation})
-        f_train.close()
+        self.graph = KnowledgeGraph.from_file(self.raw_train)
+        self.sampler = NegativeSampler(self.graph)
+        #paths already found by preprocessing or negative sampling
+        self.index = PathIndex(self.index_dir, file_hash(self.raw_train)) if self.index_dir else None
+
+    def relation_paths(self, head, tail, max_hops=4):
+        if self.index is not None:
+            return self.index.lookup(self.graph, head, tail, max_hops)
+        return self.graph.search_relation_paths(head, tail, max_hops)
 
     def neg_selection_for_training(self, train_batch, num_all_sample=200, num_negative=1):
         #neg_head_batch = []
         #neg_tail_batch = []
-        batch_size = len(train_batch[0])
+        #only the positive ids are read, from a TensorBatch or the lists of collate_fn
+        positive_ids = batch_positive_ids(train_batch)
         if num_negative == 1:
             neg_batch = []
-            for i in range(batch_size):
-                example = [train_batch[j][i] for j in range(len(train_batch))]
-                
-                head = example[2]
-                tail = example[3]
-                relation = example[1]
-                positive_id = example[0]
-
-                n_neg_examples = len(self.neg_examples[positive_id])
-                neg_example = [self.neg_examples[positive_id][j][1] for j in range(n_neg_examples)]
+            for positive_id in positive_ids:
+                #a store decodes the examples of a positive on every lookup
+                neg_examples = self.neg_examples[positive_id]
+                neg_example = [neg_examples[j][1] for j in range(len(neg_examples))]
                 
                 neg_batch.append(neg_example)
             
@@ -223,12 +244,9 @@ class TrainGraph(object):
         else:
             neg_batch = [ [] for x in range(num_negative) ]
             for num in range(num_negative):
-                for i in range(batch_size):
-                    example = [train_batch[j][i] for j in range(len(train_batch))]
-                    positive_id = example[0]
-                    
-                    n_neg_examples = len(self.neg_examples[positive_id])
-                    neg_example = [self.neg_examples[positive_id][j][num + 1] for j in range(n_neg_examples)]
+                for positive_id in positive_ids:
+                    neg_examples = self.neg_examples[positive_id]
+                    neg_example = [neg_examples[j][num + 1] for j in range(len(neg_examples))]
                     
                     neg_batch[num].append(neg_example)
                 
@@ -236,13 +254,55 @@ class TrainGraph(object):
 
         return neg_batch
 
+    def corrupted_example(self, relation_id, head, tail):
+        #example of entity ids head and tail in the layout of the precomputed negatives
+        paths = []
+        path_len = []
+        for path in self.relation_paths(head, tail, 4):
+            path = self.graph.relation_names(path)
+            n_pad = max(args.max_path_len - len(path), 0)
+            paths.append(self.vocab.convert_tokens_to_ids(['[CLS]'] + path + ['[PAD]'] * n_pad))
+            path_len.append(len(path))
+        return [relation_id, self.r_context.ids(self.graph.id2ent[head]),
+                self.r_context.ids(self.graph.id2ent[tail]),
+                paths, len(paths), path_len]
+
+    def fresh_negatives(self, train_batch, num_negative=1):
+        """
+        Newly drawn negatives for a batch, in the layout of
+        neg_selection_for_training: each negative replaces the head or the
+        tail of its positive at random. Train positive ids are line numbers
+        of raw_train, so the positives are read back from graph.triples.
+        """
+        relation_ids = list(train_batch[1])
+        triples = self.graph.triples[np.asarray(train_batch[0], dtype=np.int64) - 1].astype(np.int64)
+        heads, tails = triples[:, 0], triples[:, 2]
+        labels = 2 * triples[:, 1]
+        neg_batch = []
+        for num in range(num_negative):
+            neg_heads, neg_tails = heads.copy(), tails.copy()
+            is_head = np.random.uniform(size=len(heads)) < 0.5
+            rows = np.flatnonzero(is_head)
+            neg_heads[rows] = self.sampler.draw(heads[rows], labels[rows], tails[rows], 'head')
+            rows = np.flatnonzero(~is_head)
+            neg_tails[rows] = self.sampler.draw(heads[rows], labels[rows], tails[rows], 'tail')
+            examples = [self.corrupted_example(relation_ids[i], int(neg_heads[i]), int(neg_tails[i]))
+                for i in range(len(heads))]
+            neg_batch.append(convert_neg_sample(examples, len(examples)))
+        return neg_batch[0] if num_negative == 1 else neg_batch
+
     def neg_sampling_for_training(self, train_batch):
         # create two negative samples for each positive sample, each replacing head or tail
         train_batch = train_batch[1:]
         batch_size = len(train_batch[0])
         
-        node_list = list(self.biG.nodes) # the range for sampling negative samples
-        n = len(node_list)
+        node_list = self.graph.id2ent # the range for sampling negative samples
+        #one negative head and one negative tail per example, drawn for the whole batch
+        heads = [self.graph.ent2id[head] for head in train_batch[1]]
+        tails = [self.graph.ent2id[tail] for tail in train_batch[2]]
+        labels = [self.graph.label2id.get(relation, -1) for relation in train_batch[0]]
+        neg_heads = self.sampler.draw(heads, labels, tails, 'head').tolist()
+        neg_tails = self.sampler.draw(heads, labels, tails, 'tail').tolist()
         examples = []
         neg_head_examples = []
         neg_tail_examples = []
@@ -255,101 +315,61 @@ class TrainGraph(object):
             relation_id = self.vocab.convert_tokens_to_ids([relation])[0]
             
             #creat negative head examples
-            while 1:
-                neg_head = node_list[np.random.choice(n)]
-                flag = 1
-                if neg_head != tail:
-                    #filter positive candidates
-                    if self.biG.has_edge(neg_head, tail):
-                        for i in self.biG[neg_head][tail]:
-                            if self.biG[neg_head][tail][i]['r_type'] == relation:
-                                flag = 0
-                                break #neg_head is actually a positive sample
-                    if flag == 1:
-                        flag = 2# find a real negative sample
-                        break
+            neg_head = node_list[neg_heads[i]]
             
-            neg_head_paths = nx.all_simple_edge_paths(self.biG, neg_head, tail, 4)
+            neg_head_paths = self.relation_paths(
+                self.graph.ent2id[neg_head], self.graph.ent2id[tail], 4)
             neg_head_relation_paths = []
             for path in neg_head_paths:
-                relation_path = [self.biG[edge[0]][edge[1]][edge[2]]
-                    ['r_type'] for edge in path]
+                relation_path = self.graph.relation_names(path)
                 neg_head_relation_paths.append(relation_path)
-
-            neg_head_relation_paths = filter_repeat_path(neg_head_relation_paths)
             tmp = []
-            neg_head_pathmask = []
+            neg_head_pathlen = []
             for path in neg_head_relation_paths:
-                tmp_mask = [1 for i in range(len(path))]
+                neg_head_pathlen.append(len(path))
                 while len(path) < args.max_path_len:
                     path.append('[PAD]')
-                    tmp_mask.append(0)
                 path.insert(0, '[CLS]')
-                tmp_mask.insert(0, 1)
-                neg_head_pathmask.append(tmp_mask)
                 tmp.append(self.vocab.convert_tokens_to_ids(path))
             neg_head_relation_paths = tmp
             
             neg_head_example = [relation_id, 
-                    self.vocab.convert_tokens_to_ids(self.r_context[neg_head]), 
-                    self.vocab.convert_tokens_to_ids(self.r_context[tail]), 
+                    self.r_context.ids(neg_head), 
+                    self.r_context.ids(tail), 
                     neg_head_relation_paths,
                     len(neg_head_relation_paths), 
-                    neg_head_pathmask]
-            neg_head_overall_mask = [1] * (neg_head_example[4] + 4) \
-                + [0] * (args.max_num_path - neg_head_example[4]) # 4 for mask\r\h\t
-            neg_head_example.append(neg_head_overall_mask)
+                    neg_head_pathlen]
 
             #creat negative tail examples
-            while 1:
-                neg_tail = node_list[np.random.choice(n)]
-                flag = 1
-                if neg_tail != head:
-                    #filter positive candidates
-                    if self.biG.has_edge(head, neg_tail):
-                        for i in self.biG[head][neg_tail]:
-                            if self.biG[head][neg_tail][i]['r_type'] == relation:
-                                flag = 0
-                                break #neg_head is actually a positive sample
-                    if flag == 1:
-                        flag = 2# find a real negative sample
-                        break
-
-            neg_tail_paths = nx.all_simple_edge_paths(self.biG, head, neg_tail, 4)
+            neg_tail = node_list[neg_tails[i]]
+
+            neg_tail_paths = self.relation_paths(
+                self.graph.ent2id[head], self.graph.ent2id[neg_tail], 4)
             neg_tail_relation_paths = []
             for path in neg_tail_paths:
-                relation_path = [self.biG[edge[0]][edge[1]][edge[2]]
-                    ['r_type'] for edge in path]
+                relation_path = self.graph.relation_names(path)
                 neg_tail_relation_paths.append(relation_path)
-
-            neg_tail_relation_paths = filter_repeat_path(neg_tail_relation_paths)
             tmp = []
-            neg_tail_pathmask = []
+            neg_tail_pathlen = []
             for path in neg_tail_relation_paths:
-                tmp_mask = [1 for i in range(len(path))]
+                neg_tail_pathlen.append(len(path))
                 while len(path) < args.max_path_len:
                     path.append('[PAD]')
-                    tmp_mask.append(0)
                 path.insert(0, '[CLS]')
-                tmp_mask.insert(0, 1)
-                neg_tail_pathmask.append(tmp_mask)
                 tmp.append(self.vocab.convert_tokens_to_ids(path))
             neg_tail_relation_paths = tmp
             
             neg_tail_example = [relation_id, 
-                    self.vocab.convert_tokens_to_ids(self.r_context[head]), 
-                    self.vocab.convert_tokens_to_ids(self.r_context[neg_tail]), 
+                    self.r_context.ids(head), 
+                    self.r_context.ids(neg_tail), 
                     neg_tail_relation_paths,
                     len(neg_tail_relation_paths), 
-                    neg_tail_pathmask]
-            neg_tail_overall_mask = [1] * (neg_tail_example[4] + 4) \
-                + [0] * (args.max_num_path - neg_tail_example[4])
-            neg_tail_example.append(neg_tail_overall_mask)
+                    neg_tail_pathlen]
 
             example_convert = [relation_id,
-                    self.vocab.convert_tokens_to_ids(self.r_context[head]), 
-                    self.vocab.convert_tokens_to_ids(self.r_context[tail]),
-                    path_id, len(path_id), example[5], example[6]]
+                    self.r_context.ids(head), 
+                    self.r_context.ids(tail),
+                    path_id, len(path_id), example[5]]
             examples.append(example_convert)
             neg_head_examples.append(neg_head_example)
             neg_tail_examples.append(neg_tail_example)
@@ -378,16 +398,59 @@ def main(args):
 
     vocabulary_relation = Vocabulary(vocab_file=args.vocab_path)
     is_sparse = True if args.task=='nell_v1' else False
+    if args.data_format == 'binary':
+        dataset_class = BinaryDataset
+        args.train_file = os.path.splitext(args.train_file)[0] + '_bin'
+        args.test_file = os.path.splitext(args.test_file)[0] + '_bin'
+        #negatives from the mapped stores of negative_sampling_random.py --output_format binary
+        args.train_neg_examples = store_dir(args.train_neg_examples)
+        args.neg_save_path_valid = store_dir(args.neg_save_path_valid)
+        args.neg_save_path_test = store_dir(args.neg_save_path_test)
+    else:
+        dataset_class = MyDataset
 
     if args.do_train:
-        train_data = MyDataset(args.train_file, vocabulary_relation, args.r_context_all,
-                args.max_path_len, args.sample_path, is_sparse=is_sparse, filter_path=args.filter_empty_path)
-        train_loader = DataLoader(dataset=train_data, batch_size=args.batch_size, 
-                            shuffle=True, collate_fn=collate_fn)
-
+        if args.lazy_dataset:
+            #examples are decoded in __getitem__, the loader workers share the mapped index
+            lazy_class = LazyBinaryDataset if args.data_format == 'binary' else LazyDataset
+            train_data = lazy_class(args.train_file, vocabulary_relation, args.r_context_all,
+                    args.max_path_len, filter_path=args.filter_empty_path)
+        else:
+            train_data = dataset_class(args.train_file, vocabulary_relation, args.r_context_all,
+                    args.max_path_len, args.sample_path, is_sparse=is_sparse, filter_path=args.filter_empty_path)
+            #examples are tensorised once, batches come out as padded tensors
+            train_data = TensorDataset(train_data)
         train_KG = TrainGraph(args.raw_train, vocabulary_relation, 
-                args.r_context_all, neg_examples_path=args.train_neg_examples)
+                args.r_context_all, neg_examples_path=args.train_neg_examples,
+                index_dir=args.path_index)
         train_KG.build_graph()
+
+        #paths past --sample_path are dropped by the model and are not padded
+        num_path = train_data.num_path() if args.sample_path < 0 else np.minimum(train_data.num_path(), args.sample_path)
+        n_lead = 3 if args.encode_ent_pair is True else 4
+        path_width = train_data.path_width
+        #workers pair every batch with its precomputed negatives, the loop only sees tensors
+        loader_args = dict(collate_fn=NegativeCollate(train_KG.neg_examples, args.num_negative),
+                num_workers=args.loader_workers)
+        if args.loader_workers > 0:
+            loader_args.update(persistent_workers=True, prefetch_factor=args.prefetch_factor)
+        if args.max_batch_tokens > 0:
+            batch_sampler = BucketBatchSampler(num_path, train_data.context_len(), args.max_batch_tokens,
+                    args.batch_size, n_lead=n_lead, path_width=path_width)
+            train_loader = DataLoader(dataset=train_data, batch_sampler=batch_sampler, **loader_args)
+            first_batches = batch_sampler.batches
+        else:
+            train_loader = DataLoader(dataset=train_data, batch_size=args.batch_size, 
+                                shuffle=True, **loader_args)
+            first_batches = shuffled_batches(len(train_data), args.batch_size)
+        logger.info("Train batches: %d, padding waste: %.3f" % (len(train_loader),
+                padding_waste(first_batches, num_path, train_data.context_len(), n_lead, path_width)))
+
+        #forked before the model touches the device
+        neg_queue = None
+        if args.negative_workers > 0:
+            neg_queue = NegativeQueue(functools.partial(train_KG.fresh_negatives, num_negative=args.num_negative),
+                args.negative_workers, args.negative_queue_depth)
         args.vocab_relation_size = len(vocabulary_relation.vocab)
         
         num_train_instances = train_data.length
@@ -400,11 +463,11 @@ def main(args):
         model = CARST(config=config, device=device)
 
     if args.do_predict:
-        predict_data = MyDataset(args.train_file, vocabulary_relation, 
+        predict_data = dataset_class(args.train_file, vocabulary_relation, 
                 args.r_context_all, args.max_path_len, args.max_num_path)
 
     if args.do_test:
-        test_data = MyDataset(args.test_file, vocabulary_relation, args.r_context_test, 
+        test_data = dataset_class(args.test_file, vocabulary_relation, args.r_context_test, 
                 args.max_path_len, args.sample_path, is_sparse=is_sparse, filter_path=args.filter_empty_path)
 
     if args.do_train:
@@ -426,9 +489,19 @@ def main(args):
             time_begin = time.time()
             train_loss_per_epoch = 0
             n_not_growing_epoch = n_not_growing_epoch + 1
-            for batch in tqdm(train_loader):
+            if neg_queue is None:
+                batches = train_loader
+            else:
+                #workers only need the positive ids and relations of a batch,
+                #the precomputed negatives stay while the fresh ones are not ready
+                batches = ((batch, neg_batch if fresh is None else fresh) for (batch, neg_batch), fresh in
+                    neg_queue.iterate(train_loader, task=lambda pair: (pair[0].pos_id.tolist(), pair[0].relation.tolist())))
+            #time the loop spends waiting for its next batch
+            input_wait = []
+            time_ready = time.time()
+            for batch, neg_batch in tqdm(batches, total=len(train_loader)):
+                input_wait.append(time.time() - time_ready)
                 step = step + 1
-                neg_batch= train_KG.neg_selection_for_training(batch, num_negative=args.num_negative)     
                 
                 pos_score = model(batch, device)
                 neg_score = model(neg_batch, device)
@@ -438,6 +511,7 @@ def main(args):
                 opt.zero_grad()
                 loss.backward()
                 opt.step()
+                time_ready = time.time()
             
             print("第%d个epoch的学习率：%f" % (epoch, opt.param_groups[0]['lr']))
             optim_schedule.step()
@@ -445,8 +519,14 @@ def main(args):
             
             train_loss_per_epoch = train_loss_per_epoch / num_train_instances
             used_time = time_end - time_begin
-            logger.info("epoch: %d, train_loss:%f, time cost:%f (s)" %
-                        (epoch, train_loss_per_epoch, used_time))
+            logger.info("epoch: %d, train_loss:%f, time cost:%f (s), %.1f examples/s" %
+                        (epoch, train_loss_per_epoch, used_time, num_train_instances / used_time))
+            logger.info("epoch: %d, input wait per step: mean %.2f ms, max %.2f ms, %.1f%% of the epoch" %
+                        (epoch, 1000 * np.mean(input_wait), 1000 * np.max(input_wait), 100 * np.sum(input_wait) / used_time))
+            if neg_queue is not None:
+                logger.info("epoch: %d, fresh negative batches: %d, precomputed: %d" %
+                        (epoch, neg_queue.fresh, neg_queue.fallback))
+                neg_queue.fresh, neg_queue.fallback = 0, 0
             if epoch == args.epoch or epoch % 20 == 0: #or epoch<=20 and epoch%2==0:
                 save_path = os.path.join(args.checkpoints, args.task, "epoch_" + str(epoch))
                 torch.save(model, save_path)
@@ -498,6 +578,11 @@ def main(args):
                 break
 
         print(f'Best test auc-pr is: {best_test_ap}! Best test hits@10 is: {best_test_hits10}!')            
+        if neg_queue is not None:
+            neg_queue.close()
+        if args.path_index:
+            #fold the segments of the negative workers into one
+            PathIndex(args.path_index, file_hash(args.raw_train)).compact()
 
     if args.do_predict:
         print('Predict on Valid Set')
@@ -559,12 +644,15 @@ if __name__ == '__main__':
     args.valid_file = os.path.join('data_preprocessed', args.task, 'valid.json')
     args.test_file = os.path.join('data_preprocessed', args.task+'_ind', 'test.json')
     args.train_neg_examples = os.path.join('neg_samples', args.task, 'neg_sample_train.npy')
-    args.RSG_dir = os.path.join('data_preprocessed', args.task, 'RSG2.txt')
+    args.RSG_dir = os.path.join('data_preprocessed', args.task, 'RSG2.npz')
+    if not os.path.exists(args.RSG_dir):
+        #RSG2.txt of builds without a binary RSG
+        args.RSG_dir = os.path.join('data_preprocessed', args.task, 'RSG2.txt')
 
-    args.r_context_all = os.path.join('data_preprocessed', args.task, 'ent_r_nbr.json')
+    args.r_context_all = os.path.join('data_preprocessed', args.task, 'ent_r_nbr.npz')
     args.r_context_train = os.path.join('data_preprocessed', args.task, 'test_r_nbr.json')
     args.r_context_valid = os.path.join('data_preprocessed', args.task, 'valid_r_nbr.json')
-    args.r_context_test = os.path.join('data_preprocessed', args.task+'_ind', 'ent_r_nbr.json')
+    args.r_context_test = os.path.join('data_preprocessed', args.task+'_ind', 'ent_r_nbr.npz')
 
     args.neg_save_path_train = os.path.join('neg_samples', args.task, 'neg_sample_train.npy')
     args.neg_save_path_valid = os.path.join('neg_samples', args.task, 'neg_sample_valid.npy')
@@ -0,0 +1,99 @@
+#training batches of examples with similar path counts and context lengths, under a token budget
+import numpy as np
+from torch.utils.data import Sampler
+
+#batches of this many times the batch size are shuffled together before bucketing
+POOL_BATCHES = 50
+
+
+def padded_tokens(num_path, context_len, n_lead=4, path_width=5):
+    """
+    Tokens the model runs for one batch: the overall transformer sequence
+    (n_lead leading slots and the paths) and the head and tail context
+    sequences ([CLS] first) are padded to the longest of the batch, every
+    path is path_width tokens. Arrays hold the values of the batch.
+    """
+    num_path = np.asarray(num_path, dtype=np.int64)
+    context_len = np.asarray(context_len, dtype=np.int64)
+    if len(num_path) == 0:
+        return 0
+    width = n_lead + num_path.max() + 2 * (1 + context_len.max())
+    return int(len(num_path) * width + num_path.sum() * path_width)
+
+
+def padding_waste(batches, num_path, context_len, n_lead=4, path_width=5):
+    #share of the padded tokens of batches that are padding
+    num_path = np.asarray(num_path, dtype=np.int64)
+    context_len = np.asarray(context_len, dtype=np.int64)
+    real = padded = 0
+    for batch in batches:
+        batch = np.asarray(batch, dtype=np.int64)
+        padded += padded_tokens(num_path[batch], context_len[batch], n_lead, path_width)
+        real += int((n_lead + num_path[batch] + 2 * (1 + context_len[batch])).sum()
+            + num_path[batch].sum() * path_width)
+    return 1 - real / padded if padded > 0 else 0.0
+
+
+def shuffled_batches(n, batch_size):
+    #the batches of DataLoader(shuffle=True) for an epoch
+    order = np.random.permutation(n)
+    return [order[start:start + batch_size] for start in range(0, n, batch_size)]
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler for a DataLoader. Each epoch the examples are shuffled and
+    cut into pools of POOL_BATCHES * batch_size; a pool is sorted by
+    (num_path, context_len) and cut greedily into batches whose
+    padded_tokens stay within max_tokens and that hold at most batch_size
+    examples. The batches of all pools are then shuffled, so the order of
+    the examples stays random while a batch only mixes similar lengths.
+    num_path should already be capped at the paths the model samples.
+    """
+
+    def __init__(self, num_path, context_len, max_tokens, batch_size,
+            n_lead=4, path_width=5, shuffle=True):
+        self.num_path = np.asarray(num_path, dtype=np.int64)
+        self.context_len = np.asarray(context_len, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.batch_size = batch_size
+        self.n_lead = n_lead
+        self.path_width = path_width
+        self.shuffle = shuffle
+        self.batches = self.make_batches()
+
+    def make_batches(self):
+        order = np.random.permutation(len(self.num_path)) if self.shuffle else np.arange(len(self.num_path))
+        pool_size = POOL_BATCHES * self.batch_size
+        batches = []
+        for start in range(0, len(order), pool_size):
+            pool = order[start:start + pool_size]
+            pool = pool[np.lexsort((self.context_len[pool], self.num_path[pool]))]
+            batch, max_path, max_context, sum_path = [], 0, 0, 0
+            for i in pool.tolist():
+                n, c = int(self.num_path[i]), int(self.context_len[i])
+                width = self.n_lead + max(max_path, n) + 2 * (1 + max(max_context, c))
+                tokens = (len(batch) + 1) * width + (sum_path + n) * self.path_width
+                #an example over the budget on its own still gets a batch
+                if len(batch) > 0 and (tokens > self.max_tokens or len(batch) == self.batch_size):
+                    batches.append(batch)
+                    batch, max_path, max_context, sum_path = [], 0, 0, 0
+                batch.append(i)
+                max_path, max_context, sum_path = max(max_path, n), max(max_context, c), sum_path + n
+            if len(batch) > 0:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[k] for k in np.random.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        #the batches of an epoch are fixed when it starts, len() counts them
+        batches, self.batches = self.batches, None
+        if batches is None:
+            batches = self.make_batches()
+        return iter(batches)
+
+    def __len__(self):
+        if self.batches is None:
+            self.batches = self.make_batches()
+        return len(self.batches)
@@ -1,65 +1,89 @@
-import networkx as nx
 import re
 import numpy as np
 import os
+import glob
 import argparse
 from tqdm import tqdm
 from itertools import combinations
 import multiprocessing as mp
+import functools
+import time
+import tempfile
 
 import sys
 sys.path.append('.')
 from utils.vocab_reader import Vocabulary
+from utils.kg_graph import KnowledgeGraph
+from utils.manifest import Manifest, file_hash
 
+#cells (overlap counts plus inverted-index entries) handled per chunk of entity pairs
+OVERLAP_CHUNK_CELLS = 1 << 24
+#entities in more than this fraction of the pair neighbourhoods are counted densely
+DENSE_MIN_FRACTION = 0.01
+#MinHash signatures of the approximate RSG: LSH bands of MINHASH_ROWS hashes each
+MINHASH_BANDS = 100
+MINHASH_ROWS = 2
+MINHASH_PRIME = (1 << 31) - 1
+#incremental updates touching more than this fraction of the overlap cost rebuild instead
+UPDATE_MAX_FRACTION = 0.1
 
 
+def gather_rows(indptr, indices, rows):
+    #(position in rows, value) of every csr entry of the given rows
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    owner = np.repeat(np.arange(len(rows)), lengths)
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return owner, indices[np.repeat(starts, lengths) + within]
+
+
+def sorted_unique(keys):
+    #np.unique of a large int array, sorting is much faster than its hash table here
+    keys = np.sort(keys)
+    return keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) > 0 else keys
+
 
 class RSG(object):
     
-    def __init__(self, raw_train, rel_voc, data_dir):
+    def __init__(self, raw_train, rel_voc, data_dir, num_triples=None):
         self.raw_train = raw_train
         self.rel_voc = rel_voc
         self.data_dir = data_dir
-        self.biG, self.triples = self.build_graph()
+        #only the first num_triples triples of raw_train, see update_RSG
+        self.num_triples_read = num_triples
+        self.graph, self.triples = self.build_graph()
+        self.neighbor_cache = {}
 
     def build_graph(self):
         '''
         创建一个有向图，每个三元组 (head, relation, tail) 都会添加两条边，
         分别使用关系 relation 和 'inv_' + relation 作为边的类型。
         '''
-        biG = nx.MultiDiGraph()
-        total_links = 0
+        graph = KnowledgeGraph.from_file(self.raw_train, self.num_triples_read)
         triple= []
-        with open(self.raw_train, 'r') as f_train:
-            for line in f_train.readlines():
-                total_links = total_links + 1
-                tokens = re.split(r'\t|\s', line.strip())
-                head = tokens[0]
-                relation = tokens[1]
-                tail = tokens[2]
-                biG.add_edge(head, tail, **{'r_type': relation})
-                biG.add_edge(tail, head, **{'r_type': 'inv_' + relation})
-                triple.append((head, relation , tail))
-                triple.append((tail, 'inv_' + relation , head))
-        f_train.close()
-        print("number of links in train is:{links}".format(links=total_links))
-        return biG,triple
+        for h, r, t in graph.triples.tolist():
+            head, relation, tail = graph.id2ent[h], graph.id2rel[r], graph.id2ent[t]
+            triple.append((head, relation , tail))
+            triple.append((tail, 'inv_' + relation , head))
+        print("number of links in train is:{links}".format(links=graph.num_triples))
+        return graph,triple
     
+    # 缓存实体邻域（图中每条边都有反向边，入度邻域与出度邻域相同）
+    def get_neighbors(self, ent):
+        if ent not in self.neighbor_cache:
+            nbrs = self.graph.successors(self.graph.ent2id[ent]).tolist()
+            self.neighbor_cache[ent] = set([self.graph.id2ent[n] for n in nbrs])
+        return self.neighbor_cache[ent]
+
     # 获取入度邻域
     def get_in_neighbors(self, head, tail):
-        # 头实体入度邻域
-        neighbors1 = self.biG.predecessors(head)
-        # 尾实体入度邻域
-        neighbors2 = self.biG.predecessors(tail)
-        return set(list(neighbors1)+list(neighbors2))
+        # 头实体入度邻域 | 尾实体入度邻域
+        return self.get_neighbors(head) | self.get_neighbors(tail)
     
     # 获取出度邻域
     def get_out_neighbors(self, head, tail):
-        # 头实体出度邻域
-        neighbors1 = self.biG.successors(head)
-        # 尾实体出度邻域
-        neighbors2 = self.biG.successors(tail)
-        return set(list(neighbors1)+list(neighbors2))
+        # 头实体出度邻域 | 尾实体出度邻域
+        return self.get_neighbors(head) | self.get_neighbors(tail)
 
     def get_structure_similarity(self, triple):
         triple1 = triple[0]
@@ -86,45 +110,6 @@ class RSG(object):
         
         return structure_similarity
 
-    def get_RSG(self):
-        rel_triple=[]
-        rel_set ={}        
-        for i in tqdm(range(len(self.triples))):
-            h1, r1, t1 = self.triples[i]
-            for j in range(len(self.triples)):
-                h2, r2, t2 = self.triples[j]
-                if (h1, t1, r1) != (h2, t2, r2):
-                    w = self.get_structure_similarity(self.biG,[h1, t1, r1],[h2, t2, r2])
-                    w = int(w*10)
-                    if w!=0 and (r1 != 'inv_'+r2 and r2 != 'inv_'+r1) and r1!=r2:
-                        if (r1,r2) in rel_set:
-                            rel_set[(r1,r2)]+=w
-                        else:
-                            rel_set[(r1,r2)]=w
-        
-        for key, value in rel_set.items():
-            rel_triple.append([key[0],value,key[1]])
-        # 关系词汇路径
-        rel_vocabulary= Vocabulary(vocab_file=self.rel_voc)
-        # 创建实体和关系的字典
-        rel_head_list=[]
-        rel_tail_list=[]
-        w_list=[]
-        # 生成实体和关系的ID表示
-        for triple in rel_triple:
-            head, relation, tail = triple
-            rel_head_list.append(head)
-            w_list.append(relation)
-            rel_tail_list.append(tail)
-        head_list = rel_vocabulary.convert_tokens_to_ids(rel_head_list)
-        tail_list = rel_vocabulary.convert_tokens_to_ids(rel_tail_list)
-        # 生成关系结构图三元组
-        rel_triple2id = []
-        for i in range(len(head_list)):
-            rel_triple2id.append([head_list[i],w_list[i],tail_list[i]])
-        rel_triple2id = np.array(rel_triple2id)
-        return rel_triple2id
-
     def get_RSG2(self):
         rel_triple=[]
         rel_set ={}    
@@ -164,11 +149,530 @@ class RSG(object):
 
 
     
-    def write_RSG(self):
-        rel_triple2id = self.get_RSG2()
-        with open(self.data_dir, "w") as file:
-            for rel_triple in rel_triple2id:
-                file.write('\t'.join(map(str, rel_triple)) + '\n')
+    def get_pair_neighborhoods(self, pair_heads, pair_tails):
+        '''
+        实体对 (h, t) 的邻域 N(h) | N(t) | {h, t}，与 get_structure_similarity 相同，
+        以 CSR 形式返回 (indptr, 实体 id)
+        '''
+        graph = self.graph
+        num_pairs = len(pair_heads)
+        owner_h, nbr_h = gather_rows(graph.indptr, graph.indices, pair_heads)
+        owner_t, nbr_t = gather_rows(graph.indptr, graph.indices, pair_tails)
+        owner = np.concatenate([owner_h, owner_t, np.arange(num_pairs), np.arange(num_pairs)])
+        ents = np.concatenate([nbr_h, nbr_t, pair_heads, pair_tails]).astype(np.int64)
+        keys = sorted_unique(owner * graph.num_nodes + ents)
+        indptr = np.zeros(num_pairs + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // graph.num_nodes, minlength=num_pairs), out=indptr[1:])
+        return indptr, keys % graph.num_nodes
+
+    def build_pair_groups(self):
+        '''
+        self.triples 按无序实体对分组，以及比较三元组对时用到的关系过滤条件
+        '''
+        graph = self.graph
+        h = graph.triples[:, 0].astype(np.int64)
+        r = graph.triples[:, 1].astype(np.int64)
+        t = graph.triples[:, 2].astype(np.int64)
+        #self.triples 中第 2i 个是 (h, r, t)，第 2i+1 个是 (t, inv_r, h)
+        heads = np.stack([h, t], axis=1).ravel()
+        tails = np.stack([t, h], axis=1).ravel()
+        self.num_triples = len(heads)
+
+        #relation names (not labels) decide which pairs count, as in get_RSG2
+        names, label_names = np.unique(np.asarray(graph.id2label, dtype=str), return_inverse=True)
+        self.names = names.tolist()
+        self.num_names = len(self.names)
+        self.rels = label_names[np.stack([2 * r, 2 * r + 1], axis=1).ravel()]
+        name2id = {name: i for i, name in enumerate(self.names)}
+        self.excluded = np.eye(self.num_names, dtype=bool)
+        for i, name in enumerate(self.names):
+            if 'inv_' + name in name2id:
+                self.excluded[i, name2id['inv_' + name]] = True
+                self.excluded[name2id['inv_' + name], i] = True
+        #identical triples are never compared
+        _, self.triple_keys = np.unique((heads * graph.num_nodes + tails) * self.num_names + self.rels,
+            return_inverse=True)
+
+        #triples grouped by unordered entity pair, in index order within a group
+        pair_keys, group = np.unique(np.minimum(heads, tails) * graph.num_nodes + np.maximum(heads, tails),
+            return_inverse=True)
+        num_groups = self.num_groups = len(pair_keys)
+        self.members = np.argsort(group, kind='stable')
+        self.group_size = np.bincount(group, minlength=num_groups)
+        self.group_start = np.cumsum(self.group_size) - self.group_size
+        self.pair_heads = pair_keys // graph.num_nodes
+        self.pair_tails = pair_keys % graph.num_nodes
+
+    def build_overlap_index(self):
+        '''
+        get_RSG_indexed 需要的数组：实体对的邻域，
+        倒排索引 (实体 -> 邻域包含它的实体对) 和 hub 实体的稠密矩阵。
+        '''
+        graph = self.graph
+        self.build_pair_groups()
+        num_groups = self.num_groups
+        nbr_indptr, nbr_ents = self.get_pair_neighborhoods(self.pair_heads, self.pair_tails)
+        self.nbr_indptr, self.nbr_ents = nbr_indptr, nbr_ents
+        self.nbr_size = np.diff(nbr_indptr)
+        #entities in many neighbourhoods are counted with a dense matrix product,
+        #the others through the inverted index
+        owners = np.repeat(np.arange(num_groups), self.nbr_size)
+        freq = np.bincount(nbr_ents, minlength=graph.num_nodes)
+        hubs = np.flatnonzero(freq > DENSE_MIN_FRACTION * num_groups)
+        hub_col = np.full(graph.num_nodes, -1, dtype=np.int64)
+        hub_col[hubs] = np.arange(len(hubs))
+        is_hub = hub_col[nbr_ents] >= 0
+        self.hub_matrix = np.zeros((num_groups, len(hubs)), dtype=np.float32)
+        self.hub_matrix[owners[is_hub], hub_col[nbr_ents[is_hub]]] = 1
+
+        #倒排索引: 实体 -> 邻域包含它的实体对
+        rare = np.flatnonzero(~is_hub)
+        self.inv_groups = owners[rare[np.argsort(nbr_ents[rare], kind='stable')]]
+        self.inv_indptr = np.zeros(graph.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(nbr_ents[rare], minlength=graph.num_nodes), out=self.inv_indptr[1:])
+
+        #cells (overlap counts plus inverted-index entries) each entity pair costs
+        self.cost = np.add.reduceat(np.diff(self.inv_indptr)[nbr_ents], nbr_indptr[:-1]) + num_groups
+
+    def add_pair_weights(self, A, B, w, weight_sum, first_pair):
+        '''
+        把实体对 A[k] 和 B[k] 之间的权重 w[k] 加到它们的三元组对 (i < j) 的 (r1, r2) 上，
+        first_pair 记录每个 (r1, r2) 第一次出现的三元组对
+        '''
+        #expand entity-pair pairs to the triple pairs (i < j) of combinations()
+        n_a, n_b = self.group_size[A], self.group_size[B]
+        count = n_a * n_b
+        rep = np.repeat(np.arange(len(A)), count)
+        within = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        i = self.members[self.group_start[A][rep] + within // n_b[rep]]
+        j = self.members[self.group_start[B][rep] + within % n_b[rep]]
+        keep = (A[rep] != B[rep]) | (i < j)
+        first, second = np.minimum(i, j)[keep], np.maximum(i, j)[keep]
+        w = w[rep][keep]
+        keep = (self.triple_keys[first] != self.triple_keys[second]) \
+            & ~self.excluded[self.rels[first], self.rels[second]]
+        first, second, w = first[keep], second[keep], w[keep]
+
+        key = self.rels[first] * self.num_names + self.rels[second]
+        weight_sum += np.bincount(key, weights=w, minlength=self.num_names * self.num_names).astype(np.int64)
+        #rel_set 中 (r1, r2) 的顺序 = 第一次出现的三元组对的顺序
+        pair = first * self.num_triples + second
+        order = np.lexsort((pair, key))
+        key, pair = key[order], pair[order]
+        starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]]) if len(key) > 0 else np.zeros(0, dtype=np.int64)
+        first_pair[key[starts]] = np.minimum(first_pair[key[starts]], pair[starts])
+
+    def shard_bounds(self, num_shards):
+        #contiguous ranges of entity pairs with about the same cost
+        cum = np.cumsum(self.cost)
+        bounds = np.searchsorted(cum, cum[-1] * np.arange(1, num_shards) / num_shards, side='right')
+        return np.concatenate([[0], bounds, [self.num_groups]])
+
+    def accumulate(self, g0, g1):
+        '''
+        (r1, r2) 权重的部分和：只统计第一个实体对在 [g0, g1) 内的三元组对。
+        返回 (key, weight, first)，key = r1 * num_names + r2，first 是该 key
+        第一次出现的三元组对 i * num_triples + j。
+        '''
+        return self.accumulate_rows(np.arange(g0, g1))
+
+    def accumulate_rows(self, rows, touched=None):
+        '''
+        同 accumulate，但只统计 rows 中的实体对 a 和实体对 b 之间的三元组对：
+        b >= a，或者 b 不在 touched 中 (touched 为 None 时即所有实体对)。
+        rows = touched 的全部实体对时，每对至少有一个 touched 的实体对正好统计一次。
+        '''
+        num_groups, num_names, num_triples = self.num_groups, self.num_names, self.num_triples
+        weight_sum = np.zeros(num_names * num_names, dtype=np.int64)
+        first_pair = np.full(num_names * num_names, num_triples * num_triples, dtype=np.int64)
+        #chunks of entity pairs whose overlap counts fit in OVERLAP_CHUNK_CELLS
+        cum = np.cumsum(self.cost[rows])
+        bounds = np.searchsorted(cum, np.arange(0, cum[-1] if len(cum) > 0 else 0, OVERLAP_CHUNK_CELLS), side='right')
+        bounds = np.unique(np.concatenate([[0], np.maximum(bounds, 1), [len(rows)]]))
+        for c0, c1 in zip(bounds[:-1], bounds[1:]):
+            chunk = rows[c0:c1]
+            owner, ents = gather_rows(self.nbr_indptr, self.nbr_ents, chunk)
+            via, others = gather_rows(self.inv_indptr, self.inv_groups, ents)
+            overlap = np.bincount(owner[via] * num_groups + others,
+                minlength=len(chunk) * num_groups).reshape(len(chunk), num_groups)
+            #float32 counts are exact below 2 ** 24
+            overlap += (self.hub_matrix[chunk] @ self.hub_matrix.T).astype(np.int64)
+            #combinations() compares each pair once, keep b >= a
+            earlier = np.arange(num_groups)[None, :] < chunk[:, None]
+            if touched is not None:
+                #pairs with an untouched b are only reached from a
+                earlier &= touched[None, :]
+            overlap[earlier] = 0
+            cells = np.flatnonzero(overlap)
+            inter = overlap.ravel()[cells]
+            A, B = chunk[cells // num_groups], cells % num_groups
+            #get_structure_similarity: int(J * 10) of the Jaccard index J of the two neighbourhoods
+            w = (inter / (self.nbr_size[A] + self.nbr_size[B] - inter) * 10).astype(np.int64)
+            self.add_pair_weights(A[w > 0], B[w > 0], w[w > 0], weight_sum, first_pair)
+        found = np.flatnonzero(weight_sum > 0)
+        return found, weight_sum[found], first_pair[found]
+
+    def shard_path(self, shard_dir, shard_id, num_shards):
+        return os.path.join(shard_dir, '%d-of-%d.npz' % (shard_id, num_shards))
+
+    def write_shard(self, shard_dir, shard_id, num_shards):
+        bounds = self.shard_bounds(num_shards)
+        key, weight, first = self.accumulate(bounds[shard_id], bounds[shard_id + 1])
+        path = self.shard_path(shard_dir, shard_id, num_shards)
+        #written under a temporary name, so an interrupted shard is recomputed
+        np.savez(path + '.tmp.npz', key=key, weight=weight, first=first,
+            graph=self.graph_hash, bounds=bounds[shard_id:shard_id + 2])
+        os.replace(path + '.tmp.npz', path)
+        return shard_id
+
+    def shard_done(self, shard_dir, shard_id, num_shards):
+        path = self.shard_path(shard_dir, shard_id, num_shards)
+        if not os.path.exists(path):
+            return False
+        #a partial of another graph or another split of this one is stale
+        bounds = self.shard_bounds(num_shards)
+        with np.load(path) as partial:
+            return str(partial['graph']) == self.graph_hash \
+                and partial['bounds'].tolist() == bounds[shard_id:shard_id + 2].tolist()
+
+    def merge_shards(self, shard_dir, num_shards):
+        '''
+        合并各分片的部分和：权重相加，first 取最小，得到与 get_RSG2 相同的 rel_triple2id
+        '''
+        num_names = self.num_names
+        weight_sum = np.zeros(num_names * num_names, dtype=np.int64)
+        first_pair = np.full(num_names * num_names, self.num_triples * self.num_triples, dtype=np.int64)
+        for shard_id in range(num_shards):
+            with np.load(self.shard_path(shard_dir, shard_id, num_shards)) as partial:
+                weight_sum[partial['key']] += partial['weight']
+                first_pair[partial['key']] = np.minimum(first_pair[partial['key']], partial['first'])
+        #kept for save_state
+        self.weight_sum, self.first_pair = weight_sum, first_pair
+        return self.to_rel_triples(weight_sum, first_pair)
+
+    def to_rel_triples(self, weight_sum, first_pair):
+        #rel_triple2id of get_RSG2 from the dense (r1, r2) accumulators
+        num_names = self.num_names
+        found = np.flatnonzero(weight_sum > 0)
+        found = found[np.argsort(first_pair[found])]
+        # 关系词汇路径
+        rel_vocabulary= Vocabulary(vocab_file=self.rel_voc)
+        head_list = rel_vocabulary.convert_tokens_to_ids([self.names[k // num_names] for k in found.tolist()])
+        tail_list = rel_vocabulary.convert_tokens_to_ids([self.names[k % num_names] for k in found.tolist()])
+        # 生成关系结构图三元组
+        rel_triple2id = []
+        for i in range(len(head_list)):
+            rel_triple2id.append([head_list[i], int(weight_sum[found[i]]), tail_list[i]])
+        rel_triple2id = np.array(rel_triple2id)
+        return rel_triple2id
+
+    def entity_minhash(self, seeds):
+        '''
+        每个实体 e 的 min(h(x)) (x ∈ N(e))，以及 h(e)，hash 函数 h(x) = (a x + b) mod p
+        '''
+        graph = self.graph
+        a, b = seeds[:, 0], seeds[:, 1]
+        ent_hash = (np.arange(graph.num_nodes, dtype=np.int64)[:, None] * a + b) % MINHASH_PRIME
+        nbr_hash = np.full((graph.num_nodes, len(seeds)), MINHASH_PRIME, dtype=np.int64)
+        has_nbr = np.flatnonzero(np.diff(graph.indptr) > 0)
+        if len(has_nbr) > 0:
+            nbr_hash[has_nbr] = np.minimum.reduceat(ent_hash[graph.indices], graph.indptr[has_nbr], axis=0)
+        return ent_hash, nbr_hash
+
+    def pair_minhash(self, ent_hash, nbr_hash):
+        #MinHash of N(h) | N(t) | {h, t} for every entity pair, from the per-entity minima
+        h, t = self.pair_heads, self.pair_tails
+        return np.minimum(np.minimum(nbr_hash[h], nbr_hash[t]), np.minimum(ent_hash[h], ent_hash[t]))
+
+    def get_RSG_minhash(self, bands=MINHASH_BANDS, rows=MINHASH_ROWS, seed=0):
+        '''
+        近似 RSG：用 bands * rows 个 MinHash 估计实体对邻域的 Jaccard 相似度。
+        get_structure_similarity 的入度和出度邻域相同 (图中每条边都有反向边)，所以每个实体对
+        只需要一组签名。LSH 分段 (banding) 找出候选实体对，J >= 0.1 的实体对大概率至少有一段签名
+        完全相同；候选对的 J 由签名相同的比例估计，w = int(J * 10)。
+        实体对的签名由两个端点的签名取最小值得到，不需要展开实体对的邻域。
+        '''
+        self.build_pair_groups()
+        num_groups, num_names = self.num_groups, self.num_names
+        rng = np.random.default_rng(seed)
+        seeds = np.stack([rng.integers(1, MINHASH_PRIME, bands * rows),
+            rng.integers(0, MINHASH_PRIME, bands * rows)], axis=1)
+
+        #signatures, and per band the entity pairs sorted by bucket (ties by pair id)
+        signature = np.empty((bands * rows, num_groups), dtype=np.uint32)
+        band_order = np.empty((bands, num_groups), dtype=np.int64)
+        band_later = np.empty((bands, num_groups), dtype=np.int64)
+        for band in tqdm(range(bands), desc='MinHash bands'):
+            cols = slice(band * rows, (band + 1) * rows)
+            signature[cols] = self.pair_minhash(*self.entity_minhash(seeds[cols])).T
+            bucket = np.zeros(num_groups, dtype=np.uint64)
+            for col in range(band * rows, (band + 1) * rows):
+                bucket = bucket * np.uint64(MINHASH_PRIME) + signature[col].astype(np.uint64)
+            order = np.argsort(bucket, kind='stable')
+            starts = np.flatnonzero(np.r_[True, bucket[order][1:] != bucket[order][:-1]])
+            size = np.diff(np.r_[starts, num_groups])
+            band_order[band] = order
+            #members after each position in its bucket, all with larger pair ids
+            band_later[band] = np.repeat(starts + size, size) - np.arange(num_groups) - 1
+
+        position = np.empty((bands, num_groups), dtype=np.int64)
+        for band in range(bands):
+            position[band, band_order[band]] = np.arange(num_groups)
+        later = np.take_along_axis(band_later, position, axis=1)
+        #chunks of entity pairs whose LSH candidates fit in OVERLAP_CHUNK_CELLS
+        cum = np.cumsum(later.sum(axis=0))
+        bounds = np.searchsorted(cum, np.arange(0, cum[-1] if num_groups > 0 else 0, OVERLAP_CHUNK_CELLS), side='right')
+        bounds = np.unique(np.concatenate([[0], np.maximum(bounds, 1), [num_groups]]))
+
+        weight_sum = np.zeros(num_names * num_names, dtype=np.int64)
+        first_pair = np.full(num_names * num_names, self.num_triples * self.num_triples, dtype=np.int64)
+        #triples of the same entity pair have J = 1
+        diagonal = np.arange(num_groups)
+        self.add_pair_weights(diagonal, diagonal, np.full(num_groups, 10, dtype=np.int64), weight_sum, first_pair)
+        for a0, a1 in tqdm(list(zip(bounds[:-1], bounds[1:])), desc='LSH candidates'):
+            #candidate pairs (a, b > a): identical signatures in at least one band
+            candidates = []
+            for band in range(bands):
+                count = later[band, a0:a1]
+                src = np.repeat(position[band, a0:a1], count)
+                offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+                candidates.append(np.repeat(np.arange(a0, a1), count) * num_groups + band_order[band][src + 1 + offset])
+            candidates = sorted_unique(np.concatenate(candidates)) if bands > 0 else np.zeros(0, dtype=np.int64)
+            A, B = candidates // num_groups, candidates % num_groups
+            #estimated Jaccard index: fraction of equal MinHash values
+            matches = np.zeros(len(candidates), dtype=np.int64)
+            for values in signature:
+                matches += values[A] == values[B]
+            w = matches * 10 // max(bands * rows, 1)
+            self.add_pair_weights(A[w > 0], B[w > 0], w[w > 0], weight_sum, first_pair)
+        return self.to_rel_triples(weight_sum, first_pair)
+
+    def get_RSG_indexed(self, shard_dir, num_shards=1, shard_ids=None, workers=None):
+        '''
+        与 get_RSG2 结果相同，但只比较邻域有交集的三元组对。
+        相似度只取决于实体对，所以先在实体对之间用倒排索引 (实体 -> 邻域包含它的实体对)
+        计算交集大小 (出现在很多邻域里的实体用稠密矩阵乘法计数)，
+        再展开到三元组对，按 (r1, r2) 用 NumPy 累加权重。
+        实体对被分成 num_shards 个分片，每个分片的部分和写入 shard_dir，
+        已完成的分片不再计算；shard_ids 只计算这些分片 (其余可在别的机器上计算)。
+        所有分片都完成时合并并返回 rel_triple2id，否则返回 None。
+        '''
+        self.graph_hash = file_hash(self.raw_train)
+        self.build_overlap_index()
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+        if shard_ids is None:
+            shard_ids = range(num_shards)
+        todo = [i for i in shard_ids if not self.shard_done(shard_dir, i, num_shards)]
+        if len(todo) > 0:
+            #forked workers share the index arrays of this RSG
+            with mp.Pool(processes=workers, initializer=attach_rsg, initargs=(self,)) as pool:
+                for _ in tqdm(pool.imap_unordered(functools.partial(write_shard, shard_dir, num_shards=num_shards), todo),
+                        total=len(todo), desc='RSG shards'):
+                    pass
+        if not all(self.shard_done(shard_dir, i, num_shards) for i in range(num_shards)):
+            return None
+        return self.merge_shards(shard_dir, num_shards)
+
+    def binary_path(self):
+        #RSG2.npz next to RSG2.txt
+        return os.path.splitext(self.data_dir)[0] + '.npz'
+
+    def state_path(self):
+        #per-(r1, r2) weights of the last exact build, next to RSG2.txt
+        return os.path.splitext(self.data_dir)[0] + '_state.npz'
+
+    def save_state(self):
+        num_names, num_triples = self.num_names, self.num_triples
+        found = np.flatnonzero(self.weight_sum > 0)
+        names = np.asarray(self.names, dtype=str)
+        np.savez(self.state_path() + '.tmp.npz', r1=names[found // num_names], r2=names[found % num_names],
+            weight=self.weight_sum[found], first_i=self.first_pair[found] // num_triples,
+            first_j=self.first_pair[found] % num_triples, graph=self.graph_hash)
+        os.replace(self.state_path() + '.tmp.npz', self.state_path())
+
+    def load_state(self, graph_hash):
+        '''
+        上次精确构建的 (r1, r2) 权重，映射到本图的关系名 id 和三元组对编号；
+        不是 graph_hash 对应的图时返回 None
+        '''
+        if not os.path.exists(self.state_path()):
+            return None
+        name2id = {name: i for i, name in enumerate(self.names)}
+        with np.load(self.state_path()) as state:
+            if str(state['graph']) != graph_hash:
+                return None
+            r1 = np.asarray([name2id[name] for name in state['r1'].tolist()], dtype=np.int64)
+            r2 = np.asarray([name2id[name] for name in state['r2'].tolist()], dtype=np.int64)
+            weight_sum = np.zeros(self.num_names * self.num_names, dtype=np.int64)
+            first_pair = np.full(self.num_names * self.num_names, self.num_triples * self.num_triples, dtype=np.int64)
+            weight_sum[r1 * self.num_names + r2] = state['weight']
+            first_pair[r1 * self.num_names + r2] = state['first_i'] * self.num_triples + state['first_j']
+        return weight_sum, first_pair
+
+    def touched_weights(self, touched):
+        #partial sums over the triple pairs with at least one touched entity pair
+        return self.accumulate_rows(np.flatnonzero(touched), touched)
+
+    def scan_first(self, keys):
+        '''
+        keys 在本图中第一次出现的三元组对 (需要 build_overlap_index)。只看含有 keys 的 r1 关系的
+        三元组的实体对，按其中最小的这种三元组编号排序，分块 (块大小倍增) 统计它们与所有实体对之间的
+        三元组对；三元组 i 所在的实体对处理完后，所有 (i, j) 都已统计，所以 key 当前的 first (i, j)
+        中 i 不超过已处理的编号时就是最终结果。
+        '''
+        num_triples = self.num_triples
+        first_pair = np.full(self.num_names * self.num_names, num_triples * num_triples, dtype=np.int64)
+        #smallest index of a triple with one of the r1 relations in every entity pair
+        group_of = np.empty(num_triples, dtype=np.int64)
+        group_of[self.members] = np.repeat(np.arange(self.num_groups), self.group_size)
+        candidates = np.flatnonzero(np.isin(self.rels, np.unique(keys // self.num_names)))
+        lowest = np.full(self.num_groups, num_triples, dtype=np.int64)
+        np.minimum.at(lowest, group_of[candidates], candidates)
+        order = np.flatnonzero(lowest < num_triples)
+        order = order[np.argsort(lowest[order], kind='stable')]
+        #no pair is left to a later row
+        untouched = np.zeros(self.num_groups, dtype=bool)
+        start, size = 0, 64
+        while len(keys) > 0 and start < len(order):
+            key, _, first = self.accumulate_rows(order[start:start + size], untouched)
+            first_pair[key] = np.minimum(first_pair[key], first)
+            start, size = start + size, 2 * size
+            if np.all(first_pair[keys] // num_triples <= lowest[order[min(start, len(order)) - 1]]):
+                break
+        return first_pair[keys]
+
+    def update_RSG(self, num_old_triples, old_graph_hash):
+        '''
+        train.txt 末尾追加了三元组后增量更新 RSG。新边只改变端点在新三元组端点中的实体对的邻域，
+        其他三元组对的相似度和关系都不变，所以从上次的 (r1, r2) 权重中减去旧图里这些
+        实体对参与的三元组对的贡献，再加上新图里的贡献。旧三元组在 self.triples 中的编号不变，
+        新三元组排在后面，所以 first 也可以更新；只有上次的 first 来自受影响的三元组对
+        且它在新图中权重为 0 的 key 要用 scan_first 重新查找。结果与完整构建相同。
+        没有对应 old_graph_hash 的状态，或受影响的实体对超过 UPDATE_MAX_FRACTION 的计算量时返回 None。
+        '''
+        self.graph_hash = file_hash(self.raw_train)
+        self.build_overlap_index()
+        state = self.load_state(old_graph_hash)
+        if state is None:
+            print('no RSG state of the last build, rebuilding')
+            return None
+        weight_sum, first_pair = state
+        num_names, num_triples = self.num_names, self.num_triples
+        changed_nodes = np.unique(self.graph.triples[num_old_triples:, [0, 2]])
+        #entity pairs whose neighbourhood has a new edge
+        touched = np.isin(self.pair_heads, changed_nodes) | np.isin(self.pair_tails, changed_nodes)
+        touched_cost = self.cost[touched].sum() / max(self.cost.sum(), 1)
+        print("{touched} of {groups} entity pairs touched by {new} appended triples ({cost:.1%} of the overlap cost)".format(
+            touched=int(touched.sum()), groups=self.num_groups,
+            new=self.graph.num_triples - num_old_triples, cost=touched_cost))
+        if touched_cost > UPDATE_MAX_FRACTION:
+            print('too many entity pairs touched, rebuilding')
+            return None
+
+        old = RSG(self.raw_train, self.rel_voc, self.data_dir, num_old_triples)
+        old.build_overlap_index()
+        removed = old.touched_weights(np.isin(old.pair_heads, changed_nodes) | np.isin(old.pair_tails, changed_nodes))
+        added = self.touched_weights(touched)
+        #relation names of the old graph are a subset of the new ones
+        name2id = {name: i for i, name in enumerate(self.names)}
+        old_names = np.asarray([name2id[name] for name in old.names], dtype=np.int64)
+        key, weight, first = removed
+        key = old_names[key // old.num_names] * num_names + old_names[key % old.num_names]
+        first = first // old.num_triples * num_triples + first % old.num_triples
+        weight_sum[key] -= weight
+        #the first pair of these keys may have lost its weight
+        unknown = np.zeros(num_names * num_names, dtype=bool)
+        unknown[key[first == first_pair[key]]] = True
+
+        key, weight, first = added
+        weight_sum[key] += weight
+        #the other triple pairs come no earlier than the old first
+        settled = first <= first_pair[key]
+        first_pair[key] = np.where(unknown[key], first, np.minimum(first_pair[key], first))
+        unknown[key[settled]] = False
+        unknown = np.flatnonzero(unknown & (weight_sum > 0))
+        first_pair[unknown] = self.scan_first(unknown)
+        self.weight_sum, self.first_pair = weight_sum, first_pair
+        return self.to_rel_triples(weight_sum, first_pair)
+
+    def write_RSG(self, method='index', shard_dir=None, num_shards=1, shard_ids=None, workers=None,
+            bands=MINHASH_BANDS, rows=MINHASH_ROWS, appended=None, output_format='both'):
+        #appended: (triples, train.txt sha256) of the last build if triples were only appended since
+        rel_triple2id = None
+        merged = False
+        if method == 'index' and appended is not None:
+            rel_triple2id = self.update_RSG(*appended)
+        if rel_triple2id is not None:
+            self.save_state()
+        elif method == 'index':
+            rel_triple2id = self.get_RSG_indexed(shard_dir, num_shards, shard_ids, workers)
+            if rel_triple2id is None:
+                return False
+            self.save_state()
+            merged = True
+        elif method == 'minhash':
+            rel_triple2id = self.get_RSG_minhash(bands, rows)
+        else:
+            rel_triple2id = self.get_RSG2()
+        if output_format != 'binary':
+            with open(self.data_dir, "w") as file:
+                for rel_triple in rel_triple2id:
+                    file.write('\t'.join(map(str, rel_triple)) + '\n')
+        if output_format != 'text':
+            #(r1, w, r2) rows as the arrays CARST turns into edge_index and edge_type
+            rel_triple2id = np.asarray(rel_triple2id, dtype=np.int64).reshape(-1, 3)
+            np.savez(self.binary_path(), src=rel_triple2id[:, 0], dst=rel_triple2id[:, 2], weight=rel_triple2id[:, 1])
+        #run.py prefers RSG2.npz, so the format not written must not outlive this build
+        stale = {'text': self.binary_path(), 'binary': self.data_dir}.get(output_format)
+        if stale is not None and os.path.exists(stale):
+            os.remove(stale)
+        if merged:
+            #the outputs and the saved state supersede the partials, also those of other splits
+            for path in glob.glob(os.path.join(shard_dir, '*-of-*.npz')):
+                os.remove(path)
+        return True
+
+
+def compare_RSG(exact, approx):
+    '''
+    近似 RSG 与精确 RSG 的误差：关系对的召回率和准确率，以及权重的相对 L1 误差
+    '''
+    exact_w = {(h, t): w for h, w, t in exact.tolist()}
+    approx_w = {(h, t): w for h, w, t in approx.tolist()}
+    common = len(set(exact_w) & set(approx_w))
+    l1 = sum(abs(exact_w.get(key, 0) - approx_w.get(key, 0)) for key in set(exact_w) | set(approx_w))
+    return {'exact_pairs': len(exact_w), 'approx_pairs': len(approx_w),
+        'recall': common / max(len(exact_w), 1), 'precision': common / max(len(approx_w), 1),
+        'weight_error': l1 / max(sum(exact_w.values()), 1)}
+
+
+def report_RSG(rsg, workers=None, bands=MINHASH_BANDS, rows=MINHASH_ROWS):
+    #error-vs-time of the MinHash RSG against the exact index method, without cached shards
+    start = time.time()
+    with tempfile.TemporaryDirectory() as shard_dir:
+        exact = rsg.get_RSG_indexed(shard_dir, workers=workers)
+    exact_seconds = time.time() - start
+    start = time.time()
+    approx = rsg.get_RSG_minhash(bands, rows)
+    approx_seconds = time.time() - start
+    report = compare_RSG(exact, approx)
+    report.update({'exact_seconds': exact_seconds, 'minhash_seconds': approx_seconds,
+        'bands': bands, 'rows': rows})
+    print('exact {exact_seconds:.2f}s, minhash ({bands}x{rows}) {minhash_seconds:.2f}s, '
+        'relation pairs {exact_pairs} / {approx_pairs}, recall {recall:.4f}, precision {precision:.4f}, '
+        'weight error {weight_error:.4f}'.format(**report))
+    return report
+
+
+def attach_rsg(rsg):
+    #pool initializer, the RSG is inherited through fork
+    global worker_rsg
+    worker_rsg = rsg
+
+
+def write_shard(shard_dir, shard_id, num_shards):
+    return worker_rsg.write_shard(shard_dir, shard_id, num_shards)
         
 
 if __name__ == '__main__':
@@ -182,14 +686,61 @@ if __name__ == '__main__':
             'fb237_v1', 'fb237_v2', 'fb237_v3', 'fb237_v4', 
             'WN18RR_v1', 'WN18RR_v2', 'WN18RR_v3', 'WN18RR_v4',
             'fb237_v1_ind', 'fb237_v2_ind', 'fb237_v3_ind', 'fb237_v4_ind',
-            'WN18RR_v1_ind', 'WN18RR_v2_ind', 'WN18RR_v3_ind', 'WN18RR_v4_ind'
+            'WN18RR_v1_ind', 'WN18RR_v2_ind', 'WN18RR_v3_ind', 'WN18RR_v4_ind',
+            'drkg', 'drkg_ind'
         ])
+    parser.add_argument('--method', type=str, default='index', choices=['index', 'combinations', 'minhash'],
+                        help='compare only triples with overlapping neighbourhoods, every pair of triples, '
+                        'or estimate similarities with MinHash/LSH (approximate)')
+    parser.add_argument('--num_shards', type=int, default=8,
+                        help='split the index method into this many resumable shards')
+    parser.add_argument('--shard_id', type=int, default=None,
+                        help='only compute this shard, e.g. on one of several machines sharing RSG2_shards/')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes computing shards, all cores by default')
+    parser.add_argument('--minhash_bands', type=int, default=MINHASH_BANDS,
+                        help='LSH bands of the minhash method')
+    parser.add_argument('--minhash_rows', type=int, default=MINHASH_ROWS,
+                        help='MinHash values per LSH band of the minhash method')
+    parser.add_argument('--output_format', type=str, default='both', choices=['text', 'binary', 'both'],
+                        help='write RSG2.txt, the RSG2.npz arrays loaded by CARST, or both')
+    parser.add_argument('--report', action='store_true',
+                        help='print error and time of the minhash method against the exact one instead of writing RSG2.txt')
     args = parser.parse_args()
     data_dir = os.path.join(os.getcwd(), 'data_preprocessed', args.task, 'RSG2.txt') # 处理后RSG保存地址
     raw_train = os.path.join(os.getcwd(), 'dataset', args.task, 'train.txt')
     vocab_path = os.path.join('data_preprocessed', args.task, 'vocab_rel.txt')
-    rsg = RSG(raw_train, vocab_path, data_dir)
-    print('Build Relational Structure Graph...')
-    rel_triple = rsg.write_RSG()
-    print('finish building RSG')
+    manifest = Manifest(os.path.dirname(data_dir))
+    inputs = {'train': raw_train, 'vocab_rel': vocab_path}
+    #the exact methods write the same file
+    params = {} if args.method != 'minhash' else \
+        {'method': args.method, 'bands': args.minhash_bands, 'rows': args.minhash_rows}
+    outputs = []
+    if args.output_format != 'binary':
+        outputs.append(data_dir)
+    if args.output_format != 'text':
+        outputs.append(os.path.splitext(data_dir)[0] + '.npz')
+    if args.report:
+        report_RSG(RSG(raw_train, vocab_path, data_dir), args.workers, args.minhash_bands, args.minhash_rows)
+    elif manifest.is_fresh('rsg', inputs, params, outputs):
+        print('inputs are unchanged since the last run, skipping RSG')
+    else:
+        #if triples were only appended to train.txt, update the weights of the last exact build
+        appended = None
+        if args.method == 'index' and args.shard_id is None \
+                and manifest.stages.get('rsg', dict()).get('params') == params:
+            n_old_triples = manifest.appended('rsg', 'train', raw_train)
+            if n_old_triples is not None:
+                appended = (n_old_triples, manifest.stages['rsg']['inputs']['train']['sha256'])
+        rsg = RSG(raw_train, vocab_path, data_dir)
+        print('Build Relational Structure Graph...')
+        shard_ids = None if args.shard_id is None else [args.shard_id]
+        if rsg.write_RSG(args.method, os.path.join(os.path.dirname(data_dir), 'RSG2_shards'),
+                args.num_shards, shard_ids, args.workers, args.minhash_bands, args.minhash_rows, appended,
+                args.output_format):
+            manifest.update('rsg', inputs, params, outputs)
+            print('finish building RSG')
+        else:
+            print('shard {shard} of {num} done, the RSG is merged once all shards exist'.format(
+                shard=args.shard_id, num=args.num_shards))
     
\ No newline at end of file
@@ -0,0 +1,587 @@
+#compact integer graph shared by preprocessing, negative sampling, RSG and training
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+#below this endpoint degree product, 4-hop depth-first search is cheaper
+BIDIRECTIONAL_MIN_DEGREE_PRODUCT = 200
+#beyond this many hops, merging prefix states beats listing entity paths
+MERGED_MIN_HOPS = 6
+#above this endpoint degree product, budgeted extraction samples random walks
+RANDOM_WALK_MIN_DEGREE_PRODUCT = 10000000
+#random walks tried per requested path before random-walk sampling gives up
+WALKS_PER_PATH = 20
+#arrays written by KnowledgeGraph.save and mapped back by KnowledgeGraph.load
+GRAPH_ARRAYS = ('triples', 'indptr', 'indices', 'labels', 'reverse')
+
+
+class KnowledgeGraph(object):
+    """
+    Integer CSR view of a triple file.
+
+    Entities and relations are interned to int32 ids in order of first
+    appearance, so `id2ent` lists nodes in the same order as the networkx
+    MultiDiGraph built from the same file. Every triple (h, r, t) stores a
+    forward edge h->t with label 2*r and an inverse edge t->h with label
+    2*r+1 (relation 'inv_' + r). Edges of a node are kept in networkx
+    adjacency order, so path enumeration visits paths in the same order.
+    """
+
+    def __init__(self, triples):
+        self.ent2id = dict()
+        self.id2ent = []
+        self.rel2id = dict()
+        self.id2rel = []
+        heads, rels, tails = [], [], []
+        for head, relation, tail in triples:
+            for ent in (head, tail):
+                if ent not in self.ent2id:
+                    self.ent2id[ent] = len(self.id2ent)
+                    self.id2ent.append(ent)
+            if relation not in self.rel2id:
+                self.rel2id[relation] = len(self.id2rel)
+                self.id2rel.append(relation)
+            heads.append(self.ent2id[head])
+            rels.append(self.rel2id[relation])
+            tails.append(self.ent2id[tail])
+
+        self.build_labels()
+
+        self.triples = np.stack([np.asarray(heads, dtype=np.int32),
+            np.asarray(rels, dtype=np.int32),
+            np.asarray(tails, dtype=np.int32)], axis=1).reshape(-1, 3)
+        self.num_nodes = len(self.id2ent)
+        self.num_triples = len(self.triples)
+        self.build_csr()
+
+    def build_labels(self):
+        #label 2*r is relation r, label 2*r+1 is inv_r
+        self.id2label = []
+        for relation in self.id2rel:
+            self.id2label.append(relation)
+            self.id2label.append('inv_' + relation)
+        self.label2id = {label: i for i, label in enumerate(self.id2label)}
+
+    @classmethod
+    def from_file(cls, raw_train, num_triples=None):
+        #num_triples: only the first lines of the file, e.g. train.txt before an append
+        triples = []
+        with open(raw_train, 'r') as f_train:
+            for line in f_train.readlines()[:num_triples]:
+                tokens = re.split(r'\t|\s', line.strip())
+                triples.append((tokens[0], tokens[1], tokens[2]))
+        return cls(triples)
+
+    def save(self, graph_dir):
+        """
+        Writes the CSR arrays as .npy files and the vocabularies as json
+        into graph_dir, so other processes can map the graph with load().
+        """
+        if not os.path.exists(graph_dir):
+            os.makedirs(graph_dir)
+        for name in GRAPH_ARRAYS:
+            np.save(os.path.join(graph_dir, name + '.npy'), getattr(self, name))
+        with open(os.path.join(graph_dir, 'vocab.json'), 'w') as fw:
+            json.dump({'entities': self.id2ent, 'relations': self.id2rel}, fw)
+
+    @classmethod
+    def load(cls, graph_dir, mmap_mode='r'):
+        """
+        Graph written by save(). With mmap_mode='r' the arrays are read-only
+        memory maps, so every process that loads the same graph_dir shares
+        one copy through the page cache.
+        """
+        graph = cls.__new__(cls)
+        with open(os.path.join(graph_dir, 'vocab.json'), 'r') as fr:
+            vocab = json.load(fr)
+        graph.id2ent = vocab['entities']
+        graph.id2rel = vocab['relations']
+        graph.ent2id = {ent: i for i, ent in enumerate(graph.id2ent)}
+        graph.rel2id = {rel: i for i, rel in enumerate(graph.id2rel)}
+        graph.build_labels()
+        for name in GRAPH_ARRAYS:
+            setattr(graph, name, np.load(os.path.join(graph_dir, name + '.npy'), mmap_mode=mmap_mode))
+        graph.num_nodes = len(graph.id2ent)
+        graph.num_triples = len(graph.triples)
+        graph.num_edges = len(graph.indices)
+        return graph
+
+    def build_csr(self):
+        heads = self.triples[:, 0].astype(np.int64)
+        rels = self.triples[:, 1].astype(np.int64)
+        tails = self.triples[:, 2].astype(np.int64)
+        #edge 2*i is h->t of triple i, edge 2*i+1 is its inverse t->h
+        src = np.stack([heads, tails], axis=1).ravel()
+        dst = np.stack([tails, heads], axis=1).ravel()
+        lab = np.stack([2 * rels, 2 * rels + 1], axis=1).ravel()
+        seq = np.arange(len(src))
+
+        #networkx orders the neighbours of a node by the first edge added
+        #towards them, and parallel edges by insertion
+        _, first, inverse = np.unique(src * max(self.num_nodes, 1) + dst,
+            return_index=True, return_inverse=True)
+        order = np.lexsort((seq, first[inverse.ravel()], src))
+
+        self.indices = dst[order].astype(np.int32)
+        self.labels = lab[order].astype(np.int32)
+        #reverse[p] is the csr position of the inverse of the edge at p
+        position = np.empty_like(order)
+        position[order] = np.arange(len(order))
+        self.reverse = position[order ^ 1]
+        self.indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=self.num_nodes), out=self.indptr[1:])
+        self.num_edges = len(self.indices)
+
+    def has_node(self, ent):
+        return ent in self.ent2id
+
+    def degree(self, node):
+        return int(self.indptr[node + 1] - self.indptr[node])
+
+    def out_edges(self, node):
+        #(neighbour ids, label ids) of all edges leaving node
+        start, end = self.indptr[node], self.indptr[node + 1]
+        return self.indices[start:end], self.labels[start:end]
+
+    def successors(self, node):
+        return np.unique(self.indices[self.indptr[node]:self.indptr[node + 1]])
+
+    def predecessors(self, node):
+        #every edge is stored together with its inverse, so in- and
+        #out-neighbourhoods coincide
+        return self.successors(node)
+
+    def has_edge(self, head, tail, label=None):
+        nbrs, labels = self.out_edges(head)
+        hit = nbrs == tail
+        if label is not None:
+            hit &= labels == label
+        return bool(hit.any())
+
+    def relation_names(self, label_ids):
+        return [self.id2label[label] for label in label_ids]
+
+    def hop_distances(self, source, max_hops):
+        """
+        Breadth-first hop counts from source (a node or an array of nodes),
+        capped at max_hops + 1 for nodes that are further away (or
+        unreachable).
+        """
+        dist = np.full(self.num_nodes, max_hops + 1, dtype=np.int8)
+        frontier = np.unique(np.asarray(source, dtype=np.int64).ravel())
+        dist[frontier] = 0
+        for hop in range(1, max_hops + 1):
+            starts = self.indptr[frontier]
+            counts = self.indptr[frontier + 1] - starts
+            if counts.sum() == 0:
+                break
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+            nbrs = self.indices[offsets + np.arange(counts.sum())]
+            nbrs = np.unique(nbrs[dist[nbrs] > hop])
+            if len(nbrs) == 0:
+                break
+            dist[nbrs] = hop
+            frontier = nbrs.astype(np.int64)
+        return dist
+
+    def find_paths(self, head, tail, cutoff=4):
+        """
+        Relation-id sequences of all simple edge paths from head to tail with
+        at most cutoff hops, in the order nx.all_simple_edge_paths yields
+        them (same simple-path rule, parallel edges are distinct paths).
+        Branches that cannot reach tail within the remaining hops are pruned
+        with the hop distances from tail.
+        """
+        if head == tail or cutoff < 1:
+            return []
+        dist = self.hop_distances(tail, cutoff - 1)
+        indptr, indices, labels = self.indptr, self.indices, self.labels
+        paths = []
+        on_path = []
+        label_path = []
+
+        def extend(node, depth):
+            start, end = indptr[node], indptr[node + 1]
+            nbrs = indices[start:end]
+            if depth + 1 == cutoff:
+                for label in labels[start:end][nbrs == tail].tolist():
+                    paths.append(tuple(label_path) + (label,))
+                return
+            #keep edges whose endpoint may still reach tail in time
+            keep = np.flatnonzero(dist[nbrs] < cutoff - depth)
+            on_path.append(node)
+            for nbr, label in zip(nbrs[keep].tolist(), labels[start:end][keep].tolist()):
+                if nbr == tail:
+                    paths.append(tuple(label_path) + (label,))
+                elif nbr not in on_path[:-1]:
+                    label_path.append(label)
+                    extend(nbr, depth + 1)
+                    label_path.pop()
+            on_path.pop()
+
+        extend(head, 0)
+        return paths
+
+    def find_relation_paths(self, head, tail, cutoff=4):
+        """
+        Distinct relation-id sequences of find_paths(head, tail, cutoff), in
+        order of first appearance, without listing every entity path.
+
+        The search runs hop by hop over (node, relation prefix) states, so
+        entity paths that share a prefix and an end node are merged. A state
+        keeps the nodes its walks have visited only where they can still
+        matter: a node further than the remaining hops from tail can never
+        be stepped on again, so it is dropped, and walks left with the same
+        visited nodes keep only their earliest csr position sequence, which
+        orders the output like the depth-first search.
+        """
+        if head == tail or cutoff < 1:
+            return []
+        dist = self.hop_distances(tail, cutoff - 1)
+        indptr, indices, labels = self.indptr, self.indices, self.labels
+        found = dict()
+        #(node, relation prefix) -> {visited nodes that still matter: earliest csr positions}
+        states = {(head, ()): {frozenset(): ()}}
+        for depth in range(cutoff):
+            next_states = dict()
+            for (node, prefix), entries in states.items():
+                start, end = indptr[node], indptr[node + 1]
+                nbrs = indices[start:end]
+                if depth + 1 == cutoff:
+                    steps = np.flatnonzero(nbrs == tail)
+                else:
+                    steps = np.flatnonzero(dist[nbrs] < cutoff - depth)
+                #nodes that are more than reach hops from tail are never stepped on again
+                reach = cutoff - depth - 2
+                for pos, nbr, label in zip((steps + start).tolist(), nbrs[steps].tolist(),
+                        labels[start:end][steps].tolist()):
+                    path = prefix + (label,)
+                    if nbr == tail:
+                        key = min(entries.values()) + (pos,)
+                        if path not in found or key < found[path]:
+                            found[path] = key
+                        continue
+                    merged = next_states.setdefault((nbr, path), dict())
+                    for visited, key in entries.items():
+                        if nbr in visited:
+                            continue
+                        visited = frozenset(v for v in visited.union((node,)) if dist[v] <= reach)
+                        key = key + (pos,)
+                        if visited not in merged or key < merged[visited]:
+                            merged[visited] = key
+                    if len(merged) == 0:
+                        del next_states[(nbr, path)]
+            states = next_states
+            if len(states) == 0:
+                break
+        return sorted(found, key=found.get)
+
+    def sample_paths(self, head, tail, max_hops=4, max_paths=300, time_budget=None, rng=None):
+        """
+        At most max_paths distinct relation paths from head to tail, and
+        whether that is only a sample of them. Paths are enumerated
+        depth-first and kept by reservoir sampling, so the result is a
+        uniform sample of the distinct relation paths seen. The search stops
+        after time_budget seconds. Between endpoints whose degree product
+        reaches RANDOM_WALK_MIN_DEGREE_PRODUCT the paths are collected by
+        random walks towards tail instead, which never enumerate all
+        branches of a hub.
+        """
+        if head == tail or max_hops < 1:
+            return [], False
+        if rng is None:
+            rng = np.random.default_rng()
+        deadline = None if not time_budget else time.perf_counter() + time_budget
+        dist = self.hop_distances(tail, max_hops - 1)
+        if self.degree(head) * self.degree(tail) >= RANDOM_WALK_MIN_DEGREE_PRODUCT:
+            return self.walk_paths(head, tail, max_hops, max_paths, deadline, dist, rng), True
+
+        indptr, indices, labels = self.indptr, self.indices, self.labels
+        seen = set()
+        reservoir = []
+        stopped = []
+        on_path = []
+        label_path = []
+
+        def keep(path):
+            if path in seen:
+                return
+            seen.add(path)
+            if len(reservoir) < max_paths:
+                reservoir.append(path)
+            else:
+                j = rng.integers(len(seen))
+                if j < max_paths:
+                    reservoir[j] = path
+
+        def extend(node, depth):
+            if deadline is not None and time.perf_counter() > deadline:
+                stopped.append(True)
+                return
+            start, end = indptr[node], indptr[node + 1]
+            nbrs = indices[start:end]
+            if depth + 1 == max_hops:
+                for label in labels[start:end][nbrs == tail].tolist():
+                    keep(tuple(label_path) + (label,))
+                return
+            steps = np.flatnonzero(dist[nbrs] < max_hops - depth)
+            on_path.append(node)
+            for nbr, label in zip(nbrs[steps].tolist(), labels[start:end][steps].tolist()):
+                if stopped:
+                    break
+                if nbr == tail:
+                    keep(tuple(label_path) + (label,))
+                elif nbr not in on_path[:-1]:
+                    label_path.append(label)
+                    extend(nbr, depth + 1)
+                    label_path.pop()
+            on_path.pop()
+
+        extend(head, 0)
+        return reservoir, len(stopped) > 0 or len(seen) > max_paths
+
+    def walk_paths(self, head, tail, max_hops, max_paths, deadline, dist, rng):
+        """
+        Distinct relation paths found by random simple walks from head that
+        only step to nodes still within reach of tail, until max_paths are
+        found, the deadline passes or WALKS_PER_PATH * max_paths walks are spent.
+        """
+        found = []
+        seen = set()
+        for _ in range(WALKS_PER_PATH * max_paths):
+            if len(found) >= max_paths or (deadline is not None and time.perf_counter() > deadline):
+                break
+            node, on_path, label_path = head, [head], []
+            for depth in range(max_hops):
+                nbrs, labels = self.out_edges(node)
+                steps = dist[nbrs] < max_hops - depth
+                steps &= ~np.isin(nbrs, on_path[:-1])
+                steps = np.flatnonzero(steps)
+                if len(steps) == 0:
+                    break
+                step = steps[rng.integers(len(steps))]
+                label_path.append(int(labels[step]))
+                node = int(nbrs[step])
+                if node == tail:
+                    path = tuple(label_path)
+                    if path not in seen:
+                        seen.add(path)
+                        found.append(path)
+                    break
+                on_path.append(node)
+        return found
+
+    def search_paths(self, head, tail, max_hops=4, search='auto'):
+        """
+        Relation paths from head to tail by depth-first or meet-in-the-middle
+        search; both return the same paths in the same order. 'auto' picks
+        the bidirectional search for well-connected endpoints, where it
+        outruns the per-node overhead of the depth-first search.
+        """
+        if search == 'auto':
+            bidirectional = self.degree(head) * self.degree(tail) >= BIDIRECTIONAL_MIN_DEGREE_PRODUCT
+            search = 'bidirectional' if bidirectional else 'dfs'
+        if search == 'bidirectional':
+            return self.find_paths_bidirectional(head, tail, max_hops)
+        return self.find_paths(head, tail, max_hops)
+
+    def search_relation_paths(self, head, tail, max_hops=4, search='auto'):
+        """
+        Distinct relation paths from head to tail in order of first
+        appearance. 'merged' searches (node, relation prefix) states with
+        find_relation_paths; 'dfs' and 'bidirectional' dedupe the output of
+        search_paths. 'auto' merges prefixes for long paths, where entity
+        paths explode, and otherwise picks as search_paths does.
+        """
+        if search == 'auto' and max_hops >= MERGED_MIN_HOPS:
+            search = 'merged'
+        if search == 'merged':
+            return self.find_relation_paths(head, tail, max_hops)
+        return list(dict.fromkeys(self.search_paths(head, tail, max_hops, search)))
+
+    def search_relation_paths_many(self, head, tail, max_hops=4):
+        """
+        search_relation_paths from a fixed endpoint to a list of candidates
+        (head or tail is the list), one list of distinct relation paths per
+        candidate. The candidates share one search up to MERGED_MIN_HOPS,
+        beyond which every pair merges its own prefix states.
+        """
+        if max_hops >= MERGED_MIN_HOPS:
+            if np.ndim(head) > 0:
+                return [self.find_relation_paths(h, tail, max_hops) for h in np.asarray(head).tolist()]
+            return [self.find_relation_paths(head, t, max_hops) for t in np.asarray(tail).tolist()]
+        return self.find_paths_many(head, tail, max_hops, distinct=True)
+
+    def half_paths(self, source, max_hops, dist, budget, stop, lead=0):
+        """
+        Walks of up to max_hops edges from source (a node or an array of
+        nodes) that obey the simple-path rule, expanded one hop at a time
+        over the whole frontier. Returns
+        {length: (nodes [n, length+1], csr positions [n, length])}.
+        A walk is extended while dist[end] <= budget - length, so the other
+        endpoint may still be reached, and never continues past stop. It is
+        kept only if it can be joined with a walk of length + lead hops or
+        less from the other endpoint.
+        """
+        nodes = np.asarray(source, dtype=np.int64).reshape(-1, 1)
+        edges = np.empty((len(nodes), 0), dtype=np.int64)
+        walks = {0: (nodes, edges)}
+        for depth in range(max_hops):
+            live = nodes[:, -1] != stop
+            nodes, edges = nodes[live], edges[live]
+            rows, pos = self.expand(nodes[:, -1])
+            nbrs = self.indices[pos].astype(np.int64)
+            keep = dist[nbrs] <= budget - depth - 1
+            #a node may not come back once the walk has left it
+            keep &= ~(nodes[rows, :-1] == nbrs[:, None]).any(axis=1)
+            rows, pos, nbrs = rows[keep], pos[keep], nbrs[keep]
+            nodes = np.concatenate([nodes[rows], nbrs[:, None]], axis=1)
+            edges = np.concatenate([edges[rows], pos[:, None]], axis=1)
+            stored = dist[nbrs] <= min(depth + 1 + lead, budget - depth - 1)
+            walks[depth + 1] = (nodes[stored], edges[stored])
+            if len(nodes) == 0:
+                break
+        return walks
+
+    def expand(self, frontier):
+        """
+        All edges leaving the frontier nodes, as (frontier row, csr position)
+        arrays in csr order.
+        """
+        starts = self.indptr[frontier]
+        counts = self.indptr[frontier + 1] - starts
+        rows = np.repeat(np.arange(len(frontier)), counts)
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return rows, offsets + np.arange(counts.sum())
+
+    def find_paths_bidirectional(self, head, tail, max_hops=4):
+        """
+        Meet-in-the-middle version of find_paths: walks of up to
+        ceil(max_hops/2) hops from head are joined with walks of up to
+        floor(max_hops/2) hops from tail on their end nodes. A path of k
+        hops is split after ceil(k/2) hops, so each path is built once.
+        Returns the same relation-id sequences in the same order as
+        find_paths(head, tail, max_hops).
+        """
+        if head == tail or max_hops < 1:
+            return []
+        dist_tail = self.hop_distances(tail, max_hops)
+        dist_head = self.hop_distances(head, max_hops)
+        forward = self.half_paths(head, (max_hops + 1) // 2, dist_tail, max_hops, tail)
+        backward = self.half_paths(tail, max_hops // 2, dist_head, max_hops, head, lead=1)
+        return self.join_half_paths(forward, None, backward, None, 1, max_hops)[0]
+
+    def find_paths_many(self, head, tail, max_hops=4, distinct=False):
+        """
+        find_paths_bidirectional from one endpoint to many: either head or
+        tail is a list of candidates (corrupted tails or heads) and the other
+        a single node. The half of the fixed endpoint is expanded once, with
+        no stop node and pruned by the hop distances to all candidates, and
+        the halves of all candidates in one more expansion; every joined path
+        is then checked with the simple-path rule, which drops the walks that
+        ran through their own candidate. Returns one list of relation-id
+        sequences per candidate, each as find_paths(head, tail, max_hops), or
+        as search_relation_paths if distinct.
+        """
+        many_heads = np.ndim(head) > 0
+        fixed = tail if many_heads else head
+        candidates = np.asarray(head if many_heads else tail, dtype=np.int64)
+        found = [[] for _ in range(len(candidates))]
+        if max_hops < 1:
+            return found
+        sources = np.unique(candidates[candidates != fixed])
+        if len(sources) == 0:
+            return found
+        dist_fixed = self.hop_distances(fixed, max_hops)
+        dist_sources = self.hop_distances(sources, max_hops)
+        if many_heads:
+            forward = self.half_paths(sources, (max_hops + 1) // 2, dist_fixed, max_hops, fixed)
+            backward = self.half_paths(fixed, max_hops // 2, dist_sources, max_hops, -1, lead=1)
+            f_owner, b_owner = sources, None
+        else:
+            forward = self.half_paths(fixed, (max_hops + 1) // 2, dist_sources, max_hops, -1)
+            backward = self.half_paths(sources, max_hops // 2, dist_fixed, max_hops, fixed, lead=1)
+            f_owner, b_owner = None, sources
+        paths = self.join_half_paths(forward, f_owner, backward, b_owner, len(sources), max_hops, distinct)
+        for i, candidate in enumerate(candidates.tolist()):
+            if candidate != fixed:
+                found[i] = paths[int(np.searchsorted(sources, candidate))]
+        return found
+
+    def join_half_paths(self, forward, f_sources, backward, b_sources, num_owners, max_hops, distinct=False):
+        """
+        Joins the walks of half_paths from the head side and from the tail
+        side into simple paths. The walks of the side with sources started at
+        those sorted candidate nodes, the other side at one node (sources
+        None). Returns, per candidate, the relation-id sequences of its paths
+        in the order of find_paths, or only their first appearances if
+        distinct.
+        """
+        found, owners = [], []
+        for length in range(1, max_hops + 1):
+            f_len = (length + 1) // 2
+            if f_len not in forward or length - f_len not in backward:
+                continue
+            f_nodes, f_edges = forward[f_len]
+            b_nodes, b_edges = backward[length - f_len]
+
+            #pair every forward walk with the backward walks ending at its end node
+            order = np.argsort(b_nodes[:, -1], kind='stable')
+            b_nodes, b_edges = b_nodes[order], b_edges[order]
+            left = np.searchsorted(b_nodes[:, -1], f_nodes[:, -1], side='left')
+            right = np.searchsorted(b_nodes[:, -1], f_nodes[:, -1], side='right')
+            counts = right - left
+            f_rows = np.repeat(np.arange(len(f_nodes)), counts)
+            b_rows = np.repeat(left - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+            path_nodes = np.concatenate(
+                [f_nodes[f_rows], b_nodes[b_rows][:, ::-1][:, 1:]], axis=1)
+            path_edges = np.concatenate(
+                [f_edges[f_rows], self.reverse[b_edges[b_rows][:, ::-1]]], axis=1)
+            if f_sources is not None:
+                owner = np.searchsorted(f_sources, path_nodes[:, 0])
+            elif b_sources is not None:
+                owner = np.searchsorted(b_sources, path_nodes[:, -1])
+            else:
+                owner = np.zeros(len(path_nodes), dtype=np.int64)
+            #only complete walks end at tail
+            valid = (path_nodes[:, f_len] == path_nodes[:, -1]) == (length == f_len)
+            valid &= path_nodes[:, -2] != path_nodes[:, -1]
+            for i in range(length - 1):
+                for j in range(i + 2, length + 1):
+                    valid &= path_nodes[:, i] != path_nodes[:, j]
+            path_edges = path_edges[valid]
+            padded = np.full((len(path_edges), max_hops), -1, dtype=np.int64)
+            padded[:, :length] = path_edges
+            found.append(padded)
+            owners.append(owner[valid])
+
+        if len(found) == 0:
+            return [[] for _ in range(num_owners)]
+        found = np.concatenate(found, axis=0)
+        owners = np.concatenate(owners)
+        #depth-first search yields paths in lexicographic order of csr positions
+        order = np.lexsort(np.concatenate([found.T[::-1], owners[None, :]], axis=0))
+        found, owners = found[order], owners[order]
+        labels = np.where(found >= 0, self.labels[np.maximum(found, 0)], -1)
+        if distinct:
+            #first appearance of every relation path of a candidate, with one
+            #int64 key per (candidate, path) while it fits
+            base = len(self.id2label) + 1
+            if num_owners * base ** max_hops < 1 << 62:
+                keys = owners.astype(np.int64)
+                for column in labels.T:
+                    keys = keys * base + column + 1
+                order = np.argsort(keys, kind='stable')
+                first = np.sort(order[np.r_[True, keys[order][1:] != keys[order][:-1]]]) if len(keys) > 0 else order
+            else:
+                _, first = np.unique(np.concatenate([owners[:, None], labels], axis=1), axis=0, return_index=True)
+                first = np.sort(first)
+            labels, owners = labels[first], owners[first]
+        lengths = (labels >= 0).sum(axis=1).tolist()
+        paths = [tuple(label_path[:n]) for label_path, n in zip(labels.tolist(), lengths)]
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(owners, minlength=num_owners))]).tolist()
+        return [paths[bounds[i]:bounds[i + 1]] for i in range(num_owners)]
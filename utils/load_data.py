@@ -1,19 +1,182 @@
 import json
+import os
+import numpy as np
+import torch
 from torch.utils.data import Dataset
 
+from utils.manifest import file_hash
+from utils.query_store import QueryStore
+from utils.relation_context import RelationContext, pad_ragged
+
 
 def collate_fn(batch):
     batch = list(zip(*batch))
-    [pos_id, relation, head, tail, path, num_path, path_mask, overall_mask] = batch
+    [pos_id, relation, head, tail, path, num_path, path_len] = batch
     del batch
-    return pos_id, relation, head, tail, path, num_path, path_mask, overall_mask
+    return pos_id, relation, head, tail, path, num_path, path_len
+
+
+class TensorBatch(object):
+    """
+    Padded int64 tensors of a batch of B examples with P paths in all:
+    relation [B], head and tail relation contexts [B, L] with their lengths
+    [B], paths [P, W] (with [CLS], padded with [PAD]) grouped by example,
+    path_len [P] and num_path [B]. pos_id is None for negatives.
+    """
+    fields = ['pos_id', 'relation', 'head', 'head_len', 'tail', 'tail_len',
+        'path', 'path_len', 'num_path']
+
+    def __init__(self, pos_id, relation, head, head_len, tail, tail_len,
+            path, path_len, num_path):
+        self.pos_id = pos_id
+        self.relation = relation
+        self.head = head
+        self.head_len = head_len
+        self.tail = tail
+        self.tail_len = tail_len
+        self.path = path
+        self.path_len = path_len
+        self.num_path = num_path
+
+    @classmethod
+    def from_ragged(cls, pos_id, relation, head, head_len, tail, tail_len,
+            path, path_len, num_path):
+        #flat context ids and the path rows, padded here
+        def tensor(values):
+            return torch.from_numpy(np.asarray(values, dtype=np.int64).reshape(-1))
+        head = torch.from_numpy(pad_ragged(head, head_len)[0])
+        tail = torch.from_numpy(pad_ragged(tail, tail_len)[0])
+        return cls(None if pos_id is None else tensor(pos_id), tensor(relation),
+            head, tensor(head_len), tail, tensor(tail_len),
+            torch.from_numpy(path), tensor(path_len), tensor(num_path))
+
+    def to(self, device):
+        for name in self.fields:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, value.to(device))
+        return self
+
+    def __len__(self):
+        return len(self.relation)
+
+
+def tensorize(batch):
+    """
+    TensorBatch of the column lists of collate_fn
+    [pos_id, relation, head, tail, paths, num_path, path_len] or of the
+    negatives [relation, head, tail, paths, num_path, path_len].
+    """
+    if isinstance(batch, TensorBatch):
+        return batch
+    if len(batch) == 7:
+        pos_id, batch = batch[0], batch[1:]
+    elif len(batch) == 6:
+        pos_id = None
+    else:
+        raise ValueError('a batch has 6 or 7 fields, got %d' % len(batch))
+    relation, head, tail, paths, num_path, path_len = batch
+    rows = [row for its in paths for row in its]
+    path = pad_ragged([t for row in rows for t in row], [len(row) for row in rows])[0]
+    return TensorBatch.from_ragged(pos_id, relation,
+        [r for it in head for r in it], [len(it) for it in head],
+        [r for it in tail for r in it], [len(it) for it in tail],
+        path, [n for its in path_len for n in its], num_path)
+
+
+class TensorDataset(Dataset):
+    """
+    The examples of a MyDataset or BinaryDataset converted once into flat
+    arrays: ragged head and tail contexts, and paths as one padded [P, W]
+    array sliced by example. collate_tensors turns a list of its items into
+    a TensorBatch without touching Python lists per token.
+    """
+    def __init__(self, dataset):
+        self.length = len(dataset)
+        self.max_num_path = dataset.max_num_path
+        pos_id, relation, head, tail, rows, num_path, path_len = [], [], [], [], [], [], []
+        for i in range(self.length):
+            example = dataset[i]
+            pos_id.append(example[0])
+            relation.append(example[1])
+            head.append(example[2])
+            tail.append(example[3])
+            rows.extend(example[4])
+            num_path.append(example[5])
+            path_len.extend(example[6])
+        self.pos_id = np.asarray(pos_id, dtype=np.int64)
+        self.relation = np.asarray(relation, dtype=np.int64)
+        self.head_offsets = np.cumsum([0] + [len(it) for it in head])
+        self.head = np.asarray([r for it in head for r in it], dtype=np.int64)
+        self.tail_offsets = np.cumsum([0] + [len(it) for it in tail])
+        self.tail = np.asarray([r for it in tail for r in it], dtype=np.int64)
+        self.path_offsets = np.cumsum([0] + num_path)
+        self.path = pad_ragged([t for row in rows for t in row], [len(row) for row in rows])[0]
+        self.path_len = np.asarray(path_len, dtype=np.int64)
+        self.path_width = self.path.shape[1]
+
+    def num_path(self):
+        return np.diff(self.path_offsets)
+
+    def context_len(self):
+        #head and tail contexts are padded to a common length in the model
+        return np.maximum(np.diff(self.head_offsets), np.diff(self.tail_offsets))
+
+    def __getitem__(self, index):
+        p0, p1 = self.path_offsets[index], self.path_offsets[index + 1]
+        return (self.pos_id[index], self.relation[index],
+            self.head[self.head_offsets[index]:self.head_offsets[index + 1]],
+            self.tail[self.tail_offsets[index]:self.tail_offsets[index + 1]],
+            self.path[p0:p1], self.path_len[p0:p1])
+
+    def __len__(self):
+        return self.length
+
+
+def collate_tensors(batch):
+    [pos_id, relation, head, tail, path, path_len] = list(zip(*batch))
+    return TensorBatch.from_ragged(pos_id, relation,
+        np.concatenate(head), [len(it) for it in head],
+        np.concatenate(tail), [len(it) for it in tail],
+        np.concatenate(path), np.concatenate(path_len), [len(it) for it in path])
+
+class NegativeCollate(object):
+    """
+    collate_fn of a TensorDataset that pairs each batch with its precomputed
+    negatives: (positive TensorBatch, negative TensorBatch), or a list of
+    num_negative negative TensorBatches. neg_examples maps a positive id to
+    the columns [relation, head, tail, paths, num_path, path_len] of its
+    negatives, negative k + 1 being the k-th used. In DataLoader workers the
+    lookups and the padding happen off the training loop.
+    """
+    def __init__(self, neg_examples, num_negative=1):
+        self.neg_examples = neg_examples
+        self.num_negative = num_negative
+
+    def negatives(self, positive_ids, k):
+        columns = None
+        for positive_id in positive_ids:
+            #a store decodes the examples of a positive on every lookup
+            neg_examples = self.neg_examples[positive_id]
+            if columns is None:
+                columns = [[] for _ in range(len(neg_examples))]
+            for j in range(len(neg_examples)):
+                columns[j].append(neg_examples[j][k])
+        return tensorize(columns)
+
+    def __call__(self, batch):
+        batch = collate_tensors(batch)
+        positive_ids = batch.pos_id.tolist()
+        if self.num_negative == 1:
+            return batch, self.negatives(positive_ids, 1)
+        return batch, [self.negatives(positive_ids, num + 1) for num in range(self.num_negative)]
 
 def read_examples(data_path, vocab, relation_context, max_path_len, 
-        real_max_num_path, is_sparse=False, filter_path=True):
+        is_sparse=False, filter_path=True):
+    #masks are not stored, the model builds them from num_path and the path lengths
     examples = []
     max_num_path = 0
-    with open(relation_context, 'r') as f_dict:
-        r_context = json.load(f_dict)
+    r_context = RelationContext.load(relation_context).to_vocab(vocab)
     with open(data_path, "r") as fr:
         for line in fr.readlines():
             obj = json.loads(line.strip())
@@ -30,43 +193,33 @@ def read_examples(data_path, vocab, relation_context, max_path_len,
                     continue
 
             max_num_path = max(max_num_path, num_path)
-            path_mask = []
+            path_len = []
 
             for it in paths:
-                tmp_mask = [1 for i in range(len(it))]
+                path_len.append(len(it))
                 while len(it) < max_path_len:
                     it.append('[PAD]')
-                    tmp_mask.append(0)
                  #add [CLS]
                 it.insert(0, '[CLS]')
-                tmp_mask.insert(0, 1)
-
-                path_mask.append(tmp_mask)
                  
             #convert token to id
             relation = vocab.convert_tokens_to_ids([relation])[0]
             paths = [vocab.convert_tokens_to_ids(path) for path in paths]            
-            head = vocab.convert_tokens_to_ids(r_context[head])
-            tail = vocab.convert_tokens_to_ids(r_context[tail])
+            head = r_context.ids(head)
+            tail = r_context.ids(tail)
                   
             # create data examples
-            example = [positive_id, relation, head, tail, paths, num_path, path_mask]    
+            example = [positive_id, relation, head, tail, paths, num_path, path_len]    
             examples.append(example)
-
-        for example in examples:
-            # 4 for [MASK]\relation\head\tail
-            overall_mask = [1] * (example[5] + 4) + [0] * (real_max_num_path - example[5])
-            # mask relation
-            #overall_mask[1] = 0
-            example.append(overall_mask)
             
     return examples, max_num_path
 
 class MyDataset(Dataset):
     def __init__(self, data_path, vocab, relation_context, 
             max_path_len, real_max_num_path, is_sparse, filter_path=True):
+        #real_max_num_path no longer sizes stored masks, the model pads to its own max_num_path
         self.examples, self.max_num_path = read_examples(
-            data_path, vocab, relation_context, max_path_len, real_max_num_path, filter_path=filter_path)
+            data_path, vocab, relation_context, max_path_len, filter_path=filter_path)
         self.length = len(self.examples)
     
     def __getitem__(self, index):
@@ -74,3 +227,177 @@ class MyDataset(Dataset):
 
     def __len__(self):
         return self.length
+
+
+class BinaryDataset(Dataset):
+    """
+    MyDataset over a QueryStore written by preprocess_ind_data.py
+    --output_format binary. The arrays are memory-mapped and an example is
+    assembled in __getitem__; tokens and entity contexts are converted to
+    vocabulary ids once per distinct token or entity, not per example.
+    """
+    def __init__(self, data_dir, vocab, relation_context,
+            max_path_len, real_max_num_path, is_sparse, filter_path=True):
+        self.store = QueryStore.load(data_dir)
+        r_context = RelationContext.load(relation_context).to_vocab(vocab)
+        self.token_ids = np.asarray(vocab.convert_tokens_to_ids(self.store.tokens), dtype=np.int64)
+        self.contexts = [r_context.ids(ent) for ent in self.store.entities]
+        self.cls_id, self.pad_id = vocab.convert_tokens_to_ids(['[CLS]', '[PAD]'])
+        self.max_path_len = max_path_len
+
+        num_path = self.store.num_paths()
+        #while training, do not use samples without any paths
+        self.rows = np.flatnonzero(num_path > 0) if filter_path else np.arange(len(num_path))
+        self.max_num_path = int(num_path.max()) if len(num_path) > 0 else 0
+        self.length = len(self.rows)
+
+    def __getitem__(self, index):
+        row = self.rows[index]
+        store = self.store
+        start, end = store.query_offsets[row], store.query_offsets[row + 1]
+        offsets = store.path_offsets[start:end + 1].tolist()
+        tokens = self.token_ids[store.path_tokens[offsets[0]:offsets[-1]]].tolist()
+        paths, path_len = [], []
+        for a, b in zip(offsets[:-1], offsets[1:]):
+            n = b - a
+            n_pad = max(self.max_path_len - n, 0)
+            paths.append([self.cls_id] + tokens[a - offsets[0]:b - offsets[0]] + [self.pad_id] * n_pad)
+            path_len.append(n)
+        return [int(store.positive_id[row]),
+                int(self.token_ids[store.relation[row]]),
+                self.contexts[store.head[row]],
+                self.contexts[store.tail[row]],
+                paths, len(paths), path_len]
+
+    def __len__(self):
+        return self.length
+
+
+#arrays of a LazyDataset index, one entry per example kept
+INDEX_ARRAYS = ('offsets', 'path_counts', 'head_len', 'tail_len')
+
+
+def index_dir(data_path):
+    #train.json -> train_index/
+    return os.path.splitext(data_path)[0] + '_index'
+
+
+class LazyDataset(Dataset):
+    """
+    TensorDataset items read on demand from a json lines file of
+    preprocess_ind_data.py. The first run writes an index next to the file
+    (<split>_index/): the byte offset, path count and head and tail context
+    lengths of every example kept. The index is memory-mapped and
+    __getitem__ seeks to one line and converts it, so memory does not grow
+    with the number of examples. Forked DataLoader workers share the mapped
+    index and open their own file handle.
+    """
+    def __init__(self, data_path, vocab, relation_context, max_path_len, filter_path=True):
+        self.data_path = data_path
+        self.vocab = vocab
+        self.r_context = RelationContext.load(relation_context).to_vocab(vocab)
+        self.cls_id, self.pad_id = vocab.convert_tokens_to_ids(['[CLS]', '[PAD]'])
+        self.max_path_len = max_path_len
+        self.index = index_dir(data_path)
+        fingerprint = {'size': os.path.getsize(data_path), 'sha256': file_hash(data_path),
+            'relation_context': file_hash(relation_context), 'filter_path': filter_path}
+        meta = os.path.join(self.index, 'meta.json')
+        recorded = None
+        if os.path.exists(meta):
+            with open(meta, 'r') as fr:
+                recorded = json.load(fr)
+        if recorded is None or recorded['fingerprint'] != fingerprint:
+            recorded = self.build_index(fingerprint, filter_path)
+        for name in INDEX_ARRAYS:
+            setattr(self, name, np.load(os.path.join(self.index, name + '.npy'), mmap_mode='r'))
+        self.length = len(self.offsets)
+        self.max_num_path = recorded['max_num_path']
+        #paths longer than max_path_len are kept whole, as in read_examples
+        self.path_width = max(max_path_len, recorded['max_path_len']) + 1
+        self.handle = None
+        self.handle_pid = None
+
+    def build_index(self, fingerprint, filter_path):
+        offsets, path_counts, head_len, tail_len = [], [], [], []
+        max_num_path, max_path_len = 0, 0
+        context_len = np.diff(self.r_context.indptr)
+        with open(self.data_path, 'rb') as fr:
+            offset = 0
+            for line in fr:
+                obj = json.loads(line)
+                #while training, do not use samples without any paths
+                if not (filter_path and obj['num_path'] == 0):
+                    offsets.append(offset)
+                    path_counts.append(obj['num_path'])
+                    head_len.append(context_len[self.r_context.ent2id[obj['head']]])
+                    tail_len.append(context_len[self.r_context.ent2id[obj['tail']]])
+                    max_num_path = max(max_num_path, obj['num_path'])
+                    max_path_len = max([max_path_len] + [len(it) for it in obj['path']])
+                offset += len(line)
+        if not os.path.exists(self.index):
+            os.makedirs(self.index)
+        for name, values in zip(INDEX_ARRAYS, (offsets, path_counts, head_len, tail_len)):
+            np.save(os.path.join(self.index, name + '.npy'), np.asarray(values, dtype=np.int64))
+        recorded = {'fingerprint': fingerprint, 'max_num_path': max_num_path, 'max_path_len': max_path_len}
+        with open(os.path.join(self.index, 'meta.json'), 'w') as fw:
+            json.dump(recorded, fw)
+        return recorded
+
+    def num_path(self):
+        return np.asarray(self.path_counts)
+
+    def context_len(self):
+        #head and tail contexts are padded to a common length in the model
+        return np.maximum(self.head_len, self.tail_len)
+
+    def line(self, index):
+        #a handle per process, workers do not share the parent's file position
+        if self.handle_pid != os.getpid():
+            self.handle = open(self.data_path, 'rb')
+            self.handle_pid = os.getpid()
+        self.handle.seek(int(self.offsets[index]))
+        return json.loads(self.handle.readline())
+
+    def __getitem__(self, index):
+        obj = self.line(index)
+        paths = obj['path']
+        path = np.full((len(paths), self.path_width), self.pad_id, dtype=np.int64)
+        path[:, 0] = self.cls_id
+        for i, it in enumerate(paths):
+            path[i, 1:len(it) + 1] = self.vocab.convert_tokens_to_ids(it)
+        return (obj['positive_id'], self.vocab.convert_tokens_to_ids([obj['relation']])[0],
+            np.asarray(self.r_context.ids(obj['head']), dtype=np.int64),
+            np.asarray(self.r_context.ids(obj['tail']), dtype=np.int64),
+            path, np.asarray([len(it) for it in paths], dtype=np.int64))
+
+    def __len__(self):
+        return self.length
+
+
+class LazyBinaryDataset(BinaryDataset):
+    """
+    BinaryDataset giving TensorDataset items, for training without copying
+    the mapped QueryStore into memory.
+    """
+    def __init__(self, data_dir, vocab, relation_context, max_path_len, filter_path=True):
+        super(LazyBinaryDataset, self).__init__(data_dir, vocab, relation_context,
+            max_path_len, None, False, filter_path=filter_path)
+        lengths = np.diff(self.store.path_offsets)
+        self.path_width = max(max_path_len, int(lengths.max()) if len(lengths) > 0 else 0) + 1
+        entity_len = np.asarray([len(it) for it in self.contexts], dtype=np.int64)
+        self.context_lengths = np.maximum(entity_len[self.store.head[self.rows]],
+            entity_len[self.store.tail[self.rows]])
+
+    def num_path(self):
+        return self.store.num_paths()[self.rows]
+
+    def context_len(self):
+        return self.context_lengths
+
+    def __getitem__(self, index):
+        example = super(LazyBinaryDataset, self).__getitem__(index)
+        path = np.full((len(example[4]), self.path_width), self.pad_id, dtype=np.int64)
+        for i, row in enumerate(example[4]):
+            path[i, :len(row)] = row
+        return (example[0], example[1], np.asarray(example[2], dtype=np.int64),
+            np.asarray(example[3], dtype=np.int64), path, np.asarray(example[6], dtype=np.int64))
@@ -0,0 +1,91 @@
+#content-hash manifest that lets preprocessing stages skip unchanged work
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = 'manifest.json'
+#bytes read per hashing step
+HASH_BLOCK = 1 << 20
+
+
+def file_hash(path, size=None):
+    #sha256 of the file, or of its first size bytes
+    digest = hashlib.sha256()
+    remaining = os.path.getsize(path) if size is None else size
+    with open(path, 'rb') as fr:
+        while remaining > 0:
+            block = fr.read(min(HASH_BLOCK, remaining))
+            if len(block) == 0:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+
+def count_lines(path, size):
+    #lines in the first size bytes of a file
+    with open(path, 'rb') as fr:
+        return fr.read(size).count(b'\n')
+
+
+class Manifest(object):
+    """
+    Per-task record of what each preprocessing stage was last run on.
+
+    For every stage the manifest stores the size and sha256 of each input
+    file, the parameters, and the output files. A stage is fresh when all of
+    them match and its outputs exist, and can then be skipped. appended()
+    recognises inputs that only grew at the end since the last run, such as
+    triples appended to train.txt.
+    """
+
+    def __init__(self, task_dir):
+        self.path = os.path.join(task_dir, MANIFEST_NAME)
+        self.stages = dict()
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as fr:
+                self.stages = json.load(fr)
+
+    def fingerprint(self, inputs, params):
+        return {
+            'inputs': {name: {'size': os.path.getsize(path), 'sha256': file_hash(path)}
+                for name, path in sorted(inputs.items())},
+            'params': params}
+
+    def is_fresh(self, stage, inputs, params, outputs):
+        if stage not in self.stages:
+            return False
+        if not all(os.path.exists(path) for path in outputs):
+            return False
+        recorded = self.stages[stage]
+        return recorded['params'] == params \
+            and recorded['inputs'] == self.fingerprint(inputs, params)['inputs']
+
+    def appended(self, stage, name, path):
+        """
+        Number of lines the input `name` had at the last run of stage if
+        path still starts with exactly those bytes and has grown, else None.
+        """
+        recorded = self.stages.get(stage, dict()).get('inputs', dict()).get(name)
+        if recorded is None or os.path.getsize(path) <= recorded['size']:
+            return None
+        if file_hash(path, recorded['size']) != recorded['sha256']:
+            return None
+        with open(path, 'rb') as fr:
+            fr.seek(max(recorded['size'] - 1, 0))
+            #an unterminated last line may have been extended
+            if recorded['size'] > 0 and fr.read(1) != b'\n':
+                return None
+        return count_lines(path, recorded['size'])
+
+    def unchanged(self, stage, name, path):
+        recorded = self.stages.get(stage, dict()).get('inputs', dict()).get(name)
+        return recorded is not None and recorded['size'] == os.path.getsize(path) \
+            and recorded['sha256'] == file_hash(path)
+
+    def update(self, stage, inputs, params, outputs):
+        entry = self.fingerprint(inputs, params)
+        entry['outputs'] = list(outputs)
+        self.stages[stage] = entry
+        with open(self.path, 'w') as fw:
+            json.dump(self.stages, fw, indent=1)
@@ -0,0 +1,95 @@
+#background generation of training negatives for the batches ahead of the training loop
+import collections
+import multiprocessing as mp
+import queue
+
+import numpy as np
+
+
+def generate_negatives(generate, tasks, results):
+    #forked workers share the parent's generator state, every one draws its own
+    np.random.seed()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        key, batch = task
+        results.put((key, generate(batch)))
+
+
+class NegativeQueue(object):
+    """
+    Runs generate(batch) in forked worker processes for the batches that
+    iterate() reads ahead of the consumer. At most depth batches wait for a
+    worker; a batch whose negatives are not ready when the consumer reaches
+    it, or that found the queue full, is yielded with None, so the caller
+    never blocks on sampling and falls back to its precomputed negatives.
+    """
+
+    def __init__(self, generate, num_workers, depth=8):
+        context = mp.get_context('fork')
+        self.depth = depth
+        self.tasks = context.Queue(maxsize=depth)
+        self.results = context.Queue()
+        self.workers = [context.Process(target=generate_negatives, args=(generate, self.tasks, self.results),
+            daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+        self.next_key = 0
+        self.ready = dict()
+        #keys the consumer gave up on, their results are dropped when they arrive
+        self.late = set()
+        self.fresh = 0
+        self.fallback = 0
+
+    def submit(self, batch):
+        key = self.next_key
+        self.next_key += 1
+        try:
+            self.tasks.put_nowait((key, batch))
+        except queue.Full:
+            return None
+        return key
+
+    def take(self, key):
+        while True:
+            try:
+                done, negatives = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if done in self.late:
+                self.late.discard(done)
+            else:
+                self.ready[done] = negatives
+        if key is not None and key not in self.ready:
+            self.late.add(key)
+        negatives = self.ready.pop(key, None)
+        if negatives is None:
+            self.fallback += 1
+        else:
+            self.fresh += 1
+        return negatives
+
+    def iterate(self, batches, task=None):
+        #yields (batch, negatives or None), depth batches behind the submissions;
+        #workers receive task(batch), the whole batch by default
+        ahead = collections.deque()
+        for batch in batches:
+            ahead.append((self.submit(batch if task is None else task(batch)), batch))
+            if len(ahead) > self.depth:
+                key, batch = ahead.popleft()
+                yield batch, self.take(key)
+        while len(ahead) > 0:
+            key, batch = ahead.popleft()
+            yield batch, self.take(key)
+
+    def close(self):
+        for _ in self.workers:
+            try:
+                self.tasks.put(None, timeout=1)
+            except queue.Full:
+                break
+        for worker in self.workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
@@ -0,0 +1,82 @@
+#bulk corruption of (head, relation, tail) queries with a packed positive-edge filter
+import numpy as np
+
+#candidates drawn per missing negative, rejected draws are replaced by the surplus
+DRAW_FACTOR = 2
+#smallest block of candidates drawn at once
+MIN_DRAW = 16
+
+
+class NegativeSampler(object):
+    """
+    Random head or tail replacements that are not edges of the graph.
+
+    Every edge (h, label, t) of the KnowledgeGraph, inverse edges included,
+    is packed into the int64 key (h * num_labels + label) * num_nodes + t,
+    and the keys are kept sorted, so a block of candidates is checked
+    against the positives with one searchsorted. Candidates are drawn in
+    blocks with the global NumPy generator (or rng) and deduplicated in
+    draw order, which keeps the distribution of drawing one node at a time
+    and rejecting it.
+    """
+
+    def __init__(self, graph, rng=None):
+        self.graph = graph
+        self.rng = np.random if rng is None else rng
+        self.num_nodes = graph.num_nodes
+        self.num_labels = max(len(graph.id2label), 1)
+        heads = np.repeat(np.arange(graph.num_nodes, dtype=np.int64), np.diff(graph.indptr))
+        self.keys = np.sort(self.pack(heads, np.asarray(graph.labels, dtype=np.int64),
+            np.asarray(graph.indices, dtype=np.int64)))
+
+    def pack(self, heads, labels, tails):
+        return (heads * self.num_labels + labels) * self.num_nodes + tails
+
+    def is_positive(self, heads, labels, tails):
+        #labels < 0 are relations that are not in the graph, nothing is positive for them
+        keys = self.pack(np.asarray(heads, dtype=np.int64), np.asarray(labels, dtype=np.int64),
+            np.asarray(tails, dtype=np.int64))
+        if len(self.keys) == 0:
+            return np.zeros(keys.shape, dtype=bool)
+        found = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return (self.keys[found] == keys) & (np.asarray(labels) >= 0)
+
+    def rejected(self, candidates, heads, labels, tails, side):
+        #the kept endpoint itself, or a candidate that forms a positive edge
+        if side == 'head':
+            return (candidates == tails) | self.is_positive(candidates, labels, tails)
+        return (candidates == heads) | self.is_positive(heads, labels, candidates)
+
+    def candidates(self, head, label, tail, n, side):
+        """
+        n entity ids replacing side ('head' or 'tail') of (head, label, tail):
+        the positive endpoint first, then n - 1 distinct random entities in
+        the order they were drawn, none of them the other endpoint or
+        forming a positive edge.
+        """
+        taken = np.asarray([head if side == 'head' else tail], dtype=np.int64)
+        while len(taken) < n:
+            block = self.rng.randint(self.num_nodes, size=max(DRAW_FACTOR * (n - len(taken)), MIN_DRAW))
+            block = block[~self.rejected(block, head, label, tail, side)]
+            _, first = np.unique(block, return_index=True)
+            block = block[np.sort(first)]
+            block = block[~np.isin(block, taken)]
+            taken = np.concatenate([taken, block[:n - len(taken)]])
+        return taken
+
+    def draw(self, heads, labels, tails, side):
+        """
+        One replacement of side for every query of a batch of entity-id
+        arrays, drawn for all queries at once and redrawn for the rejected.
+        """
+        heads = np.asarray(heads, dtype=np.int64)
+        labels = np.asarray(labels, dtype=np.int64)
+        tails = np.asarray(tails, dtype=np.int64)
+        result = np.empty(len(heads), dtype=np.int64)
+        todo = np.arange(len(heads))
+        while len(todo) > 0:
+            block = self.rng.randint(self.num_nodes, size=len(todo))
+            bad = self.rejected(block, heads[todo], labels[todo], tails[todo], side)
+            result[todo[~bad]] = block[~bad]
+            todo = todo[bad]
+        return result
@@ -1,8 +1,9 @@
 import argparse
-import networkx as nx
+import functools
 import os 
 import re
 import json
+import pickle
 import numpy as np
 import multiprocessing as mp
 
@@ -10,21 +11,19 @@ from tqdm import tqdm
 import sys
 sys.path.append('.')
 from utils.vocab_reader import Vocabulary
-from preprocess_ind_data import filter_repeat_path
+from utils.kg_graph import KnowledgeGraph
+from utils.query_scheduler import QueryScheduler, timed, timing_path
+from utils.query_store import QueryStore
+from utils.manifest import Manifest, file_hash
+from utils.path_index import PathIndex
+from utils.relation_context import RelationContext
+from utils.negative_sampler import NegativeSampler
+from utils.negative_store import NegativeStoreWriter, store_dir
 import multiprocessing as mp
 
 
 def build_graph(raw_train):
-        biG = nx.MultiDiGraph()
-        with open(raw_train, 'r') as f_train:
-            for line in f_train.readlines():
-                tokens = re.split(r'\t|\s', line.strip())
-                head = tokens[0]
-                relation = tokens[1]
-                tail = tokens[2]
-                biG.add_edge(head, tail, **{'r_type': relation})
-                biG.add_edge(tail, head, **{'r_type': 'inv_' + relation})
-        return biG
+        return KnowledgeGraph.from_file(raw_train)
 
 
 def convert_neg_sample(examples, n):     
@@ -33,17 +32,135 @@ def convert_neg_sample(examples, n):
     tail = [examples[i][2]for i in range(n)]
     paths = [examples[i][3]for i in range(n)]
     num_path = [examples[i][4]for i in range(n)]
-    path_mask = [examples[i][5]for i in range(n)]
-    overall_mask = [examples[i][6]for i in range(n)]
-    neg_triplet = [relation, head, tail, paths, num_path, path_mask, overall_mask]
+    path_len = [examples[i][5]for i in range(n)]
+    neg_triplet = [relation, head, tail, paths, num_path, path_len]
     
     return neg_triplet
 
 
+def extract_paths(head, tail):
+    #distinct relation-id paths between two entity ids, sampled when --path_budget is set
+    if args.path_budget > 0:
+        paths, _ = graph.sample_paths(head, tail, args.max_hops, args.path_budget, args.time_budget)
+        return paths
+    if index is not None:
+        return index.lookup(graph, head, tail, args.max_hops)
+    return graph.search_relation_paths(head, tail, args.max_hops)
+
+
+def extract_paths_many(head, tail):
+    #extract_paths from one endpoint to a list of candidates (head or tail), searched together
+    if args.path_budget > 0:
+        if np.ndim(head) > 0:
+            return [extract_paths(h, tail) for h in head]
+        return [extract_paths(head, t) for t in tail]
+    if index is not None:
+        return index.lookup_many(graph, head, tail, args.max_hops)
+    return graph.search_relation_paths_many(head, tail, args.max_hops)
+
+
+def query_inputs(name, raw_predict):
+    #files the negatives of a query split depend on, for the manifest; the keys
+    #never collide with 'train', the graph the negatives are sampled from
+    if os.path.exists(raw_predict):
+        return {'queries_' + name: raw_predict}
+    query_dir = os.path.splitext(raw_predict)[0] + '_bin'
+    return {'queries_' + name + '_' + array: os.path.join(query_dir, array + '.npy')
+        for array in ('positive_id', 'relation', 'head', 'tail')}
+
+
+def negative_outputs(neg_paths):
+    #.npy files and/or their store directories, by --output_format
+    outputs = []
+    if args.output_format != 'binary':
+        outputs += neg_paths
+    if args.output_format != 'npy':
+        outputs += [store_dir(neg_path) for neg_path in neg_paths]
+    return outputs
+
+
+def shard_path(shard_dir, split, shard_id, num_shards):
+    return os.path.join(shard_dir, '%s-%d-of-%d.pkl' % (split, shard_id, num_shards))
+
+
+def shard_records(fr):
+    #pickled records up to the first one an interrupted run left incomplete
+    while True:
+        try:
+            yield pickle.load(fr)
+        except (EOFError, pickle.UnpicklingError, ValueError):
+            return
+
+
+def shard_header(fingerprint, graph_hash, split, shard_id, num_shards):
+    #a shard is only resumed or merged for the same inputs, parameters and train.txt
+    return dict(fingerprint, graph=graph_hash, split=split, shard=[shard_id, num_shards])
+
+
+def shard_done(path, header):
+    #a finished shard of other inputs or parameters is stale
+    if not os.path.exists(path):
+        return False
+    with open(path, 'rb') as fr:
+        return next(shard_records(fr), None) == header
+
+
+def open_shard(path, header):
+    """
+    Opens the partial file of a shard for appending (positive_id, negatives)
+    records after its header. Records of an interrupted run with the same
+    header are kept and their positive ids returned, so only the rest is
+    sampled again.
+    """
+    part = path + '.part'
+    done, end = set(), 0
+    if os.path.exists(part):
+        with open(part, 'rb') as fr:
+            records = shard_records(fr)
+            if next(records, None) == header:
+                end = fr.tell()
+                for pos_id, _ in records:
+                    done.add(pos_id)
+                    end = fr.tell()
+    fw = open(part, 'r+b' if end > 0 else 'wb')
+    fw.truncate(end)
+    fw.seek(end)
+    if end == 0:
+        pickle.dump(header, fw)
+    return fw, done
+
+
+def merge_shards(shard_dir, split, num_shards, neg_path):
+    """
+    Streams the records of all shards of a split, in shard order, into the
+    outputs of neg_path. The store is written record by record; only the
+    pickled .npy needs every negative at once, so the dict is built for
+    --output_format npy or both alone.
+    """
+    writer = None
+    if args.output_format != 'npy':
+        #paths are stored unpadded, [CLS] and [PAD] come back from the vocabulary ids
+        cls_id, pad_id = vocab.convert_tokens_to_ids(['[CLS]', '[PAD]'])
+        writer = NegativeStoreWriter(store_dir(neg_path), cls_id, pad_id, args.max_path_len)
+    neg_triplets = {} if args.output_format != 'binary' else None
+    for shard_id in range(num_shards):
+        with open(shard_path(shard_dir, split, shard_id, num_shards), 'rb') as fr:
+            records = shard_records(fr)
+            next(records)
+            for pos_id, neg_triplet in records:
+                if writer is not None:
+                    writer.add(pos_id, neg_triplet)
+                if neg_triplets is not None:
+                    neg_triplets[pos_id] = neg_triplet
+    if writer is not None:
+        writer.close()
+    if neg_triplets is not None:
+        np.save(neg_path, np.array(neg_triplets, dtype=object))
+
+
 def find_path(obj):
     
-    node_list = list(biG.nodes) #负样本采样的范围
-    n = len(node_list)
+    node_list = graph.id2ent #负样本采样的范围
     neg_triplets = {}
     
     relation = obj['relation']
@@ -51,110 +168,74 @@ def find_path(obj):
     tail = obj['tail']
     positive_id = obj['positive_id']
     relation_id = vocab.convert_tokens_to_ids([relation])[0]
+    relation_label = graph.label2id.get(relation, -1)
+    if index is not None:
+        hits, lookups = index.hits, index.hits + index.misses
 
-    neg_heads, neg_tails = [head], [tail]
-    #randomly sample neg_heads and neg_tails
-    while len(neg_heads) < n_sample:
-        neg_head = node_list[np.random.choice(n)]
-        if neg_head != tail and neg_head not in neg_heads:
-            flag = 1 #filter positive candidates
-            if biG.has_edge(neg_head, tail):
-                for i in biG[neg_head][tail]:
-                    if biG[neg_head][tail][i]['r_type'] == relation:
-                        flag = 0
-            if flag == 1:
-                neg_heads.append(neg_head)
-
-    while len(neg_tails) < n_sample:
-        neg_tail = node_list[np.random.choice(n)]
-        if neg_tail != head and neg_tail not in neg_tails:
-            flag = 1 #filter positive candidates
-            if biG.has_edge(head, neg_tail):
-                for i in biG[head][neg_tail]:
-                    if biG[head][neg_tail][i]['r_type'] == relation:
-                        flag = 0
-            if flag == 1:
-                neg_tails.append(neg_tail)
+    #randomly sample neg_heads and neg_tails, the positive first, without positive candidates
+    head_id, tail_id = graph.ent2id[head], graph.ent2id[tail]
+    neg_heads = [node_list[i] for i in sampler.candidates(head_id, relation_label, tail_id, n_sample, 'head').tolist()]
+    neg_tails = [node_list[i] for i in sampler.candidates(head_id, relation_label, tail_id, n_sample, 'tail').tolist()]
 
     neg_tails_path = {n_tail: [] for n_tail in neg_tails}
-    neg_tails_pathmask = {n_tail: [] for n_tail in neg_tails}
+    neg_tails_pathlen = {n_tail: [] for n_tail in neg_tails}
     neg_heads_path = {n_head: [] for n_head in neg_heads}
-    neg_heads_pathmask = {n_head: [] for n_head in neg_heads}
+    neg_heads_pathlen = {n_head: [] for n_head in neg_heads}
     
-    for ntail in neg_tails:
-        paths = nx.all_simple_edge_paths(biG, head, ntail, 4)
-        for path in paths:
-            r_path = [biG[edge[0]][edge[1]][edge[2]]
-                ['r_type'] for edge in path]
-            if len(r_path) == 1 and r_path[0] == relation:
+    #one search from the fixed endpoint reaches all candidates
+    tails_paths = extract_paths_many(head_id, [graph.ent2id[ntail] for ntail in neg_tails])
+    for ntail, paths in zip(neg_tails, tails_paths):
+        for r_path in paths:
+            if len(r_path) == 1 and r_path[0] == relation_label:
                 continue                  
-            neg_tails_path[ntail].append(r_path)
-
-    for nhead in neg_heads:
-        paths = nx.all_simple_edge_paths(biG, nhead, tail, 4)
-        for path in paths:
-            r_path = [biG[edge[0]][edge[1]][edge[2]]
-                ['r_type'] for edge in path]
-            if len(r_path) == 1 and r_path[0] == relation:
+            neg_tails_path[ntail].append(graph.relation_names(r_path))
+
+    heads_paths = extract_paths_many([graph.ent2id[nhead] for nhead in neg_heads], tail_id)
+    for nhead, paths in zip(neg_heads, heads_paths):
+        for r_path in paths:
+            if len(r_path) == 1 and r_path[0] == relation_label:
                 continue
-            neg_heads_path[nhead].append(r_path)
+            neg_heads_path[nhead].append(graph.relation_names(r_path))
 
-    #filter repeated paths & add path mask
+    #pad paths, the model builds the masks from the path lengths
     for neg_tail in neg_tails:
-        neg_tails_path[neg_tail] = filter_repeat_path(neg_tails_path[neg_tail])
         tmp = []
         for path in neg_tails_path[neg_tail]:
-            tmp_mask = [1 for i in range(len(path))]
+            neg_tails_pathlen[neg_tail].append(len(path))
             while len(path) < args.max_path_len:
                 path.append('[PAD]')
-                tmp_mask.append(0)
             path.insert(0, '[CLS]')
-            tmp_mask.insert(0, 1)
-            neg_tails_pathmask[neg_tail].append(tmp_mask)
             tmp.append(vocab.convert_tokens_to_ids(path))
         
         neg_tails_path[neg_tail] = tmp
 
     for neg_head in neg_heads:
-        neg_heads_path[neg_head] = filter_repeat_path(neg_heads_path[neg_head])
         tmp = []
         for path in neg_heads_path[neg_head]:
-            tmp_mask = [1 for i in range(len(path))]
+            neg_heads_pathlen[neg_head].append(len(path))
             while len(path) < args.max_path_len:
                 path.append('[PAD]')
-                tmp_mask.append(0)
             path.insert(0, '[CLS]')
-            tmp_mask.insert(0, 1)
-            neg_heads_pathmask[neg_head].append(tmp_mask)
             tmp.append(vocab.convert_tokens_to_ids(path))
         
         neg_heads_path[neg_head] = tmp
 
     # convert data to list of examples
     neg_head_examples = [[relation_id, 
-            vocab.convert_tokens_to_ids(r_context[neg_heads[i]]), 
-            vocab.convert_tokens_to_ids(r_context[tail]), 
+            r_context.ids(neg_heads[i]), 
+            r_context.ids(tail), 
             neg_heads_path[neg_heads[i]],
             len(neg_heads_path[neg_heads[i]]), 
-            neg_heads_pathmask[neg_heads[i]]] 
+            neg_heads_pathlen[neg_heads[i]]] 
             for i in range(n_sample)]
     neg_tail_examples = [[relation_id, 
-            vocab.convert_tokens_to_ids(r_context[head]), 
-            vocab.convert_tokens_to_ids(r_context[neg_tails[i]]), 
+            r_context.ids(head), 
+            r_context.ids(neg_tails[i]), 
             neg_tails_path[neg_tails[i]],
             len(neg_tails_path[neg_tails[i]]), 
-            neg_tails_pathmask[neg_tails[i]]] 
+            neg_tails_pathlen[neg_tails[i]]] 
             for i in range(n_sample)]
     
-    # add overall mask
-    for example in neg_head_examples:
-        overall_mask = [1] * (example[4] + 4) + [0] * (args.max_num_path - example[4])
-        # 3 for [MASK]\head\tail
-        example.append(overall_mask)
-    for example in neg_tail_examples:
-        overall_mask = [1] * (example[4] + 4) + [0] * (args.max_num_path - example[4])
-        example.append(overall_mask)
-    
     if path_mode == 'eval':
         neg_triplet = {}
         neg_triplet['neg_head_examples'] = convert_neg_sample(neg_head_examples, n_sample)
@@ -172,39 +253,98 @@ def find_path(obj):
         #neg_triplets[positive_id] = convert_neg_sample(tmp, num_sample)
         neg_triplet = convert_neg_sample(tmp, n_sample)
 
-    return neg_triplet, positive_id
+    if index is not None:
+        hits, lookups = index.hits - hits, index.hits + index.misses - lookups
+    else:
+        hits, lookups = 0, 0
+    return neg_triplet, positive_id, hits, lookups
 
 
 def get_neg_sampling_replacing_head_tail(raw_train, vocab_path, 
-                relation_context, raw_predict, num_sample=50, mode='eval'):
+                relation_context, raw_predict, num_sample=50, mode='eval', timing_file=None,
+                index_dir=None, shard=None, shard_file=None, header=None):
+    '''
+    Negatives for the queries of raw_predict, as a dict positive_id -> negatives.
+    shard = (shard_id, num_shards) only samples that contiguous part of the
+    queries; with shard_file the results are streamed to it instead of being
+    returned, resuming an interrupted run of the same header.
+    '''
 
-    global biG, vocab, n_sample, r_context, path_mode
+    global graph, vocab, n_sample, r_context, path_mode, index, sampler
     path_mode = mode
-    biG = build_graph(raw_train)
+    graph = build_graph(raw_train)
+    sampler = NegativeSampler(graph)
+    #forked workers inherit the index and append their misses to own segments
+    index = None
+    if index_dir and args.path_budget == 0:
+        index = PathIndex(index_dir, file_hash(raw_train))
     vocab = Vocabulary(vocab_file=vocab_path)
     n_sample = num_sample
-    with open(relation_context, 'r') as f_dict:
-        r_context = json.load(f_dict)
-    node_list = list(biG.nodes) #负样本采样的范围
+    r_context = RelationContext.load(relation_context).to_vocab(vocab)
+    node_list = graph.id2ent #负样本采样的范围
     n = len(node_list)
     neg_triplets = {}
     n_line = 0
     
     positive_list = []
-    with open(raw_predict, 'r') as fr:
-        for line in fr.readlines():
+    if not os.path.exists(raw_predict):
+        #queries preprocessed with --output_format binary only
+        store = QueryStore.load(os.path.splitext(raw_predict)[0] + '_bin')
+        for i in range(len(store)):
             tmp = {}
-            obj = json.loads(line.strip())
-            tmp['relation'] = obj['relation']
-            tmp['head'] = obj['head']
-            tmp['tail'] = obj['tail']
-            tmp['positive_id'] = obj['positive_id']
+            tmp['relation'] = store.tokens[store.relation[i]]
+            tmp['head'] = store.entities[store.head[i]]
+            tmp['tail'] = store.entities[store.tail[i]]
+            tmp['positive_id'] = int(store.positive_id[i])
             positive_list.append(tmp)
+    else:
+        with open(raw_predict, 'r') as fr:
+            for line in fr.readlines():
+                tmp = {}
+                obj = json.loads(line.strip())
+                tmp['relation'] = obj['relation']
+                tmp['head'] = obj['head']
+                tmp['tail'] = obj['tail']
+                tmp['positive_id'] = obj['positive_id']
+                positive_list.append(tmp)
+    if shard is not None:
+        shard_id, num_shards = shard
+        positive_list = positive_list[len(positive_list) * shard_id // num_shards:
+            len(positive_list) * (shard_id + 1) // num_shards]
+    fw = None
+    if shard_file is not None:
+        fw, done = open_shard(shard_file, header)
+        positive_list = [obj for obj in positive_list if obj['positive_id'] not in done]
         
+    #every corrupted pair keeps one endpoint of the positive, so the
+    #endpoint degrees drive the cost of a query
+    features = [graph.degree(graph.ent2id[obj['head']]) + graph.degree(graph.ent2id[obj['tail']])
+            for obj in positive_list]
+    scheduler = QueryScheduler(timing_file)
+    seconds = dict()
+    hits, lookups = 0, 0
     with mp.Pool(processes=None) as pool:
-        for (neg_triplet, pos_id) in tqdm(pool.imap_unordered(find_path, positive_list, 
-                chunksize=2), total=len(positive_list), desc=' Negative Sampling...'):
-            neg_triplets[pos_id] = neg_triplet
+        batches = scheduler.batches(positive_list, features)
+        with tqdm(total=len(positive_list), desc=' Negative Sampling...') as pbar:
+            for results in pool.imap_unordered(functools.partial(timed, find_path), batches, chunksize=1):
+                for (neg_triplet, pos_id, n_hits, n_lookups), second in results:
+                    if fw is not None:
+                        pickle.dump((pos_id, neg_triplet), fw)
+                        fw.flush()
+                    else:
+                        neg_triplets[pos_id] = neg_triplet
+                    seconds[pos_id] = second
+                    hits += n_hits
+                    lookups += n_lookups
+                pbar.update(len(results))
+    scheduler.record(features, [seconds[obj['positive_id']] for obj in positive_list])
+    if index is not None:
+        print("path index hit rate for {file}: {hits}/{lookups}".format(
+            file=raw_predict, hits=hits, lookups=lookups))
+    if fw is not None:
+        fw.close()
+        os.replace(shard_file + '.part', shard_file)
+        return None
     
     # for pos_id, positive_item in tqdm(enumerate(positive_list), total=len(positive_list), desc='Negative Sampling...'):
     #     neg_triplet = find_path(positive_item)
@@ -228,7 +368,20 @@ if __name__ == '__main__':
             'drkg','drkg_ind'
         ])
     parser.add_argument('--max_path_len', type=int, default=4)
-    parser.add_argument('--max_num_path', type=int, default=900)
+    parser.add_argument('--max_hops', type=int, default=4,
+                        help='same --max_hops as used by preprocess_ind_data.py')
+    parser.add_argument('--path_budget', type=int, default=0,
+                        help='sample at most this many relation paths per candidate; 0 enumerates all')
+    parser.add_argument('--time_budget', type=float, default=0,
+                        help='seconds of path search per candidate when --path_budget is set; 0 for no limit')
+    parser.add_argument('--path_index', type=str, default='',
+                        help='directory of an entity-pair path index shared with preprocessing, e.g. data_preprocessed/<task>/path_index; empty (the default) disables it')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='split the queries of every split into this many resumable shards')
+    parser.add_argument('--shard_id', type=int, default=None,
+                        help='only sample this shard, e.g. on one of several machines sharing neg_shards/')
+    parser.add_argument('--output_format', type=str, default='npy', choices=['npy', 'binary', 'both'],
+                        help='pickled .npy dicts, mapped int32 stores in neg_sample_<split>_bin/ for run.py --data_format binary, or both')
     args = parser.parse_args()
     data_dir = os.path.join(os.getcwd(), 'neg_samples')
     if not os.path.exists(data_dir):
@@ -242,7 +395,7 @@ if __name__ == '__main__':
     test_file= os.path.join(os.getcwd(), 'data_preprocessed', args.task, 'test.json')
     valid_file = os.path.join(os.getcwd(), 'data_preprocessed', args.task, 'valid.json')
     
-    ent_r_nbr = os.path.join('data_preprocessed', args.task, 'ent_r_nbr.json')
+    ent_r_nbr = os.path.join('data_preprocessed', args.task, 'ent_r_nbr.npz')
     """ test_r_nbr = os.path.join('data_preprocessed', args.task, 'test_r_nbr.json')
     valid_r_nbr = os.path.join('data_preprocessed', args.task, 'valid_r_nbr.json') """
     neg_save_path_valid = os.path.join(task_dir, 'neg_sample_valid.npy')
@@ -254,25 +407,61 @@ if __name__ == '__main__':
     else:
         vocab_path = os.path.join('data_preprocessed', args.task, 'vocab_rel.txt')
 
+    manifest = Manifest(task_dir)
+    inputs = {'train': raw_train, 'ent_r_nbr': ent_r_nbr, 'vocab_rel': vocab_path}
+    params = {'max_path_len': args.max_path_len,
+        'max_hops': args.max_hops, 'path_budget': args.path_budget, 'time_budget': args.time_budget,
+        'output_format': args.output_format}
+
     #在train-graph上，算指标用valid set里的query
     if args.task[-3:] == 'ind':
         print("It's a ind test graph set!")
-        neg_triplets = get_neg_sampling_replacing_head_tail(
-                raw_train=raw_train, vocab_path=vocab_path, 
-                relation_context=ent_r_nbr, 
-                raw_predict=test_file)
-        np.save(neg_save_path_test, neg_triplets)
+        splits = [('test', test_file, neg_save_path_test, 50, 'eval')]
+    else:
+        #训练用的负样本, 测试用的负样本
+        splits = [('train', train_file, neg_save_path_train, 11, 'train'),
+            ('valid', valid_file, neg_save_path_valid, 50, 'eval')]
+    for split, raw_predict, _, _, _ in splits:
+        inputs.update(query_inputs(split, raw_predict))
+    outputs = negative_outputs([neg_path for _, _, neg_path, _, _ in splits])
+    if manifest.is_fresh('negatives', inputs, params, outputs):
+        print('inputs and parameters are unchanged since the last run, skipping negative sampling')
     else:
-        #训练用的负样本
-        neg_triplets = get_neg_sampling_replacing_head_tail(
-                raw_train=raw_train, vocab_path=vocab_path, 
-                relation_context=ent_r_nbr, 
-                raw_predict=train_file, num_sample=11, mode='train')
-        np.save(neg_save_path_train, neg_triplets)
-        #测试用的负样本
-        neg_triplets = get_neg_sampling_replacing_head_tail(
-                raw_train=raw_train, vocab_path=vocab_path, 
-                relation_context=ent_r_nbr, 
-                raw_predict=valid_file)
-        np.save(neg_save_path_valid, np.array(neg_triplets, dtype=object))
-    print('DONE')
\ No newline at end of file
+        #shards stream their results to neg_shards/ and are merged once all of them exist
+        shard_dir = os.path.join(task_dir, 'neg_shards')
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+        shard_params = {name: value for name, value in params.items() if name != 'output_format'}
+        fingerprint = manifest.fingerprint(inputs, shard_params)
+        #the timings of the scheduler are kept per graph and hop limit, as in preprocess_ind_data.py
+        graph_hash = file_hash(raw_train)
+        shard_ids = range(args.num_shards) if args.shard_id is None else [args.shard_id]
+        for split, raw_predict, _, num_sample, mode in splits:
+            for shard_id in shard_ids:
+                header = shard_header(fingerprint, graph_hash, split, shard_id, args.num_shards)
+                path = shard_path(shard_dir, split, shard_id, args.num_shards)
+                if shard_done(path, header):
+                    continue
+                get_neg_sampling_replacing_head_tail(
+                        raw_train=raw_train, vocab_path=vocab_path,
+                        relation_context=ent_r_nbr,
+                        raw_predict=raw_predict, num_sample=num_sample, mode=mode,
+                        timing_file=timing_path(task_dir, 'neg_timings_' + mode, graph_hash, args.max_hops),
+                        index_dir=args.path_index, shard=(shard_id, args.num_shards),
+                        shard_file=path, header=header)
+        if all(shard_done(shard_path(shard_dir, split, shard_id, args.num_shards),
+                shard_header(fingerprint, graph_hash, split, shard_id, args.num_shards))
+                for split, _, _, _, _ in splits for shard_id in range(args.num_shards)):
+            vocab = Vocabulary(vocab_file=vocab_path)
+            for split, _, neg_path, _, _ in splits:
+                merge_shards(shard_dir, split, args.num_shards, neg_path)
+                for shard_id in range(args.num_shards):
+                    os.remove(shard_path(shard_dir, split, shard_id, args.num_shards))
+            manifest.update('negatives', inputs, params, outputs)
+        else:
+            print('shard {shard} of {num} done, the negatives are merged once all shards exist'.format(
+                shard=args.shard_id, num=args.num_shards))
+    if args.path_index:
+        #fold the segments of the pool workers into one
+        PathIndex(args.path_index, file_hash(raw_train)).compact()
+    print('DONE')
@@ -0,0 +1,280 @@
+#memory-mapped ragged store of the negative samples written by negative_sampling_random.py
+import argparse
+import json
+import os
+
+import numpy as np
+
+import sys
+sys.path.append('.')
+from utils.relation_context import pad_ragged
+
+#arrays written by NegativeStore.save and mapped back by NegativeStore.load
+NEGATIVE_ARRAYS = ('positive_id', 'group_offsets', 'relation',
+    'head_offsets', 'head_context', 'tail_offsets', 'tail_context',
+    'path_offsets', 'token_offsets', 'path_tokens')
+#int64 arrays of a store, the others are int32
+NEGATIVE_DTYPES = {'positive_id': np.int64, 'group_offsets': np.int64, 'head_offsets': np.int64,
+    'tail_offsets': np.int64, 'path_offsets': np.int64, 'token_offsets': np.int64}
+#bytes copied at a time when NegativeStoreWriter.close() turns its raw files into .npy
+COPY_BLOCK = 1 << 24
+#example groups of a positive in eval mode, a train positive has one unnamed group
+EVAL_GROUPS = ['neg_head_examples', 'neg_tail_examples']
+
+
+def store_dir(neg_path):
+    #neg_sample_valid.npy -> neg_sample_valid_bin/
+    return os.path.splitext(neg_path)[0] + '_bin'
+
+
+def strip_masks(group):
+    #[relation, head, tail, paths, num_path, path_len] of a group, also from the
+    #earlier layout that carried path_mask and overall_mask instead of path_len
+    if len(group) == 6:
+        return group
+    path_len = [[sum(mask) - 1 for mask in masks] for masks in group[5]]
+    return list(group[:5]) + [path_len]
+
+
+def load_negatives(neg_path, mmap_mode='r'):
+    #a store directory is mapped, a .npy of negatives is unpickled
+    if os.path.isdir(neg_path):
+        return NegativeStore.load(neg_path, mmap_mode=mmap_mode)
+    negatives = np.load(neg_path, allow_pickle=True).item()
+    for positive_id, value in negatives.items():
+        if isinstance(value, dict):
+            negatives[positive_id] = {name: strip_masks(group) for name, group in value.items()}
+        else:
+            negatives[positive_id] = strip_masks(value)
+    return negatives
+
+
+class NegativeStore(object):
+    """
+    Flat int32 arrays for the negatives of one split. Positive i owns the
+    example groups i*G:(i+1)*G (G = len(groups), or 1 in train mode), and
+    group g holds examples group_offsets[g]:group_offsets[g+1]. Example e
+    has relation[e], head and tail relation contexts given by the offset
+    arrays, and paths path_offsets[e]:path_offsets[e+1], path p being the
+    unpadded tokens path_tokens[token_offsets[p]:token_offsets[p+1]].
+    [CLS] and [PAD] are added back from the lengths, so store[positive_id]
+    gives back the lists of convert_neg_sample.
+    """
+
+    def __init__(self, groups, cls_id, pad_id, max_path_len):
+        self.groups = groups
+        self.cls_id = cls_id
+        self.pad_id = pad_id
+        self.max_path_len = max_path_len
+        self.positive_id = []
+        self.group_offsets = [0]
+        self.relation = []
+        self.head_offsets = [0]
+        self.head_context = []
+        self.tail_offsets = [0]
+        self.tail_context = []
+        self.path_offsets = [0]
+        self.token_offsets = [0]
+        self.path_tokens = []
+        self.order = None
+
+    @classmethod
+    def from_negatives(cls, neg_triplets, cls_id, pad_id, max_path_len):
+        """
+        Converts the dict of negative_sampling_random.py, positive id to
+        convert_neg_sample lists (train) or to a dict of them (eval).
+        """
+        values = list(neg_triplets.values())
+        groups = EVAL_GROUPS if len(values) > 0 and isinstance(values[0], dict) else None
+        store = cls(groups, cls_id, pad_id, max_path_len)
+        for positive_id, value in neg_triplets.items():
+            store.add(positive_id, [value[name] for name in groups] if groups else [value])
+        return store
+
+    def add(self, positive_id, groups):
+        #groups are convert_neg_sample lists [relation, head, tail, paths, num_path, path_len]
+        self.positive_id.append(positive_id)
+        for group in groups:
+            relation, head, tail, paths, _, path_len = strip_masks(group)
+            for e in range(len(relation)):
+                self.relation.append(relation[e])
+                self.head_context.extend(head[e])
+                self.head_offsets.append(len(self.head_context))
+                self.tail_context.extend(tail[e])
+                self.tail_offsets.append(len(self.tail_context))
+                for path, n in zip(paths[e], path_len[e]):
+                    #drop [CLS] and the [PAD]s
+                    self.path_tokens.extend(path[1:n + 1])
+                    self.token_offsets.append(len(self.path_tokens))
+                self.path_offsets.append(len(self.token_offsets) - 1)
+            self.group_offsets.append(len(self.relation))
+
+    def save(self, neg_dir):
+        if not os.path.exists(neg_dir):
+            os.makedirs(neg_dir)
+        for name in NEGATIVE_ARRAYS:
+            np.save(os.path.join(neg_dir, name + '.npy'),
+                np.asarray(getattr(self, name), dtype=NEGATIVE_DTYPES.get(name, np.int32)))
+        with open(os.path.join(neg_dir, 'meta.json'), 'w') as fw:
+            json.dump({'groups': self.groups, 'cls_id': self.cls_id, 'pad_id': self.pad_id,
+                'max_path_len': self.max_path_len}, fw)
+
+    @classmethod
+    def load(cls, neg_dir, mmap_mode='r'):
+        with open(os.path.join(neg_dir, 'meta.json'), 'r') as fr:
+            meta = json.load(fr)
+        store = cls(meta['groups'], meta['cls_id'], meta['pad_id'], meta['max_path_len'])
+        for name in NEGATIVE_ARRAYS:
+            setattr(store, name, np.load(os.path.join(neg_dir, name + '.npy'), mmap_mode=mmap_mode))
+        return store
+
+    def __len__(self):
+        return len(self.positive_id)
+
+    def keys(self):
+        return np.asarray(self.positive_id).tolist()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, positive_id):
+        return self.row(positive_id) is not None
+
+    def row(self, positive_id):
+        #positives keep the order they were written in, lookups go through a sorted view
+        if self.order is None:
+            self.order = np.argsort(self.positive_id, kind='stable')
+        found = np.searchsorted(self.positive_id, positive_id, sorter=self.order)
+        if found < len(self.order) and self.positive_id[self.order[found]] == positive_id:
+            return int(self.order[found])
+        return None
+
+    def __getitem__(self, positive_id):
+        i = self.row(positive_id)
+        if i is None:
+            raise KeyError(positive_id)
+        if self.groups is None:
+            return self.examples(i)
+        num_groups = len(self.groups)
+        return {name: self.examples(i * num_groups + g) for g, name in enumerate(self.groups)}
+
+    def ragged(self, offsets, values, e0, e1):
+        #rows e0:e1 of a ragged array, as lists
+        bounds = np.asarray(offsets[e0:e1 + 1])
+        flat = np.asarray(values[bounds[0]:bounds[-1]]).tolist()
+        bounds = (bounds - bounds[0]).tolist()
+        return [flat[bounds[k]:bounds[k + 1]] for k in range(e1 - e0)]
+
+    def examples(self, g):
+        """
+        Examples of group g in the layout of convert_neg_sample:
+        [relation, head, tail, paths, num_path, path_len].
+        """
+        e0, e1 = int(self.group_offsets[g]), int(self.group_offsets[g + 1])
+        relation = np.asarray(self.relation[e0:e1]).tolist()
+        head = self.ragged(self.head_offsets, self.head_context, e0, e1)
+        tail = self.ragged(self.tail_offsets, self.tail_context, e0, e1)
+        path_bounds = np.asarray(self.path_offsets[e0:e1 + 1])
+        num_path = np.diff(path_bounds).tolist()
+        token_bounds = np.asarray(self.token_offsets[path_bounds[0]:path_bounds[-1] + 1])
+        tokens = np.asarray(self.path_tokens[token_bounds[0]:token_bounds[-1]])
+        lengths = np.diff(token_bounds)
+        #paths shorter than max_path_len are padded to it, longer ones are kept whole
+        width = max(self.max_path_len, int(lengths.max()) if len(lengths) > 0 else 0)
+        ids = pad_ragged(tokens, lengths, width, self.cls_id, self.pad_id)[0].tolist()
+        if width > self.max_path_len:
+            keep = (np.maximum(lengths, self.max_path_len) + 1).tolist()
+            ids = [row[:k] for row, k in zip(ids, keep)]
+        lengths = lengths.tolist()
+        starts = (path_bounds - path_bounds[0]).tolist()
+        paths = [ids[starts[k]:starts[k + 1]] for k in range(e1 - e0)]
+        path_len = [lengths[starts[k]:starts[k + 1]] for k in range(e1 - e0)]
+        return [relation, head, tail, paths, num_path, path_len]
+
+
+class NegativeStoreWriter(object):
+    """
+    Writes a NegativeStore one positive at a time, so the negatives of a
+    split never have to be in memory together. add() appends the arrays
+    of a positive to raw files in neg_dir, shifting its offsets past the
+    ones already written; close() turns them into the .npy files and
+    meta.json that NegativeStore.load maps.
+    """
+
+    def __init__(self, neg_dir, cls_id, pad_id, max_path_len):
+        if not os.path.exists(neg_dir):
+            os.makedirs(neg_dir)
+        self.dir = neg_dir
+        self.cls_id = cls_id
+        self.pad_id = pad_id
+        self.max_path_len = max_path_len
+        self.groups = None
+        self.files = {name: open(self.raw_path(name), 'wb') for name in NEGATIVE_ARRAYS}
+        self.sizes = {name: 0 for name in NEGATIVE_ARRAYS}
+        #last value of every offset array, the offsets of the next positive start there
+        self.ends = {name: 0 for name in NEGATIVE_ARRAYS if name.endswith('_offsets')}
+        for name in self.ends:
+            self.write(name, [0])
+
+    def raw_path(self, name):
+        return os.path.join(self.dir, name + '.bin')
+
+    def write(self, name, values):
+        values = np.asarray(values, dtype=NEGATIVE_DTYPES.get(name, np.int32))
+        self.files[name].write(values.tobytes())
+        self.sizes[name] += len(values)
+
+    def add(self, positive_id, value):
+        #value is the negatives of positive_id in the layout of NegativeStore.from_negatives
+        if self.sizes['positive_id'] == 0:
+            self.groups = EVAL_GROUPS if isinstance(value, dict) else None
+        part = NegativeStore(self.groups, self.cls_id, self.pad_id, self.max_path_len)
+        part.add(positive_id, [value[name] for name in self.groups] if self.groups else [value])
+        for name in NEGATIVE_ARRAYS:
+            values = getattr(part, name)
+            if name in self.ends:
+                values = np.asarray(values[1:], dtype=np.int64) + self.ends[name]
+                if len(values) > 0:
+                    self.ends[name] = int(values[-1])
+            self.write(name, values)
+
+    def close(self):
+        for name in NEGATIVE_ARRAYS:
+            self.files[name].close()
+            dtype = NEGATIVE_DTYPES.get(name, np.int32)
+            n = self.sizes[name]
+            out = np.lib.format.open_memmap(os.path.join(self.dir, name + '.npy'), mode='w+',
+                dtype=dtype, shape=(n,))
+            if n > 0:
+                raw = np.memmap(self.raw_path(name), dtype=dtype, mode='r', shape=(n,))
+                step = COPY_BLOCK // np.dtype(dtype).itemsize
+                for start in range(0, n, step):
+                    out[start:start + step] = raw[start:start + step]
+                del raw
+            out.flush()
+            del out
+            os.remove(self.raw_path(name))
+        with open(os.path.join(self.dir, 'meta.json'), 'w') as fw:
+            json.dump({'groups': self.groups, 'cls_id': self.cls_id, 'pad_id': self.pad_id,
+                'max_path_len': self.max_path_len}, fw)
+
+
+if __name__ == '__main__':
+    #converts the pickled .npy negatives of a task into stores next to them
+    from utils.vocab_reader import Vocabulary
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', type=str, required=True)
+    parser.add_argument('--max_path_len', type=int, default=4)
+    args = parser.parse_args()
+    task = args.task[:-4] if args.task[-3:] == 'ind' else args.task
+    vocab = Vocabulary(vocab_file=os.path.join('data_preprocessed', task, 'vocab_rel.txt'))
+    cls_id, pad_id = vocab.convert_tokens_to_ids(['[CLS]', '[PAD]'])
+    task_dir = os.path.join('neg_samples', args.task)
+    for split in ('train', 'valid', 'test'):
+        neg_path = os.path.join(task_dir, 'neg_sample_{}.npy'.format(split))
+        if not os.path.exists(neg_path):
+            continue
+        store = NegativeStore.from_negatives(np.load(neg_path, allow_pickle=True).item(),
+            cls_id, pad_id, args.max_path_len)
+        store.save(store_dir(neg_path))
+        print('{} -> {}: {} positives'.format(neg_path, store_dir(neg_path), len(store)))
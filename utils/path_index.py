@@ -0,0 +1,152 @@
+#persistent (graph, head, tail, max_hops) -> relation paths index on local files
+import glob
+import os
+import uuid
+
+import numpy as np
+
+
+class PathIndex(object):
+    """
+    Distinct relation-id paths of entity pairs, kept across runs and tools.
+
+    Entries live under index_dir/<graph hash>, so entity ids are always
+    those of the graph the paths were found in. Every process appends to
+    its own segment: <name>.log holds the records (int32 path count, token
+    count, path lengths, label ids) and <name>.idx the int64 rows
+    (head, tail, max_hops, log offset) that locate them. Opening the index
+    loads all .idx files into a dict, so lookups are one hash probe and one
+    read. Segments written while a pool runs are picked up by the next
+    PathIndex opened on the directory, and compact() folds the segments it
+    loaded into one, so the files do not pile up across runs.
+    """
+
+    def __init__(self, index_dir, graph_hash):
+        self.dir = os.path.join(index_dir, graph_hash)
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir, exist_ok=True)
+        self.entries = dict()
+        self.segments = []
+        for idx_file in sorted(glob.glob(os.path.join(self.dir, '*.idx'))):
+            log_file = idx_file[:-4] + '.log'
+            if not os.path.exists(log_file):
+                continue
+            rows = np.fromfile(idx_file, dtype=np.int64)
+            rows = rows[:len(rows) // 4 * 4].reshape(-1, 4)
+            #rows past the end of the log come from an interrupted write
+            rows = rows[rows[:, 3] < os.path.getsize(log_file)]
+            segment = len(self.segments)
+            self.segments.append(log_file)
+            for head, tail, max_hops, offset in rows.tolist():
+                self.entries[(head, tail, max_hops)] = (segment, offset)
+        self.readers = dict()
+        self.writer = None
+        self.writer_pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, segment, offset):
+        #raw bytes of the record at offset of a segment
+        if segment not in self.readers:
+            self.readers[segment] = open(self.segments[segment], 'rb')
+        #positional reads, forked workers share the parent's file offsets
+        fd = self.readers[segment].fileno()
+        n_paths, n_tokens = np.frombuffer(os.pread(fd, 8, offset), dtype=np.int32).tolist()
+        return os.pread(fd, 8 + 4 * (n_paths + n_tokens), offset)
+
+    def get(self, head, tail, max_hops):
+        entry = self.entries.get((head, tail, max_hops))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        record = np.frombuffer(self.record(*entry), dtype=np.int32).tolist()
+        n_paths, body = record[0], record[2:]
+        lengths, tokens = body[:n_paths], body[n_paths:]
+        paths, start = [], 0
+        for n in lengths:
+            paths.append(tuple(tokens[start:start + n]))
+            start += n
+        return paths
+
+    def put(self, head, tail, max_hops, paths):
+        if self.writer_pid != os.getpid():
+            #a forked worker must not share the parent's segment
+            name = os.path.join(self.dir, '%d-%s' % (os.getpid(), uuid.uuid4().hex[:8]))
+            self.writer = (open(name + '.log', 'ab'), open(name + '.idx', 'ab'))
+            self.writer_pid = os.getpid()
+            self.segments.append(name + '.log')
+        f_log, f_idx = self.writer
+        lengths = [len(path) for path in paths]
+        tokens = [label for path in paths for label in path]
+        offset = f_log.tell()
+        f_log.write(np.asarray([len(paths), len(tokens)] + lengths + tokens, dtype=np.int32).tobytes())
+        f_log.flush()
+        f_idx.write(np.asarray([head, tail, max_hops, offset], dtype=np.int64).tobytes())
+        f_idx.flush()
+        self.entries[(head, tail, max_hops)] = (len(self.segments) - 1, offset)
+
+    def lookup(self, graph, head, tail, max_hops, search='auto'):
+        #cached paths, or search_relation_paths stored for the next time
+        paths = self.get(head, tail, max_hops)
+        if paths is None:
+            paths = graph.search_relation_paths(head, tail, max_hops, search)
+            self.put(head, tail, max_hops, paths)
+        return paths
+
+    def lookup_many(self, graph, head, tail, max_hops):
+        """
+        lookup for a fixed endpoint and a list of candidates (head or tail
+        is the list): the misses are searched together with
+        search_relation_paths_many and stored one entry per pair.
+        """
+        many_heads = np.ndim(head) > 0
+        pairs = [(h, tail) for h in head] if many_heads else [(head, t) for t in tail]
+        found = [self.get(h, t, max_hops) for h, t in pairs]
+        missing = [i for i, paths in enumerate(found) if paths is None]
+        if len(missing) > 0:
+            if many_heads:
+                searched = graph.search_relation_paths_many([pairs[i][0] for i in missing], tail, max_hops)
+            else:
+                searched = graph.search_relation_paths_many(head, [pairs[i][1] for i in missing], max_hops)
+            for i, paths in zip(missing, searched):
+                self.put(pairs[i][0], pairs[i][1], max_hops, paths)
+                found[i] = paths
+        return found
+
+    def compact(self):
+        """
+        Rewrites the entries of the loaded segments into one new segment
+        and removes the old ones. Call it once no worker writes any more;
+        segments created after this index was opened are left alone.
+        """
+        if len(self.segments) <= 1:
+            return
+        name = os.path.join(self.dir, 'compact-%s' % uuid.uuid4().hex[:8])
+        entries = dict()
+        with open(name + '.log', 'wb') as f_log:
+            rows = []
+            for key, entry in self.entries.items():
+                rows.append(list(key) + [f_log.tell()])
+                f_log.write(self.record(*entry))
+                entries[key] = (0, rows[-1][3])
+        #the index is written last, an interrupted compaction leaves no rows
+        with open(name + '.idx', 'wb') as f_idx:
+            f_idx.write(np.asarray(rows, dtype=np.int64).reshape(-1, 4).tobytes())
+        for reader in self.readers.values():
+            reader.close()
+        if self.writer is not None and self.writer_pid == os.getpid():
+            for f in self.writer:
+                f.close()
+        for log_file in self.segments:
+            for path in (log_file, log_file[:-4] + '.idx'):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.segments = [name + '.log']
+        self.entries = entries
+        self.readers = dict()
+        self.writer = None
+        self.writer_pid = None
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
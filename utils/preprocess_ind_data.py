@@ -6,11 +6,21 @@ import os
 import argparse
 import logging
 
-import networkx as nx
+import functools
 import multiprocessing as mp
+import numpy as np
 from rich.progress import track
 from tqdm import tqdm
 
+import sys
+sys.path.append('.')
+from utils.kg_graph import KnowledgeGraph
+from utils.query_scheduler import QueryScheduler, timed, timing_path
+from utils.query_store import QueryStore
+from utils.manifest import Manifest, file_hash
+from utils.path_index import PathIndex
+from utils.relation_context import RelationContext
+
 logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
     level=logging.DEBUG,
@@ -18,23 +28,57 @@ logging.basicConfig(
     filemode='a')
 
 
-def filter_repeat_path(relation_path):
-    filtered_path = []
-    for path in relation_path:
-        flag = 1
-        for non_repeat_path in filtered_path:
-            if path == non_repeat_path:
-                flag = -1
-                break
-        if flag == 1:
-            filtered_path.append(path)
-    return filtered_path
+def binary_dir(query_output):
+    #train.json -> train_bin/
+    return os.path.splitext(query_output)[0] + '_bin'
+
+
+def attach_graph(graph_dir, max_hops, path_search, path_budget=0, time_budget=0, index_dir=None, graph_hash=None):
+    #pool initializer: every worker maps the graph saved by build_graph once
+    global worker_graph, worker_max_hops, worker_path_search, worker_path_budget, worker_time_budget
+    global worker_index
+    worker_graph = KnowledgeGraph.load(graph_dir)
+    worker_max_hops = max_hops
+    worker_path_search = path_search
+    worker_path_budget = path_budget
+    worker_time_budget = time_budget
+    worker_index = PathIndex(index_dir, graph_hash) if index_dir else None
+
+
+def named_paths(graph, r_paths, relation):
+    #relation names of the paths, without the queried relation itself
+    relation_path = []
+    for r_path in r_paths:
+        if len(r_path) == 1 and r_path[0] == relation:
+            continue
+        relation_path.append(graph.relation_names(r_path))
+    return relation_path
+
+
+def find_path(query):
+    #query is (positive_id, head id, tail id, relation label id)
+    idx, head, tail, relation = query
+    truncated = False
+    if head < 0 or tail < 0:
+        return [], idx, truncated
+    if worker_path_budget > 0:
+        #seeded by the query so reruns keep the same sample
+        r_paths, truncated = worker_graph.sample_paths(head, tail, worker_max_hops,
+            worker_path_budget, worker_time_budget, np.random.default_rng(idx))
+    elif worker_index is not None:
+        r_paths = worker_index.lookup(worker_graph, head, tail, worker_max_hops, worker_path_search)
+    else:
+        """ 枚举max_hops跳以内的所有关系路径 """
+        r_paths = worker_graph.search_relation_paths(head, tail, worker_max_hops, worker_path_search)
+
+    return named_paths(worker_graph, r_paths, relation), idx, truncated
 
 
 class DataProcessor(object):
 
     def __init__(self, raw_train, raw_test, raw_valid, train, test, valid,
-            ent_voc, rel_voc, ent_r_nbr, neg_test, neg_valid):
+            ent_voc, rel_voc, ent_r_nbr, neg_test, neg_valid, max_hops=4, path_search='auto',
+            graph_dir=None, path_budget=0, time_budget=0, output_format='json', index_dir=None):
         self.raw_train = raw_train
         self.raw_valid = raw_valid
         self.raw_test = raw_test
@@ -47,48 +91,42 @@ class DataProcessor(object):
         self.ent_r_nbr = ent_r_nbr
 
         self.neg_test, self.neg_valid = neg_test, neg_valid
+        self.max_hops = max_hops
+        self.path_search = path_search
+        #a path budget of 0 keeps exhaustive enumeration
+        self.path_budget = path_budget
+        self.time_budget = time_budget
+        #'json' lines, 'binary' columnar arrays (see QueryStore) or 'both'
+        self.output_format = output_format
+        #exhaustive paths are shared with other tools through a PathIndex here
+        self.index_dir = index_dir
+        if graph_dir is None:
+            graph_dir = os.path.join(os.path.dirname(train), 'graph')
+        self.graph_dir = graph_dir
+        self.scheduler = QueryScheduler(timing_path(os.path.dirname(train), 'path_timings',
+            file_hash(raw_train), max_hops))
 
     def build_graph(self):
-        self.biG = nx.MultiDiGraph()
-        total_links = 0
-        with open(self.raw_train, 'r') as f_train:
-            for line in f_train.readlines():
-                total_links = total_links + 1
-                tokens = re.split(r'\t|\s', line.strip())
-                head = tokens[0]
-                relation = tokens[1]
-                tail = tokens[2]
-                self.biG.add_edge(head, tail, **{'r_type': relation})
-                self.biG.add_edge(tail, head, **{'r_type': 'inv_' + relation})
-        f_train.close()
-        print("number of links in train is:{links}".format(links=total_links))
-        
-    def find_path(self, idx):
-        
-        obj = self.positive_obj[idx]
-        head = obj['head']
-        tail = obj['tail']
-        relation = obj['relation']
-        relation_path = []
-        """ 将路径长度从1增长到4，直到找到路径 """
-        for path in nx.all_simple_edge_paths(self.biG, head, tail, 4):
-            r_path = [self.biG[edge[0]][edge[1]][edge[2]]
-                ['r_type'] for edge in path]
-            if len(r_path) == 1 and r_path[0] == relation:
-                continue
-            relation_path.append(r_path)
-        relation_path = filter_repeat_path(relation_path)
-
-        return relation_path, idx
+        self.graph = KnowledgeGraph.from_file(self.raw_train)
+        #workers map this copy instead of receiving the graph through pickling
+        self.graph.save(self.graph_dir)
+        self.graph_hash = file_hash(self.raw_train)
+        self.index = None
+        if self.index_dir and self.path_budget == 0:
+            self.index = PathIndex(self.index_dir, self.graph_hash)
+        print("number of links in train is:{links}".format(links=self.graph.num_triples))
 
-    def build_query_data(self, query_data, query_output):
+    def build_query_data(self, query_data, query_output, changed_nodes=None):
         #build input data
         #Query data is what we need to reason. 
         #Query output is a file with h\r\t\r-path for each triplet, 
         #where r is to be predicted with h\t\r-path.
+        #With changed_nodes (endpoints of triples appended to train.txt),
+        #queries out of reach of them keep their paths from query_output.
         total_links = 0
         n_zero_path_ent_pairs = 0
         max_num_path = 0
+        n_truncated = 0
         self.positive_obj = dict()
         with open(query_data, 'r') as f_r:
             for line in f_r.readlines():
@@ -104,95 +142,89 @@ class DataProcessor(object):
                 new_obj['tail'] = tail
                 self.positive_obj[total_links] = new_obj
 
-        with open(query_output, 'w') as fw:
-            with mp.Pool(processes=None) as pool:
-                inputs = range(1, total_links + 1)
-                for (relation_path, pos_id) in tqdm(pool.imap(self.find_path, inputs, chunksize=16), 
-                        total=total_links, desc=query_data + ' Extracting Path...'):
-                    new_obj = self.positive_obj[pos_id]
-                    new_obj['positive_id'] = pos_id
-                    new_obj['path'] = relation_path
-                    new_obj['num_path'] = len(relation_path)
-                    fw.write(json.dumps(new_obj) + "\n")
-                    max_num_path = max(new_obj['num_path'], max_num_path)
-                    if len(relation_path) == 0:
-                        n_zero_path_ent_pairs += 1
-            
-        print("number of links in {file} is:{links}. number of zero path entity pairs is {zeros}. max number of path is {max_path}"
-            .format(file=query_data, links=total_links, zeros=n_zero_path_ent_pairs, max_path=max_num_path))    
+        previous = self.load_previous(query_output) if changed_nodes is not None else dict()
+        if changed_nodes is not None:
+            #a new path has to run through a new edge within max_hops
+            dist = self.graph.hop_distances(changed_nodes, self.max_hops).astype(np.int64)
 
-    def build_query_data_old(self, query_data, query_output):
-        #build input data
-        #Query data is what we need to reason. 
-        #Query output is a file with h\r\t\r-path for each triplet, 
-        #where r is to be predicted with h\t\r-path.
-        total_links = 0
-        n_zero_path_ent_pairs = 0
-        max_num_path = 0
-        all_obj = dict()
-        with open(query_data, 'r') as f_valid:
-            with open(query_output, 'w') as fw:
-                for line in tqdm(f_valid.readlines(), desc=query_data + ' Processing...'):
-                    total_links = total_links + 1
-                    tokens = re.split(r'\t|\s', line.strip())
-                    head = tokens[0]
-                    relation = tokens[1]
-                    tail = tokens[2]
-                    relation_path = []
-                    
-                    """ 将路径长度从1增长到4，直到找到路径 """
-                    for path in nx.all_simple_edge_paths(self.biG, head, tail, 4):
-                        r_path = [self.biG[edge[0]][edge[1]][edge[2]]
-                            ['r_type'] for edge in path]
-                        if len(r_path) == 1 and r_path[0] == relation:
-                            continue
-                        relation_path.append(r_path)
-                    if len(relation_path) == 0:
-                        n_zero_path_ent_pairs += 1
-                    #4-hop之内找不到，就当作没有路径处理
-
-                    new_obj = collections.OrderedDict()
-                    new_obj['relation'] = relation
-                    new_obj['head'] = head
-                    new_obj['tail'] = tail
-                    new_obj['positive_id'] = total_links
-                    new_obj['path'] = filter_repeat_path(relation_path)
-                    new_obj['num_path'] = len(new_obj['path'])
-                    
-                    fw.write(json.dumps(new_obj) + "\n")
-                    max_num_path = max(new_obj['num_path'], max_num_path)
-                    del relation_path
+        queries, features = [], []
+        relation_paths, truncated, seconds = dict(), dict(), dict()
+        for pos_id in range(1, total_links + 1):
+            obj = self.positive_obj[pos_id]
+            head = self.graph.ent2id.get(obj['head'], -1)
+            tail = self.graph.ent2id.get(obj['tail'], -1)
+            if pos_id in previous and (head < 0 or tail < 0 or dist[head] + dist[tail] + 1 > self.max_hops):
+                relation_paths[pos_id] = previous[pos_id]['path']
+                truncated[pos_id] = previous[pos_id].get('truncated', False)
+                continue
+            relation = self.graph.label2id.get(obj['relation'], -1)
+            r_paths = None if self.index is None or head < 0 or tail < 0 \
+                else self.index.get(head, tail, self.max_hops)
+            if r_paths is not None:
+                relation_paths[pos_id] = named_paths(self.graph, r_paths, relation)
+                truncated[pos_id] = False
+                continue
+            queries.append((pos_id, head, tail, relation))
+            #hub endpoints dominate the cost of a query
+            features.append(0 if head < 0 or tail < 0 else self.graph.degree(head) * self.graph.degree(tail))
+        if changed_nodes is not None:
+            print("{reused} of {links} queries in {file} are out of reach of the appended triples".format(
+                reused=len(relation_paths), links=total_links, file=query_data))
+
+        if self.index is not None:
+            print("path index hit rate for {file}: {hits}/{lookups}".format(
+                file=query_data, hits=self.index.hits, lookups=self.index.hits + self.index.misses))
+            self.index.hits, self.index.misses = 0, 0
+
+        #largest queries first, one cost-balanced batch per task
+        index_dir = self.index_dir if self.index is not None else None
+        with mp.Pool(processes=None, initializer=attach_graph, initargs=(self.graph_dir,
+                self.max_hops, self.path_search, self.path_budget, self.time_budget,
+                index_dir, self.graph_hash)) as pool:
+            batches = self.scheduler.batches(queries, features)
+            with tqdm(total=len(queries), desc=query_data + ' Extracting Path...') as pbar:
+                for results in pool.imap_unordered(functools.partial(timed, find_path), batches, chunksize=1):
+                    for (relation_path, pos_id, is_truncated), second in results:
+                        relation_paths[pos_id] = relation_path
+                        truncated[pos_id] = is_truncated
+                        seconds[pos_id] = second
+                    pbar.update(len(results))
+        self.scheduler.record(features, [seconds[query[0]] for query in queries])
+
+        store = QueryStore() if self.output_format != 'json' else None
+        fw = open(query_output, 'w') if self.output_format != 'binary' else None
+        for pos_id in range(1, total_links + 1):
+            relation_path = relation_paths.pop(pos_id)
+            new_obj = self.positive_obj[pos_id]
+            new_obj['positive_id'] = pos_id
+            new_obj['path'] = relation_path
+            new_obj['num_path'] = len(relation_path)
+            if self.path_budget > 0:
+                new_obj['truncated'] = truncated[pos_id]
+                n_truncated += truncated[pos_id]
+            if fw is not None:
+                fw.write(json.dumps(new_obj) + "\n")
+            if store is not None:
+                store.add(pos_id, new_obj['relation'], new_obj['head'], new_obj['tail'],
+                    relation_path, new_obj.get('truncated'))
+            max_num_path = max(new_obj['num_path'], max_num_path)
+            if len(relation_path) == 0:
+                n_zero_path_ent_pairs += 1
+        if fw is not None:
+            fw.close()
+        if store is not None:
+            store.save(binary_dir(query_output))
+        if self.path_budget > 0:
+            print("{truncated} queries in {file} hit the path or time budget".format(
+                truncated=n_truncated, file=query_data))
+            
         print("number of links in {file} is:{links}. number of zero path entity pairs is {zeros}. max number of path is {max_path}"
             .format(file=query_data, links=total_links, zeros=n_zero_path_ent_pairs, max_path=max_num_path))    
 
-    def build_relation_context(self, query_data, relation_context_output):
-        ent_context = dict()
-        with open(query_data, 'r') as fr:
-            with open(relation_context_output, 'w') as fw:
-                for line in fr.readlines():
-                    tokens = re.split(r'\t|\s', line.strip())
-                    head = tokens[0]
-                    tail = tokens[2]
-
-                    for ent in [head, tail]:
-                        if ent not in ent_context.keys():
-                            r_nbr = set()
-                            #对于valid，用biG
-                            for _, v in self.biG.out_edges(ent):
-                                for n_edge in self.biG[ent][v]:
-                                    r_type = self.biG[ent][v][n_edge]['r_type']
-                                    r_nbr.add(r_type) #只包含出边或入边
-
-                                    """ if r_type.startswith('inv_'):
-                                        inv_r = r_type[4::]
-                                    else:
-                                        inv_r = 'inv_' + r_type
-                                    r_nbr.add(inv_r)
-                                    #nbr包含in and out的所有边和相应反关系 """
-                                
-                            ent_context[ent] = list(r_nbr)
-                fw.write(json.dumps(ent_context) + '\n')
-        print('finish building relation context')  
+    def build_relation_context(self, relation_context_output):
+        #relations on the edges of every train entity, as an entity x relation csr matrix
+        RelationContext.from_graph(self.graph).save(relation_context_output)
+        print('finish building relation context')
 
     def write_vocab(self, ent_list, rel_list):
         fout_ent_voc = open(self.ent_voc, "w")
@@ -227,17 +259,54 @@ class DataProcessor(object):
         print("number of unique entities: %s" % len(ent_dict))
         return ent_dict, rel_dict
 
+    def load_previous(self, query_output):
+        previous = dict()
+        with open(query_output, 'r') as fr:
+            for line in fr.readlines():
+                obj = json.loads(line.strip())
+                previous[obj['positive_id']] = obj
+        return previous
+
     def preprocess(self):
+        manifest = Manifest(os.path.dirname(self.train))
+        inputs = {'train': self.raw_train, 'test': self.raw_test, 'valid': self.raw_valid}
+        params = {'max_hops': self.max_hops, 'path_search': self.path_search,
+            'path_budget': self.path_budget, 'time_budget': self.time_budget,
+            'output_format': self.output_format}
+        outputs = [self.ent_r_nbr, self.ent_voc, self.rel_voc]
+        if self.output_format != 'binary':
+            outputs += [self.train, self.test, self.valid]
+        if self.output_format != 'json':
+            outputs += [binary_dir(self.train), binary_dir(self.test), binary_dir(self.valid)]
+        if manifest.is_fresh('preprocess', inputs, params, outputs):
+            print('inputs and parameters are unchanged since the last run, skipping preprocessing')
+            return
+
+        #if triples were only appended to train.txt, earlier paths away from them still hold
+        n_old_triples = None
+        if self.output_format != 'binary' \
+                and manifest.stages.get('preprocess', dict()).get('params') == params \
+                and all(os.path.exists(path) for path in outputs) \
+                and manifest.unchanged('preprocess', 'test', self.raw_test) \
+                and manifest.unchanged('preprocess', 'valid', self.raw_valid):
+            n_old_triples = manifest.appended('preprocess', 'train', self.raw_train)
+
         self.build_graph()
-        self.build_query_data(self.raw_train, self.train)
-        self.build_query_data(self.raw_test, self.test)
-        self.build_query_data(self.raw_valid, self.valid)
+        changed_nodes = None
+        if n_old_triples is not None:
+            changed_nodes = self.graph.triples[n_old_triples:, [0, 2]].ravel()
+            print("{new} triples appended to {file}, updating paths near them".format(
+                new=self.graph.num_triples - n_old_triples, file=self.raw_train))
+        self.build_query_data(self.raw_train, self.train, changed_nodes)
+        self.build_query_data(self.raw_test, self.test, changed_nodes)
+        self.build_query_data(self.raw_valid, self.valid, changed_nodes)
         """ self.build_relation_context(self.raw_test, self.test_r_nbr)
         self.build_relation_context(self.raw_valid, self.valid_r_nbr) """
-        self.build_relation_context(self.raw_train, self.ent_r_nbr)
+        self.build_relation_context(self.ent_r_nbr)
         
         ent_list, rel_list = self.get_unique_roles_values()
         self.write_vocab(ent_list=ent_list, rel_list=rel_list)
+        manifest.update('preprocess', inputs, params, outputs)
         
 
 if __name__ == '__main__':
@@ -254,6 +323,18 @@ if __name__ == '__main__':
             'nell_v3_ind', 'nell_v4_ind', 'WN18RR_v1_ind', 'WN18RR_v2_ind', 'WN18RR_v3_ind', 'WN18RR_v4_ind',
             'drkg','drkg_ind'
         ])
+    parser.add_argument('--max_hops', type=int, default=4,
+                        help='longest relational path to extract; train with --max_path_len >= max_hops')
+    parser.add_argument('--path_search', type=str, default='auto', choices=['auto', 'bidirectional', 'dfs', 'merged'],
+                        help='meet-in-the-middle, depth-first or prefix-merging path search (same paths)')
+    parser.add_argument('--path_budget', type=int, default=0,
+                        help='sample at most this many relation paths per query, e.g. --sample_path of run.py; 0 enumerates all')
+    parser.add_argument('--time_budget', type=float, default=0,
+                        help='seconds of path search per query when --path_budget is set; 0 for no limit')
+    parser.add_argument('--output_format', type=str, default='json', choices=['json', 'binary', 'both'],
+                        help='json lines, columnar arrays in <split>_bin/ for run.py --data_format binary, or both')
+    parser.add_argument('--path_index', type=str, default='',
+                        help='directory of an entity-pair path index shared with the negative sampler, e.g. data_preprocessed/<task>/path_index; empty (the default) disables it')
     args = parser.parse_args()
     data_dir = os.path.join(os.getcwd(), 'data_preprocessed')
     if not os.path.exists(data_dir):
@@ -271,7 +352,7 @@ if __name__ == '__main__':
     valid = os.path.join(task_dir, 'valid.json')
     test_r_nbr = os.path.join(task_dir, 'test_r_nbr.json')
     valid_r_nbr = os.path.join(task_dir, 'valid_r_nbr.json')
-    ent_r_nbr = os.path.join(task_dir, 'ent_r_nbr.json')
+    ent_r_nbr = os.path.join(task_dir, 'ent_r_nbr.npz')
 
     neg_valid = os.path.join(task_dir, 'neg_valid.json')
     neg_test = os.path.join(task_dir, 'neg_test.json')
@@ -280,5 +361,12 @@ if __name__ == '__main__':
     ent_vocab = os.path.join(task_dir, 'vocab_ent.txt')
 
     data_process = DataProcessor(raw_train, raw_test, raw_valid, train, test, valid, 
-            ent_vocab, rel_vocab, ent_r_nbr, neg_valid, neg_test)
+            ent_vocab, rel_vocab, ent_r_nbr, neg_valid, neg_test,
+            max_hops=args.max_hops, path_search=args.path_search,
+            graph_dir=os.path.join(task_dir, 'graph'),
+            path_budget=args.path_budget, time_budget=args.time_budget,
+            output_format=args.output_format, index_dir=args.path_index)
     data_process.preprocess()
+    if args.path_index:
+        #fold the segments of the pool workers into one
+        PathIndex(args.path_index, file_hash(raw_train)).compact()
@@ -0,0 +1,97 @@
+#cost-aware scheduling of path-extraction queries over a process pool
+import os
+import time
+import multiprocessing as mp
+
+import numpy as np
+
+#batches handed out per worker; more batches balance better, fewer cut IPC
+BATCHES_PER_WORKER = 8
+#timings kept per file, the newest ones
+MAX_TIMINGS = 20000
+
+
+def timing_path(directory, name, graph_hash, max_hops):
+    #timings of one graph and hop limit, e.g. path_timings-<hash>-h4.txt
+    return os.path.join(directory, '%s-%s-h%d.txt' % (name, graph_hash[:16], max_hops))
+
+
+def timed(func, batch):
+    #runs func on every query of a batch inside a worker, with wall-clock seconds
+    results = []
+    for query in batch:
+        start = time.perf_counter()
+        result = func(query)
+        results.append((result, time.perf_counter() - start))
+    return results
+
+
+class QueryScheduler(object):
+    """
+    Orders queries by estimated cost, largest first, and packs them into
+    batches of about the same estimated cost: a hub query is a batch of its
+    own, cheap queries are grouped. The pool is fed one batch at a time
+    (chunksize=1), so a worker that runs out of work takes the next batch
+    from the shared task queue instead of waiting on a fixed chunk.
+
+    The cost of a query is predicted from a scalar feature (e.g. the degree
+    product of its endpoints) with a power law fitted to the timings that
+    earlier runs recorded in timing_file (see timing_path), at most the
+    MAX_TIMINGS newest ones.
+    """
+
+    def __init__(self, timing_file=None, num_workers=None):
+        self.timing_file = timing_file
+        self.num_workers = num_workers or mp.cpu_count()
+        self.scale = 1.0
+        self.power = 1.0
+        self.fit()
+
+    def load(self):
+        if self.timing_file is None or not os.path.exists(self.timing_file):
+            return np.zeros((0, 2))
+        return np.loadtxt(self.timing_file, ndmin=2).reshape(-1, 2)
+
+    def fit(self):
+        timings = self.load()
+        if len(timings) < 2:
+            return
+        x = np.log1p(timings[:, 0])
+        y = np.log(np.maximum(timings[:, 1], 1e-6))
+        if np.ptp(x) == 0:
+            return
+        self.power, log_scale = np.polyfit(x, y, 1)
+        self.scale = np.exp(log_scale)
+
+    def estimate(self, features):
+        return self.scale * np.power(1.0 + np.asarray(features, dtype=np.float64), self.power)
+
+    def batches(self, queries, features):
+        costs = self.estimate(features)
+        order = np.argsort(-costs, kind='stable')
+        target = costs.sum() / (self.num_workers * BATCHES_PER_WORKER)
+        batches, batch, batch_cost = [], [], 0.0
+        for i in order.tolist():
+            batch.append(queries[i])
+            batch_cost += costs[i]
+            if batch_cost >= target:
+                batches.append(batch)
+                batch, batch_cost = [], 0.0
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def record(self, features, seconds):
+        if self.timing_file is None:
+            return
+        new = np.column_stack([np.asarray(features, dtype=np.float64),
+            np.asarray(seconds, dtype=np.float64)]).reshape(-1, 2)
+        if len(new) > MAX_TIMINGS:
+            #a run with more queries than are kept leaves a uniform sample of them
+            new = new[np.sort(np.random.choice(len(new), MAX_TIMINGS, replace=False))]
+        timings = np.concatenate([self.load(), new])[-MAX_TIMINGS:]
+        with open(self.timing_file + '.tmp', 'w') as fw:
+            for feature, second in timings.tolist():
+                fw.write('%d\t%.6f\n' % (feature, second))
+        os.replace(self.timing_file + '.tmp', self.timing_file)
+        self.fit()
@@ -0,0 +1,92 @@
+#columnar binary store of preprocessed queries and their relation paths
+import json
+import os
+
+import numpy as np
+
+#arrays written by QueryStore.save and mapped back by QueryStore.load
+QUERY_ARRAYS = ('positive_id', 'relation', 'head', 'tail',
+    'query_offsets', 'path_offsets', 'path_tokens')
+
+
+class QueryStore(object):
+    """
+    Flat int arrays for the queries of one split. Query i has relation
+    tokens[relation[i]] between entities[head[i]] and entities[tail[i]],
+    and owns paths query_offsets[i]:query_offsets[i+1]. Path p is the token
+    sequence path_tokens[path_offsets[p]:path_offsets[p+1]]. Tokens and
+    entities are kept as strings, so the store does not depend on a
+    vocabulary and the loader converts each distinct token only once.
+    """
+
+    def __init__(self):
+        self.tokens = []
+        self.token2id = dict()
+        self.entities = []
+        self.ent2id = dict()
+        self.positive_id = []
+        self.relation = []
+        self.head = []
+        self.tail = []
+        self.query_offsets = [0]
+        self.path_offsets = [0]
+        self.path_tokens = []
+        self.truncated = None
+
+    def token_id(self, token):
+        if token not in self.token2id:
+            self.token2id[token] = len(self.tokens)
+            self.tokens.append(token)
+        return self.token2id[token]
+
+    def entity_id(self, ent):
+        if ent not in self.ent2id:
+            self.ent2id[ent] = len(self.entities)
+            self.entities.append(ent)
+        return self.ent2id[ent]
+
+    def add(self, positive_id, relation, head, tail, paths, truncated=None):
+        #paths are lists of token strings
+        self.positive_id.append(positive_id)
+        self.relation.append(self.token_id(relation))
+        self.head.append(self.entity_id(head))
+        self.tail.append(self.entity_id(tail))
+        for path in paths:
+            self.path_tokens.extend(self.token_id(token) for token in path)
+            self.path_offsets.append(len(self.path_tokens))
+        self.query_offsets.append(len(self.path_offsets) - 1)
+        if truncated is not None:
+            if self.truncated is None:
+                self.truncated = []
+            self.truncated.append(truncated)
+
+    def save(self, query_dir):
+        if not os.path.exists(query_dir):
+            os.makedirs(query_dir)
+        dtypes = {'positive_id': np.int64, 'query_offsets': np.int64, 'path_offsets': np.int64}
+        for name in QUERY_ARRAYS:
+            np.save(os.path.join(query_dir, name + '.npy'),
+                np.asarray(getattr(self, name), dtype=dtypes.get(name, np.int32)))
+        if self.truncated is not None:
+            np.save(os.path.join(query_dir, 'truncated.npy'), np.asarray(self.truncated, dtype=bool))
+        with open(os.path.join(query_dir, 'vocab.json'), 'w') as fw:
+            json.dump({'tokens': self.tokens, 'entities': self.entities}, fw)
+
+    @classmethod
+    def load(cls, query_dir, mmap_mode='r'):
+        store = cls.__new__(cls)
+        with open(os.path.join(query_dir, 'vocab.json'), 'r') as fr:
+            vocab = json.load(fr)
+        store.tokens = vocab['tokens']
+        store.entities = vocab['entities']
+        for name in QUERY_ARRAYS:
+            setattr(store, name, np.load(os.path.join(query_dir, name + '.npy'), mmap_mode=mmap_mode))
+        truncated = os.path.join(query_dir, 'truncated.npy')
+        store.truncated = np.load(truncated, mmap_mode=mmap_mode) if os.path.exists(truncated) else None
+        return store
+
+    def __len__(self):
+        return len(self.positive_id)
+
+    def num_paths(self):
+        return np.diff(self.query_offsets)
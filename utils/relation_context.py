@@ -0,0 +1,99 @@
+#sparse entity x relation context, the relations on the edges of every entity
+import numpy as np
+
+
+def pad_ragged(values, lengths, width=None, lead=None, pad_id=0):
+    """
+    Pads the ragged rows values[sum(lengths[:i]):sum(lengths[:i+1])] to
+    width (the longest row by default), after the token lead if given.
+    Returns int64 ids and 0/1 mask arrays of shape [len(lengths), width(+1)].
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if width is None:
+        width = int(lengths.max()) if len(lengths) > 0 else 0
+    start = 0 if lead is None else 1
+    ids = np.full((len(lengths), width + start), pad_id, dtype=np.int64)
+    mask = np.zeros((len(lengths), width + start), dtype=np.int64)
+    if lead is not None:
+        ids[:, 0] = lead
+        mask[:, 0] = 1
+    filled = np.arange(width) < lengths[:, None]
+    mask[:, start:] = filled
+    #boolean assignment fills row by row, in the order of values
+    ids[:, start:][filled] = values
+    return ids, mask
+
+
+class RelationContext(object):
+    """
+    CSR matrix of entities by relation labels: row i holds the distinct
+    labels (relations and inv_ relations) on the edges of entity
+    entities[i], in label order. Columns index `relations`, so the matrix
+    does not depend on a vocabulary; to_vocab() maps them to vocabulary ids
+    once, after which ids() and pad() need no token lookups.
+    """
+
+    def __init__(self, indptr, indices, entities, relations):
+        self.indptr = indptr
+        self.indices = indices
+        self.entities = list(entities)
+        self.relations = list(relations)
+        self.ent2id = {ent: i for i, ent in enumerate(self.entities)}
+        self.token_ids = None
+
+    @classmethod
+    def from_graph(cls, graph):
+        num_labels = max(len(graph.id2label), 1)
+        rows = np.repeat(np.arange(graph.num_nodes, dtype=np.int64), np.diff(graph.indptr))
+        #one key per (entity, label), sorted and deduplicated
+        keys = np.unique(rows * num_labels + np.asarray(graph.labels, dtype=np.int64))
+        indptr = np.zeros(graph.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // num_labels, minlength=graph.num_nodes), out=indptr[1:])
+        indices = (keys % num_labels).astype(np.int32)
+        return cls(indptr, indices, graph.id2ent, graph.id2label)
+
+    def save(self, path):
+        np.savez(path, indptr=self.indptr, indices=self.indices,
+            entities=np.asarray(self.entities, dtype=str),
+            relations=np.asarray(self.relations, dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays['indptr'], arrays['indices'],
+                arrays['entities'].tolist(), arrays['relations'].tolist())
+
+    def to_vocab(self, vocab):
+        self.token_ids = np.asarray(vocab.convert_tokens_to_ids(self.relations), dtype=np.int64)
+        return self
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, ent):
+        return ent in self.ent2id
+
+    def rows(self, entities):
+        return np.asarray([self.ent2id[ent] for ent in entities], dtype=np.int64)
+
+    def names(self, ent):
+        row = self.ent2id[ent]
+        return [self.relations[i] for i in self.indices[self.indptr[row]:self.indptr[row + 1]].tolist()]
+
+    def ids(self, ent):
+        #vocabulary ids of the context of one entity
+        row = self.ent2id[ent]
+        return self.token_ids[self.indices[self.indptr[row]:self.indptr[row + 1]]].tolist()
+
+    def pad(self, rows, width=None, lead=None, pad_id=0):
+        """
+        Padded vocabulary ids and mask of the contexts of a batch of entity
+        rows, gathered from the CSR arrays in one call; see pad_ragged.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        #csr position of every context entry of the batch, row by row
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        values = self.token_ids[self.indices[np.repeat(starts, lengths) + within]]
+        return pad_ragged(values, lengths, width, lead, pad_id)